@@ -28,6 +28,117 @@ and pysysconf.syslog_verbosity (for syslog). These should be set to
 LOG_NONE, LOG_ERROR, LOG_ACTION, or LOG_NO_ACTION, in increasing order
 of verbosity.
 
+For runs that act on many objects, setting pysysconf.log_aggregate to
+True replaces the messages about each object copied, deleted, or
+changed within a directory by one summary per action and check, such
+as "removed 98,211 objects under /var/spool/x", and setting
+pysysconf.log_buffer_lines writes messages to stdout in batches of
+that many lines (errors are written at once).
+
+Removal of directories:
+
+If pysysconf.remove_in_background is True, directories being deleted
+are first renamed into a trash directory at the top of their
+filesystem, so that they disappear immediately, and are then deleted
+by pysysconf.remove_threads background threads. Call
+wait_for_removals() to wait for them to finish. Trash left behind by
+an earlier run is deleted the next time the trash directory is used.
+Set pysysconf.trash_dir to use one directory of your choice instead
+(directories on other filesystems are then deleted in the
+foreground).
+
+Backups:
+
+By default, objects that are replaced or removed with backup = True
+are renamed to <filename>.<isodate>. If pysysconf.backup_dir is set
+to a directory name, they are instead saved in a content-addressed
+store in that directory, so that identical content is only stored
+once (compressed with gzip if pysysconf.backup_compress is True).
+Each saved object is recorded in backup_dir/index, and old backups
+can be pruned with check_backups_pruned().
+
+Convergence state:
+
+If pysysconf.state_db is set to a filename, check_copy() records in
+that SQLite database a fingerprint of its arguments and of the stat
+data of the source and destination trees after each successful run.
+Later runs skip all comparison and copying while both fingerprints
+are unchanged. Set pysysconf.force_full_run to True to ignore the
+recorded state (it is still updated).
+
+If pysysconf.expiry_index is also True, check_not_exists() with a
+test_age records in the database, for each directory it searches, the
+directory's mtime and the earliest time any entry in it becomes old
+enough to remove. Later runs only list the directories that have
+changed or have something due, and lstat the others.
+
+Multiple roots:
+
+If pysysconf.root is set to a directory, all absolute destination
+pathnames given to the check_* functions (and the account databases
+used by check_users() and check_groups()) are taken relative to that
+directory instead of /, so a policy can be applied to a chroot or
+disk image. Source pathnames are not affected. run_roots() applies a
+policy to many roots in parallel.
+
+Large files:
+
+If pysysconf.large_file_size is set to a number of bytes, files at
+least that large are copied preserving holes (sparse regions), with
+blocks preallocated, and without leaving the data in the page cache.
+
+Copy verification:
+
+check_copy() with verify = True reads back every file it copies and
+compares its digest (using the hashlib algorithm named by
+pysysconf.verify_hash) with that of the source, in
+pysysconf.verify_threads background threads.
+
+Packages:
+
+check_rpm_installed(), check_rpm_not_installed(), and rpm_installed()
+query and change the installed packages through
+pysysconf.package_backend. If this is None, an rpm_package_db is used,
+which reads the rpm database once per run and uses yum to install and
+remove packages. A fake_package_db can be used to test policies.
+
+External commands:
+
+Commands run by shell_command(), including those run by the
+check_service_*, check_rpm_*, and check_selinux_bool() functions, can
+be limited to pysysconf.command_timeout seconds each, or to a time
+given with time_limit(). run_checks() runs checks in order of priority
+within an overall deadline, and reports those it had to defer.
+
+Profiling:
+
+profile_run() runs a policy under cProfile and reports the time (and
+optionally the memory) taken by each check_* call site, writing a
+pstats file and a collapsed-stack file for flame graphs. Setting the
+environment variable PYSYSCONF_PROFILE to an output prefix does the
+same for a whole policy script.
+
+Filesystems:
+
+check_copy(), check_link(), check_file_exists(), check_dir_exists(),
+and check_not_exists() reach the filesystem through
+pysysconf.filesystem, a filesystem_backend object. If this is None,
+the real filesystem is used. A prefixed_filesystem places both sources
+and destinations below a directory, and a memory_filesystem keeps
+everything in memory, so that these checks can be tested and their
+cost measured without disk I/O. The backup store, removal in the
+background, large file copies, and SELinux contexts need the real
+filesystem; in a memory_filesystem backups are made by renaming.
+
+Reporting:
+
+start_report() writes an event for every check_* call (the resource,
+the action taken, its state before and after, the time taken, the
+bytes copied, and any error) as JSON lines to a file, through a
+background thread. Setting the environment variable PYSYSCONF_REPORT
+to a filename does the same for a whole policy script. The keys of
+the events are listed under start_report().
+
 Exception handling:
 
 Internal functions (those starting with an underscore) may raise
@@ -41,14 +152,13 @@ exceptions fall through.
 
 ##############################################################################
 # imports
-import sys, socket, os, filecmp, datetime, stat, errno, pwd, grp, types, syslog
-
-_HAVE_SELINUX_MODULE = False
-try:
-    import selinux
-    _HAVE_SELINUX_MODULE = True
-except ImportError:
-    pass
+#
+# Importing this module is done on every run of every policy, so only
+# cheap modules are imported here. Others (selinux, hashlib, json,
+# gzip, tempfile, string, threading, Queue, sqlite3, multiprocessing,
+# cStringIO) are imported by the functions that need them.
+import sys, os, datetime, stat, errno, pwd, grp, syslog
+import heapq, array, thread, itertools, fcntl, time, contextlib, mmap, re
 
 ##############################################################################
 # logging
@@ -66,7 +176,7 @@ class PysysconfError(Exception):
 ##############################################################################
 # public functions
 
-def log(level, message):
+def log(level, message, *args):
     """Logs the message string to stdout and syslog, if the level is below
     that of the given verbosities.
 
@@ -77,77 +187,135 @@ def log(level, message):
     message : string
         Message to log.
 
+    args : any
+        (optional)
+        If given, the message is message % args, which is only formatted
+        if the message is logged.
+
     e.g. log an error:
     >>> log(LOG_ERROR, "An error occured!")
+
+    e.g. log an action without formatting it if actions are not logged:
+    >>> log(LOG_ACTION, "Copying %s to %s", src, dst)
     """
+    global _syslog_opened, _log_buffer_registered
+    if level == LOG_ERROR and _active_report != None:
+        _active_report.error(message, args)
+    if level > verbosity and level > syslog_verbosity:
+        return
+    if args:
+        message = message % args
     if level <= verbosity:
-        print message
+        if log_buffer_lines == None:
+            print message
+        else:
+            if not _log_buffer_registered:
+                import atexit
+                atexit.register(flush_log)
+                _log_buffer_registered = True
+            _log_buffer.append(message)
+            if len(_log_buffer) >= log_buffer_lines or level == LOG_ERROR:
+                flush_log()
     if level <= syslog_verbosity:
+        if not _syslog_opened:
+            syslog.openlog("pysysconf")
+            _syslog_opened = True
         syslog.syslog(syslog_priority | syslog_facility, message)
 
-def acquire_lock(lock_name):
-    """Acquires the lock referenced by the given filename by creating the
-    file lock_name. The parent directory of lock_name must already exist.
+def flush_log():
+    """Write out any messages held back by log_buffer_lines. This is
+    done automatically when the buffer fills, when an error is logged,
+    and at exit.
+    """
+    if _log_buffer:
+        sys.stdout.write("\n".join(_log_buffer) + "\n")
+        sys.stdout.flush()
+        del _log_buffer[:]
+
+def acquire_lock(lock_name, shared = False, timeout = 0):
+    """Acquires the lock referenced by the given filename, using an
+    advisory lock (flock) on the file lock_name, which is created if
+    necessary. The parent directory of lock_name must already exist.
+    The lock is released by release_lock(), or automatically by the
+    kernel if this process exits.
     
     lock_name : string
         Filename for the lock.
 
+    shared : boolean
+        (optional: default = False)
+        Whether to acquire a shared lock, which may be held by any
+        number of processes at once, rather than an exclusive lock.
+
+    timeout : number or None
+        (optional: default = 0)
+        Number of seconds to wait for the lock if it is already held.
+        If 0, return immediately. If None, wait indefinitely.
+
     return : boolean
         Returns True if the lock was successfully acquired,
         otherwise False.
 
     e.g. Lock a copy operation:
     >>> acquire_lock("/var/lock/pysysconf/copylock")
+
+    e.g. Wait up to a minute to run alongside other read-only audits:
+    >>> acquire_lock("/var/lock/pysysconf/policy", shared = True, timeout = 60)
     """
+    if lock_name in _lock_fds:
+        log(LOG_ERROR, "Error: lock " + lock_name + " is already held")
+        return False
+    if shared:
+        operation = fcntl.LOCK_SH
+    else:
+        operation = fcntl.LOCK_EX
     try:
-        # create a new file with exclusive access (fails if file
-        # already exists)
-        fd = os.open(lock_name, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0644)
-    except:
-        # Lockfile already exists, read out the PID from it. If the
-        # process that created the lockfile is still running, then we
-        # don't aquire the lock. If the process is not running, then
-        # we steal the lockfile.
-        try:
-            fd = open(lock_name)
-            pid = fd.read()
-            fd.close()
-            is_running = False
-            try:
-                # To check if the process with the given PID is still
-                # running, we try to get its session ID, which raises
-                # an exception if the process doesn't exist.
-                os.getsid(int(pid))
-                is_running = True
-            except:
-                pass
-            if is_running:
-                log(LOG_ERROR, "Error: unable to acquire lock "
-                    + lock_name)
-                return False
-            # The old process is not running, so steal its lockfile.
-            os.unlink(lock_name)
-            fd = os.open(lock_name, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0644)
-        except:
-            log(LOG_ERROR, "Error: unable to acquire lock "
-                + lock_name)
-            return False
-    # we've successfully created the lockfile, now write our PID into
-    # it
-    os.write(fd, str(os.getpid()))
-    try:
-        os.close(fd)
+        fd = os.open(lock_name, os.O_CREAT | os.O_RDWR, 0644)
     except EnvironmentError, e:
-        if e.filename == None:
-            log(LOG_ERROR, "Error: " + str(e))
+        log(LOG_ERROR, "Error: unable to acquire lock " + lock_name
+            + ": " + e.strerror)
+        return False
+    try:
+        # don't let commands run by shell_command() inherit the lock
+        fcntl.fcntl(fd, fcntl.F_SETFD,
+                    fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        if timeout == None:
+            fcntl.flock(fd, operation)
         else:
-            log(LOG_ERROR, "Error: " + e.filename + ": " + e.strerror)
+            deadline = time.time() + timeout
+            delay = 0.01
+            while True:
+                try:
+                    fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                    break
+                except IOError, e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        os.close(fd)
+                        log(LOG_ERROR, "Error: unable to acquire lock "
+                            + lock_name)
+                        return False
+                    time.sleep(min(delay, remaining))
+                    delay = min(delay * 2, 0.5)
+        if not shared:
+            # record our PID for the information of administrators
+            os.ftruncate(fd, 0)
+            os.write(fd, str(os.getpid()))
+    except EnvironmentError, e:
+        os.close(fd)
+        log(LOG_ERROR, "Error: unable to acquire lock " + lock_name
+            + ": " + str(e))
+        return False
+    _lock_fds[lock_name] = fd
     log(LOG_ACTION, "Acquired lock " + lock_name)
     return True
 
 def release_lock(lock_name):
-    """Releases a lock acquired by acquire_lock() by deleting the file
-    lock_name. An exception is thrown if the lock was not already acquired.
+    """Releases a lock acquired by acquire_lock(). An error is logged
+    if the lock was not already acquired. The file lock_name is left
+    in place for the next user of the lock.
 
     lock_name : string
         Filename for the lock.
@@ -155,19 +323,79 @@ def release_lock(lock_name):
     e.g. Unlock a copy operation:
     >>> release_lock("/var/lock/pysysconf/copylock")
     """
+    fd = _lock_fds.pop(lock_name, None)
+    if fd == None:
+        log(LOG_ERROR, "Error: lock " + lock_name + " is not held")
+        return
     try:
-        os.unlink(lock_name)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
     except EnvironmentError, e:
-        if e.filename == None:
-            log(LOG_ERROR, "Error: " + str(e))
-        else:
-            log(LOG_ERROR, "Error: " + e.filename + ": " + e.strerror)
+        log(LOG_ERROR, "Error: " + str(e))
     log(LOG_ACTION, "Released lock " + lock_name)
 
+@contextlib.contextmanager
+def locked(lock_name, shared = False, timeout = 0):
+    """Context manager that holds a lock, as for acquire_lock(), for the
+    duration of a with statement. Raises PysysconfError if the lock
+    could not be acquired.
+
+    lock_name : string
+        Filename for the lock.
+
+    shared : boolean
+        (optional: default = False)
+        Whether to acquire a shared lock.
+
+    timeout : number or None
+        (optional: default = 0)
+        Number of seconds to wait for the lock, or None to wait
+        indefinitely.
+
+    e.g. Run a policy, waiting up to five minutes for any other run:
+    >>> with locked("/var/lock/pysysconf/policy", timeout = 300):
+    ...     check_copy("main.cf.server", "/etc/sendmail/main.cf")
+    """
+    if not acquire_lock(lock_name, shared, timeout):
+        raise PysysconfError("unable to acquire lock " + lock_name)
+    try:
+        yield
+    finally:
+        release_lock(lock_name)
+
+@contextlib.contextmanager
+def time_limit(seconds):
+    """Context manager that limits the time that external commands run
+    by shell_command() (and so by the check_service_*, check_rpm_*,
+    and check_selinux_bool() functions) may take, for the duration of
+    a with statement. A command that would run past the limit is
+    killed, and the check running it logs an error. Limits may be
+    nested, and the earliest applies.
+
+    seconds : number
+        Number of seconds from now after which commands are killed.
+
+    e.g. Give up on a yum install that takes more than five minutes:
+    >>> with time_limit(300):
+    ...     check_rpm_installed("texlive")
+    """
+    global _command_deadline
+    outer_deadline = _command_deadline
+    deadline = time.time() + seconds
+    if outer_deadline != None and outer_deadline < deadline:
+        deadline = outer_deadline
+    _command_deadline = deadline
+    try:
+        yield
+    finally:
+        _command_deadline = outer_deadline
+
 def check_copy(src, dst, uid = None, gid = None,
                perm = None, umask = None, dmask = None, se_context = None,
                se_user = None, se_role = None, se_type = None,
-               se_level = None, backup = True, purge = False):
+               se_level = None, backup = True, purge = False,
+               hardlinks = False, include = None, exclude = None,
+               verify = False, spec = None):
     """Check the copy of a file, symlink, or directory.
 
     src : string
@@ -253,6 +481,44 @@ def check_copy(src, dst, uid = None, gid = None,
         Whether to delete files in dst (if it is a directory) if
         they are not present in src.
 
+    hardlinks : boolean
+        (optional: default = False)
+        Whether to preserve hard links between files within src (if
+        it is a directory), so that files that are hard-linked in
+        src are also hard-linked in dst. Each group of linked files
+        is only compared and copied once.
+
+    include : list of strings and compiled regexps, or None
+        (optional: default = None)
+        If not None and src is a directory, only copy (and purge)
+        non-directories matching one of these patterns. A string is
+        a glob, matched against the name of each entry if it has no
+        "/" and otherwise against its pathname relative to src. A
+        compiled regexp is searched for in the relative pathname.
+        Directories are always descended into unless excluded.
+
+    exclude : list of strings and compiled regexps, or None
+        (optional: default = None)
+        If not None and src is a directory, entries matching one of
+        these patterns (as for include) are neither copied nor
+        purged, and excluded directories are not descended into on
+        either side.
+
+    verify : boolean
+        (optional: default = False)
+        Whether to check each file that is copied by hashing it with
+        verify_hash once it has been written, using verify_threads
+        threads. Source digests are computed as the data is copied,
+        and files that were compared with verify_hash and found to
+        be the same are not read again. Mismatches are logged as
+        errors.
+
+    spec : stat_spec object or None
+        (optional: default = None)
+        Ownership, permissions, and SELinux context to use instead of
+        uid, gid, perm, umask, dmask, se_context, se_user, se_role,
+        se_type, and se_level, which must then all be None.
+
     return : boolean
 	Whether any change was made to dst.
 
@@ -261,26 +527,318 @@ def check_copy(src, dst, uid = None, gid = None,
 
     e.g. Check that a directory is an exact copy, without backup:
     >>> check_copy("ppds", "/etc/cups/ppds", purge = True, backup = False)
+
+    e.g. Mirror a directory, leaving local files and version control
+         metadata alone:
+    >>> check_copy("site", "/var/www/site", purge = True,
+    ...            exclude = [".git", "local/", re.compile(r"\.bak$")])
     """
     change_made = True
+    fs = _fs()
+    try:
+        dst = _root_path(dst)
+        spec = _stat_spec_arg(spec, uid, gid, perm, umask, dmask,
+                              se_context, se_user, se_role, se_type,
+                              se_level)
+        path_filter = None
+        if include != None or exclude != None:
+            path_filter = _path_filter(include, exclude)
+        if state_db != None:
+            resource = "copy:" + os.path.abspath(dst)
+            filter_key = None
+            if path_filter != None:
+                filter_key = path_filter.key()
+            inputs = _tree_fingerprint(src, repr((os.path.abspath(src),
+                spec.key(), purge, hardlinks, filter_key)))
+            if _state_unchanged(resource, inputs, dst):
+                log(LOG_NO_ACTION, dst + " is unchanged since it was last"
+                    " copied from " + src)
+                return False
+        verifier = None
+        if verify:
+            verifier = _copy_verifier(verify_hash, verify_threads)
+        try:
+            src_stat = fs.lstat(src)
+            src_mode = src_stat.st_mode
+            if stat.S_ISREG(src_mode):
+                change_made = _copy_file(src, dst, backup,
+                                         verifier = verifier,
+                                         src_stat = src_stat)
+            elif stat.S_ISLNK(src_mode):
+                change_made = _copy_file(src, dst, backup)
+            elif stat.S_ISDIR(src_mode):
+                if hardlinks:
+                    link_map = {}
+                else:
+                    link_map = None
+                options = _copy_options(spec, backup, purge, link_map,
+                                        path_filter, verifier)
+                with _log_aggregated(dst):
+                    change_made = _copy_dir(src, dst, options,
+                                            src_stat = src_stat)
+            else:
+                raise PysysconfError("src " + src + " is not" \
+                                  " a regular file, a symlink," \
+                                  " or a directory")
+        finally:
+            mismatches = []
+            if verifier != None:
+                mismatches = verifier.finish()
+        for message in mismatches:
+            log(LOG_ERROR, "Error: verification failed: " + message)
+        # a directory copy checks the attributes of dst itself
+        if not stat.S_ISDIR(src_mode):
+            change_made = _chkstatsrc(src, dst, spec, src_stat) \
+                or change_made
+        if state_db != None and not mismatches:
+            _state_record(resource, inputs, _tree_fingerprint(dst))
+    except EnvironmentError, e:
+        if e.filename == None:
+            log(LOG_ERROR, "Error: " + str(e))
+        else:
+            log(LOG_ERROR, "Error: " + e.filename + ": " + e.strerror)
+    except PysysconfError, e:
+        log(LOG_ERROR, "Error: " + str(e))
+    return change_made
+
+def check_template(src, dst, vars, uid = None, gid = None, perm = None,
+                   umask = None, se_context = None, se_user = None,
+                   se_role = None, se_type = None, se_level = None,
+                   backup = True, spec = None):
+    """Check that dst is a copy of the template file src, with
+    variables substituted as for string.Template. Rendered templates
+    are cached, so rendering the same template with the same variables
+    for several destinations only reads and renders it once.
+
+    src : string
+        Filename of the template. Placeholders are written as $name
+        or ${name}, and $$ is a literal $.
+
+    dst : string
+        Filename of the destination file.
+
+    vars : dictionary
+        Values of the variables used in the template.
+
+    uid, gid, perm, umask, se_context, se_user, se_role, se_type,
+    se_level, backup, spec :
+        (optional)
+        As for check_copy(). Permissions default to those of src,
+        masked by umask.
+
+    return : boolean
+	Whether any change was made to dst.
+
+    e.g. Generate a per-host configuration file:
+    >>> check_template("ntp.conf.in", "/etc/ntp.conf",
+    ...                {"server": "ntp1.example.com"})
+    """
+    change_made = False
+    try:
+        dst = _root_path(dst)
+        spec = _stat_spec_arg(spec, uid, gid, perm, umask, None,
+                              se_context, se_user, se_role, se_type,
+                              se_level)
+        (rendered, digest) = _render_template(src, vars)
+        need_write = True
+        try:
+            dst_stat = os.lstat(dst)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            dst_stat = None
+        if dst_stat != None and stat.S_ISREG(dst_stat.st_mode) \
+                and dst_stat.st_size == len(rendered) \
+                and _file_digest(dst) == digest:
+            need_write = False
+        if need_write:
+            change_made = True
+            if dst_stat != None and not stat.S_ISREG(dst_stat.st_mode):
+                _remove(dst, backup)
+                dst_stat = None
+            log(LOG_ACTION, "Rendering " + src + " to " + dst)
+            import tempfile
+            (fd, tmp_name) = tempfile.mkstemp(prefix = "."
+                                              + os.path.basename(dst) + ".",
+                                              dir = os.path.dirname(dst)
+                                              or ".")
+            try:
+                f = os.fdopen(fd, "wb")
+                try:
+                    f.write(rendered)
+                    f.flush()
+                    os.fsync(f.fileno())
+                finally:
+                    f.close()
+                _chkstatsrc(src, tmp_name, spec)
+                if dst_stat != None and backup:
+                    _backup_in_place(dst)
+                os.rename(tmp_name, dst)
+            except:
+                os.unlink(tmp_name)
+                raise
+        else:
+            log(LOG_NO_ACTION, dst + " is already rendered from " + src)
+            change_made = _chkstatsrc(src, dst, spec)
+    except EnvironmentError, e:
+        if e.filename == None:
+            log(LOG_ERROR, "Error: " + str(e))
+        else:
+            log(LOG_ERROR, "Error: " + e.filename + ": " + e.strerror)
+    except PysysconfError, e:
+        log(LOG_ERROR, "Error: " + str(e))
+    return change_made
+
+def check_line_in_file(dst, lines, backup = True):
+    """Check that the file dst contains each of the given lines,
+    appending any that are missing. The file is created if it does not
+    exist, and is otherwise rewritten atomically, keeping its
+    ownership, permissions, and SELinux context.
+
+    dst : string
+        Filename of the file to check.
+
+    lines : string or list of strings
+        Lines (without trailing newlines) that must be present.
+
+    backup : boolean
+	(optional: default = True)
+        Whether to backup dst if it will be changed.
+
+    return : boolean
+	Whether any change was made to dst.
+
+    e.g. Make sure the local NFS server is in /etc/hosts:
+    >>> check_line_in_file("/etc/hosts", "10.0.0.5 nfs.example.com nfs")
+    """
+    change_made = False
+    try:
+        dst = _root_path(dst)
+        if isinstance(lines, basestring):
+            lines = [lines]
+        missing = []
+        dst = _root_realpath(dst)
+        mm = _mmap_file(dst)
+        try:
+            for line in lines:
+                if line not in missing and not _mmap_has_line(mm, line):
+                    missing.append(line)
+        finally:
+            if mm != None:
+                mm.close()
+        if missing:
+            change_made = True
+            for line in missing:
+                log(LOG_ACTION, "Adding \"" + line + "\" to " + dst)
+            def append_lines(f_in, f_out):
+                last = ""
+                if f_in != None:
+                    while True:
+                        buf = f_in.read(65536)
+                        if not buf:
+                            break
+                        f_out.write(buf)
+                        last = buf[-1]
+                if last not in ("", "\n"):
+                    f_out.write("\n")
+                f_out.write("".join([line + "\n" for line in missing]))
+            _rewrite_file(dst, append_lines, backup)
+        else:
+            log(LOG_NO_ACTION, dst + " already contains the required lines")
+    except EnvironmentError, e:
+        if e.filename == None:
+            log(LOG_ERROR, "Error: " + str(e))
+        else:
+            log(LOG_ERROR, "Error: " + e.filename + ": " + e.strerror)
+    except PysysconfError, e:
+        log(LOG_ERROR, "Error: " + str(e))
+    return change_made
+
+def check_config_values(dst, values, separator = " = ", backup = True):
+    """Check that the configuration file dst sets each key to the given
+    value, in lines of the form <key><separator><value>. All lines
+    setting a key to a different value are replaced, and keys that
+    are not set are appended. Commented-out lines are left alone. All
+    changes are made in a single atomic rewrite, as for
+    check_line_in_file().
+
+    dst : string
+        Filename of the file to check.
+
+    values : dictionary
+        Mapping of keys to the values they must have.
+
+    separator : string
+	(optional: default = " = ")
+	Separator written between keys and values. Existing lines are
+	matched ignoring whitespace around the separator. If separator
+	is only whitespace, then keys and values are separated by any
+	amount of whitespace.
+
+    backup : boolean
+	(optional: default = True)
+        Whether to backup dst if it will be changed.
+
+    return : boolean
+	Whether any change was made to dst.
+
+    e.g. Enable IP forwarding and set the SSH port:
+    >>> check_config_values("/etc/sysctl.conf", {"net.ipv4.ip_forward": "1"})
+    >>> check_config_values("/etc/ssh/sshd_config", {"Port": "2222"},
+    ...                     separator = " ")
+    """
+    change_made = False
     try:
-        src_stat = os.lstat(src)
-        src_mode = src_stat.st_mode
-        if stat.S_ISREG(src_mode):
-            change_made = _copy_file(src, dst, backup)
-        elif stat.S_ISLNK(src_mode):
-            change_made = _copy_file(src, dst, backup)
-        elif stat.S_ISDIR(src_mode):
-            change_made = _copy_dir(src, dst, uid, gid, perm,
-                                    umask, dmask, se_context, se_user,
-                                    se_role, se_type, se_level, backup, purge)
+        dst = _root_path(dst)
+        if not values:
+            return change_made
+        desired = {}
+        for (key, value) in values.items():
+            desired[key] = key + separator + str(value)
+        keys = sorted(values.keys(), key = len, reverse = True)
+        if separator.strip():
+            sep_re = r"[ \t]*" + re.escape(separator.strip())
+        else:
+            sep_re = r"[ \t]"
+        key_re = re.compile(r"(?m)^[ \t]*(" + "|".join(map(re.escape, keys))
+                            + ")" + sep_re)
+        found = set()
+        wrong = set()
+        dst = _root_realpath(dst)
+        mm = _mmap_file(dst)
+        try:
+            if mm != None:
+                for m in key_re.finditer(mm):
+                    end = mm.find("\n", m.start())
+                    if end == -1:
+                        end = len(mm)
+                    found.add(m.group(1))
+                    if mm[m.start():end] != desired[m.group(1)]:
+                        wrong.add(m.group(1))
+        finally:
+            if mm != None:
+                mm.close()
+        missing = [key for key in keys if key not in found]
+        if wrong or missing:
+            change_made = True
+            for key in sorted(wrong) + sorted(missing):
+                log(LOG_ACTION, "Setting \"" + desired[key] + "\" in " + dst)
+            def edit_values(f_in, f_out):
+                last = ""
+                if f_in != None:
+                    for line in f_in:
+                        m = key_re.match(line)
+                        if m and m.group(1) in wrong:
+                            line = desired[m.group(1)] + "\n"
+                        f_out.write(line)
+                        last = line[-1]
+                if last not in ("", "\n"):
+                    f_out.write("\n")
+                missing.sort()
+                f_out.write("".join([desired[key] + "\n" for key in missing]))
+            _rewrite_file(dst, edit_values, backup)
         else:
-            raise PysysconfError("src " + src + " is not" \
-                              " a regular file, a symlink," \
-                              " or a directory")
-        change_made = _chkstatsrc(src, dst, uid, gid, perm, umask, dmask,
-                                  se_context, se_user, se_role, se_type, se_level) \
-			or change_made
+            log(LOG_NO_ACTION, dst + " already has the required values")
     except EnvironmentError, e:
         if e.filename == None:
             log(LOG_ERROR, "Error: " + str(e))
@@ -292,7 +850,7 @@ def check_copy(src, dst, uid = None, gid = None,
 
 def check_link(src, dst, uid = None, gid = None, se_context = None,
                se_user = None, se_role = None, se_type = None,
-               se_level = None, backup = True):
+               se_level = None, backup = True, spec = None):
     """Check that dst is a symlink to src.
 
     src : string
@@ -350,6 +908,12 @@ def check_link(src, dst, uid = None, gid = None, se_context = None,
         (optional: default = True)
         Whether to backup dst if it will be overwritten.
 
+    spec : stat_spec object or None
+        (optional: default = None)
+        Ownership and SELinux context to use instead of
+        uid, gid, se_context, se_user, se_role, se_type, and
+        se_level, which must then all be None.
+
     return : boolean
 	Whether any change was made to dst.
 
@@ -357,10 +921,14 @@ def check_link(src, dst, uid = None, gid = None, se_context = None,
     >>> check_link("/net/maildir", "/var/spool/mail")
     """
     change_made = False
+    fs = _fs()
     try:
+        dst = _root_path(dst)
+        spec = _stat_spec_arg(spec, uid, gid, None, None, None, se_context,
+                              se_user, se_role, se_type, se_level)
         dst_exists = True;
         try:
-            dst_stat = os.lstat(dst)
+            dst_stat = fs.lstat(dst)
             dst_mode = dst_stat.st_mode
         except OSError, e:
             if e.errno == errno.ENOENT:
@@ -370,18 +938,17 @@ def check_link(src, dst, uid = None, gid = None, se_context = None,
         need_link = True
         if dst_exists:
             if stat.S_ISLNK(dst_mode):
-                if os.readlink(dst) == src:
+                if fs.readlink(dst) == src:
                     need_link = False
         if need_link:
 	    change_made = True
             if dst_exists:
                 _remove(dst, backup)
             log(LOG_ACTION, "Symlinking " + dst + " to " + src)
-            os.symlink(src, dst)
+            fs.symlink(src, dst)
         else:
             log(LOG_NO_ACTION, dst + " is already symlinked to " + src)
-        change_made = _chkstat(dst, uid, gid, None, se_context,
-                               se_user, se_role, se_type, se_level) \
+        change_made = _chkstat(dst, spec.uid, spec.gid, None, spec) \
                          or change_made
     except EnvironmentError, e:
         if e.filename == None:
@@ -394,7 +961,8 @@ def check_link(src, dst, uid = None, gid = None, se_context = None,
 
 def check_file_exists(dst, uid = None, gid = None, perm = None,
                       se_context = None, se_user = None, se_role = None,
-                      se_type = None, se_level = None, backup = True):
+                      se_type = None, se_level = None, backup = True,
+                      spec = None):
     """Check that the file named dst exists and has the specified
     ownership and permissions. The path to dst must already exist.
 
@@ -457,6 +1025,12 @@ def check_file_exists(dst, uid = None, gid = None, perm = None,
 	(optional: default = True)
         Whether to backup dst if it will be replaced.
 
+    spec : stat_spec object or None
+        (optional: default = None)
+        Ownership, permissions, and SELinux context to use instead of
+        uid, gid, perm, se_context, se_user, se_role, se_type,
+        and se_level, which must then all be None.
+
     return : boolean
 	Whether any change was made to dst.
 
@@ -464,10 +1038,14 @@ def check_file_exists(dst, uid = None, gid = None, perm = None,
     >>> check_file_exists("/etc/nologin", uid = "root")
     """
     change_made = False
+    fs = _fs()
     try:
+        dst = _root_path(dst)
+        spec = _stat_spec_arg(spec, uid, gid, perm, None, None, se_context,
+                              se_user, se_role, se_type, se_level)
         dst_exists = True;
 	try:
-            dst_stat = os.lstat(dst)
+            dst_stat = fs.lstat(dst)
             dst_mode = dst_stat.st_mode
         except OSError, e:
             if e.errno == errno.ENOENT:
@@ -483,13 +1061,13 @@ def check_file_exists(dst, uid = None, gid = None, perm = None,
             if dst_exists:
                 _remove(dst, backup)
             log(LOG_ACTION, "Creating file " + dst)
-            fd = os.open(dst, os.O_CREAT)
-	    os.close(fd)
+            fs.create(dst)
         else:
             log(LOG_NO_ACTION, "File " + dst + " already exists")
-        change_made = _chkstat(dst, uid, gid, perm, se_context,
-                               se_user, se_role, se_type, se_level) \
-                         or change_made
+        if need_create:
+            dst_stat = None
+        change_made = _chkstat(dst, spec.uid, spec.gid, spec.perm, spec,
+                               dst_stat) or change_made
     except EnvironmentError, e:
         if e.filename == None:
             log(LOG_ERROR, "Error: " + str(e))
@@ -501,7 +1079,8 @@ def check_file_exists(dst, uid = None, gid = None, perm = None,
 
 def check_dir_exists(dst, uid = None, gid = None, perm = None,
                      se_context = None, se_user = None, se_role = None,
-                     se_type = None, se_level = None, backup = True):
+                     se_type = None, se_level = None, backup = True,
+                     spec = None):
     """Check that the directory named dst exists and has the specified
     ownership and permissions. The path to dst must already exist.
 
@@ -564,6 +1143,12 @@ def check_dir_exists(dst, uid = None, gid = None, perm = None,
 	(optional: default = True)
         Whether to backup dst if it will be replaced.
 
+    spec : stat_spec object or None
+        (optional: default = None)
+        Ownership, permissions, and SELinux context to use instead of
+        uid, gid, perm, se_context, se_user, se_role, se_type,
+        and se_level, which must then all be None.
+
     return : boolean
 	Whether any change was made to dst.
 
@@ -571,10 +1156,14 @@ def check_dir_exists(dst, uid = None, gid = None, perm = None,
     >>> check_dir_exists("/var/pysysconf")
     """
     change_made = False
+    fs = _fs()
     try:
+        dst = _root_path(dst)
+        spec = _stat_spec_arg(spec, uid, gid, perm, None, None, se_context,
+                              se_user, se_role, se_type, se_level)
         dst_exists = True;
 	try:
-            dst_stat = os.lstat(dst)
+            dst_stat = fs.lstat(dst)
             dst_mode = dst_stat.st_mode
         except OSError, e:
             if e.errno == errno.ENOENT:
@@ -590,12 +1179,13 @@ def check_dir_exists(dst, uid = None, gid = None, perm = None,
             if dst_exists:
                 _remove(dst, backup)
             log(LOG_ACTION, "Creating directory " + dst)
-	    os.mkdir(dst, 0700)
+	    fs.mkdir(dst, 0700)
         else:
             log(LOG_NO_ACTION, "Directory " + dst + " already exists")
-        change_made = _chkstat(dst, uid, gid, perm, se_context,
-                               se_user, se_role, se_type, se_level) \
-                         or change_made
+        if need_create:
+            dst_stat = None
+        change_made = _chkstat(dst, spec.uid, spec.gid, spec.perm, spec,
+                               dst_stat) or change_made
     except EnvironmentError, e:
         if e.filename == None:
             log(LOG_ERROR, "Error: " + str(e))
@@ -605,7 +1195,8 @@ def check_dir_exists(dst, uid = None, gid = None, perm = None,
         log(LOG_ERROR, "Error: " + str(e))
     return change_made
 
-def check_not_exists(dst, test = None, follow_links = False, backup = False):
+def check_not_exists(dst, test = None, follow_links = False, backup = False,
+                     keep_at_least = None, include = None, exclude = None):
     """Delete dst, or files in dst that satisfy test.
 
     dst : string
@@ -626,9 +1217,40 @@ def check_not_exists(dst, test = None, follow_links = False, backup = False):
 	Whether to rename objects to <filename>.<isodate> rather than
 	deleting them.
 
+    keep_at_least : integer or None
+	(optional: default = None)
+	If not None, never remove objects from a directory if this
+	would leave it with fewer than keep_at_least entries. Objects
+	satisfying test are removed oldest-first, with the age taken
+	from the age_type of test (or mtime if test has none). Requires
+	test to be given.
+
+    include : list of strings and compiled regexps, or None
+	(optional: default = None)
+	If not None, only remove non-directories matching one of these
+	patterns, as for check_copy(). Directories are still descended
+	into, and a directory satisfying test is only removed if it is
+	empty once its contents have been removed. Requires test to be
+	given.
+
+    exclude : list of strings and compiled regexps, or None
+	(optional: default = None)
+	If not None, never remove or descend into objects matching one
+	of these patterns, as for check_copy(). Excluded objects are
+	not stat'ed or tested. Requires test to be given.
+
     return : boolean
 	Whether any change was made to dst.
 
+    If pysysconf.expiry_index is True and test has an expiry() method
+    (as test_age does), then unless follow_links is True, the time
+    each directory below dst is next due to have an entry removed is
+    recorded in pysysconf.state_db, and later runs do not list or
+    stat the entries of directories that are unchanged and have
+    nothing due. Only the creation, removal, and renaming of entries
+    is noticed, so an entry whose time is set back (with touch -d,
+    for example) is not removed until its directory changes.
+
     e.g. Ensure /etc/nologin does not exist:
     >>> check_not_exists("/etc/nologin")
 
@@ -642,13 +1264,28 @@ def check_not_exists(dst, test = None, follow_links = False, backup = False):
     e.g. Ensure all backup files older than one week do not exist:
     >>> test_one_week = test_age(age = datetime.timedelta(days = 7))
     >>> check_not_exists("/backups", test = test_one_week)
+
+    e.g. As above, but always keep the ten newest backups:
+    >>> check_not_exists("/backups", test = test_one_week, keep_at_least = 10)
+
+    e.g. Empty /var/tmp, but leave the systemd private directories alone:
+    >>> check_not_exists("/var/tmp", test = test_true(),
+    ...                  exclude = ["systemd-private-*"])
     """
     change_made = False
+    fs = _fs()
     try:
+        dst = _root_path(dst)
 	if test == None:
+            if keep_at_least != None:
+                raise PysysconfError("keep_at_least can only be used"
+                                     " together with a test")
+            if include != None or exclude != None:
+                raise PysysconfError("include and exclude can only be"
+                                     " used together with a test")
 	    dst_exists = True;
     	    try:
-        	dst_stat = os.lstat(dst)
+        	dst_stat = fs.lstat(dst)
       	    except OSError, e:
         	if e.errno == errno.ENOENT:
             	    dst_exists = False
@@ -661,7 +1298,25 @@ def check_not_exists(dst, test = None, follow_links = False, backup = False):
             else:
                 log(LOG_NO_ACTION, dst + " already did not exist")
 	else:
-	    change_made = _remove_by_test(dst, test, follow_links, backup)
+            path_filter = None
+            if include != None or exclude != None:
+                path_filter = _path_filter(include, exclude)
+            index = None
+            if expiry_index and hasattr(test, "expiry") \
+                    and not follow_links:
+                if state_db == None:
+                    raise PysysconfError("expiry_index requires state_db"
+                                         " to be set")
+                filter_key = None
+                if path_filter != None:
+                    filter_key = path_filter.key()
+                index = _expiry_index(repr((test.key(), filter_key)))
+            with _log_aggregated(dst):
+                change_made = _remove_by_test(dst, test, follow_links,
+                                              backup, keep_at_least,
+                                              path_filter, index = index)
+            if index != None:
+                index.commit()
             if not change_made:
                 log(LOG_NO_ACTION, dst + " did not have any removals")
     except EnvironmentError, e:
@@ -673,20 +1328,200 @@ def check_not_exists(dst, test = None, follow_links = False, backup = False):
         log(LOG_ERROR, "Error: " + str(e))
     return change_made
 
-def shell_command(command):
+def check_dir_size_limit(dst, max_bytes, order = "oldest",
+                         age_type = "mtime", backup = False):
+    """Delete files in the directory dst until the total size of all
+    files within it is no more than max_bytes.
+
+    dst : string
+	Directory to limit the size of. Subdirectories are included in
+	the total, but are not themselves removed.
+
+    max_bytes : integer
+	Maximum total size (in bytes) of all files within dst.
+
+    order : string
+	(optional: default = "oldest")
+	Which files to delete first. Either "oldest" (by age_type) or
+	"largest".
+
+    age_type : string
+	(optional: default = "mtime")
+	Which time to use for order = "oldest". One of "mtime",
+	"atime", or "ctime".
+
+    backup : boolean
+	(optional: default = False)
+	Whether to save files to the backup store rather than deleting
+	them. Requires backup_dir to be set, as backups renamed within
+	dst would not reduce its size; otherwise an error is logged
+	and nothing is removed.
+
+    return : boolean
+	Whether any change was made to dst.
+
+    e.g. Keep the print spool below 2 GB, deleting the oldest jobs first:
+    >>> check_dir_size_limit("/var/spool/cups", 2 * 1024**3)
+    """
+    change_made = False
+    try:
+        dst = _root_path(dst)
+        if order not in ("oldest", "largest"):
+            raise PysysconfError("Unknown order " + str(order))
+        if backup and (backup_dir == None
+                       or _fs().native_path(dst) == None):
+            raise PysysconfError("cannot limit the size of " + dst
+                                 + " with backup unless backup_dir is set")
+        snapshot = _dir_snapshot(dst, age_type)
+        total = sum(snapshot.sizes)
+        if total <= max_bytes:
+            log(LOG_NO_ACTION, "%s is already within %d bytes (%d bytes used)"
+                % (dst, max_bytes, total))
+        else:
+            if order == "oldest":
+                key = snapshot.times.__getitem__
+            else:
+                key = lambda i: -snapshot.sizes[i]
+            with _log_aggregated(dst):
+                for i in sorted(xrange(len(snapshot.sizes)), key = key):
+                    if total <= max_bytes:
+                        break
+                    f_name = snapshot.path(i)
+                    _remove(f_name, backup)
+                    change_made = True
+                    total = total - snapshot.sizes[i]
+                    _log_item(LOG_ACTION, "removed", "%s removed", f_name)
+            if total > max_bytes:
+                log(LOG_ERROR, "Error: %s still uses %d bytes, more than %d"
+                    % (dst, total, max_bytes))
+    except EnvironmentError, e:
+        if e.filename == None:
+            log(LOG_ERROR, "Error: " + str(e))
+        else:
+            log(LOG_ERROR, "Error: " + e.filename + ": " + e.strerror)
+    except PysysconfError, e:
+        log(LOG_ERROR, "Error: " + str(e))
+    return change_made
+
+def wait_for_removals():
+    """Wait until all directories queued for background removal have
+    been deleted. Does nothing if pysysconf.remove_in_background has
+    not been used.
+
+    e.g. Make sure the old cache is really gone before continuing:
+    >>> check_not_exists("/var/cache/foo")
+    >>> wait_for_removals()
+    """
+    if _reap_queue != None:
+        _reap_queue.join()
+
+def check_backups_pruned(max_count = None, max_age = None):
+    """Delete old backups from the backup store in pysysconf.backup_dir,
+    together with any stored content that is no longer needed.
+
+    max_count : integer or None
+	(optional: default = None)
+	Maximum number of backups to keep for each filename. If None,
+	then there is no limit.
+
+    max_age : datetime.timedelta or None
+	(optional: default = None)
+	Maximum age of backups to keep. If None, then there is no limit.
+
+    return : boolean
+	Whether any backups were deleted.
+
+    e.g. Keep only the last five backups of each file, for at most 30 days:
+    >>> check_backups_pruned(max_count = 5,
+    ...                      max_age = datetime.timedelta(days = 30))
+    """
+    change_made = False
+    try:
+        if backup_dir == None:
+            raise PysysconfError("No backup_dir has been set")
+        index_name = os.path.join(backup_dir, "index")
+        if not os.path.exists(index_name):
+            log(LOG_NO_ACTION, "Backup store " + backup_dir + " is empty")
+            return change_made
+        with _backup_lock():
+            import json
+            entries = [json.loads(line) for line in open(index_name)]
+            if max_age != None:
+                oldest = (datetime.datetime.now() - max_age).isoformat()
+            counts = {}
+            kept = []
+            for entry in reversed(entries):
+                counts[entry["path"]] = counts.get(entry["path"], 0) + 1
+                if max_count != None and counts[entry["path"]] > max_count:
+                    continue
+                if max_age != None and entry["time"] < oldest:
+                    continue
+                kept.append(entry)
+            kept.reverse()
+            if len(kept) == len(entries):
+                log(LOG_NO_ACTION, "Backup store " + backup_dir
+                    + " did not have any removals")
+                return change_made
+            change_made = True
+            tmp_name = index_name + ".tmp"
+            f = open(tmp_name, "w")
+            try:
+                for entry in kept:
+                    f.write(json.dumps(entry) + "\n")
+            finally:
+                f.close()
+            os.rename(tmp_name, index_name)
+            log(LOG_ACTION, "Pruned %d backups from %s"
+                % (len(entries) - len(kept), backup_dir))
+            needed = set([entry["object"] for entry in kept
+                          if entry["type"] == "file"])
+            objects_dir = os.path.join(backup_dir, "objects")
+            for d in os.listdir(objects_dir):
+                for f in os.listdir(os.path.join(objects_dir, d)):
+                    if f.split(".")[0] not in needed:
+                        os.unlink(os.path.join(objects_dir, d, f))
+    except EnvironmentError, e:
+        if e.filename == None:
+            log(LOG_ERROR, "Error: " + str(e))
+        else:
+            log(LOG_ERROR, "Error: " + e.filename + ": " + e.strerror)
+    except PysysconfError, e:
+        log(LOG_ERROR, "Error: " + str(e))
+    return change_made
+
+def shell_command(command, timeout = None):
     """Run an external command in a shell.
 
     command : string
         Commandline to run. Will be passed to a subshell.
 
+    timeout : number or None
+        (optional: default = None)
+        Maximum number of seconds to let the command run. The
+        command is also limited by command_timeout and by any
+        enclosing time_limit() or run_checks() deadline. If the
+        command runs for too long, it and any processes it started
+        are killed, an error is logged, and the status of the killed
+        command is returned.
+
     return : integer
-        Returns the exit status of the command.
+        Returns the exit status of the command, as for os.system().
 
     e.g. Restart apache:
     >>> shell_command("/sbin/service httpd restart")
+
+    e.g. Rebuild the locate database, giving up after ten minutes:
+    >>> shell_command("/usr/bin/updatedb", timeout = 600)
     """
     log(LOG_ACTION, "Running \"" + command + "\"")
-    return os.system(command)
+    deadline = _command_deadline
+    for limit in (timeout, command_timeout):
+        if limit != None and (deadline == None
+                              or time.time() + limit < deadline):
+            deadline = time.time() + limit
+    if deadline == None:
+        return os.system(command)
+    return _run_with_deadline(command, deadline)
 
 def service_exists(service_name):
     """Test if the service is installed.
@@ -731,53 +1566,61 @@ def check_service_enabled(service_name, needs_restart = False,
     >>> check_service_enabled("httpd")
     """
     change_made = False
-    if not service_exists(service_name):
-        log(LOG_ERROR, "service %s is not installed" % service_name)
-        return change_made
-    if dist_version < 17:
-        if shell_command("/sbin/service " + service_name + " status > /dev/null"):
-            change_made = True
-            log(LOG_ACTION, "Starting " + service_name)
-            shell_command("/sbin/service " + service_name + " start")
-        else:
-            log(LOG_NO_ACTION, service_name + " is already running")
-            if needs_restart:
+    try:
+        if not service_exists(service_name):
+            log(LOG_ERROR, "service %s is not installed" % service_name)
+            return change_made
+        if dist_version < 17:
+            if shell_command("/sbin/service " + service_name + " status > /dev/null"):
                 change_made = True
-                log(LOG_ACTION, "Restarting " + service_name)
-                shell_command("/sbin/service " + service_name + " restart")
+                log(LOG_ACTION, "Starting " + service_name)
+                shell_command("/sbin/service " + service_name + " start")
             else:
-                if needs_reload:
+                log(LOG_NO_ACTION, service_name + " is already running")
+                if needs_restart:
                     change_made = True
-                    log(LOG_ACTION, "Reloading " + service_name)
-                    shell_command("/sbin/service " + service_name + " reload")
-        if shell_command("/sbin/chkconfig --list " + service_name \
-                             + " | grep -q \":on\""):
-            change_made = True
-            log(LOG_ACTION, "Turning on " + service_name)
-            shell_command("/sbin/chkconfig " + service_name + " on")
-        else:
-            log(LOG_NO_ACTION, service_name + " is already on")
-    else:
-        if shell_command("/bin/systemctl --quiet is-active " + service_name + ".service"):
-            change_made = True
-            log(LOG_ACTION, "Starting " + service_name)
-            shell_command("/bin/systemctl start " + service_name + ".service")
+                    log(LOG_ACTION, "Restarting " + service_name)
+                    shell_command("/sbin/service " + service_name + " restart")
+                else:
+                    if needs_reload:
+                        change_made = True
+                        log(LOG_ACTION, "Reloading " + service_name)
+                        shell_command("/sbin/service " + service_name + " reload")
+            if shell_command("/sbin/chkconfig --list " + service_name \
+                                 + " | grep -q \":on\""):
+                change_made = True
+                log(LOG_ACTION, "Turning on " + service_name)
+                shell_command("/sbin/chkconfig " + service_name + " on")
+            else:
+                log(LOG_NO_ACTION, service_name + " is already on")
         else:
-            log(LOG_NO_ACTION, service_name + " is already running")
-            if needs_restart:
+            if shell_command("/bin/systemctl --quiet is-active " + service_name + ".service"):
                 change_made = True
-                log(LOG_ACTION, "Restarting " + service_name)
-                shell_command("/bin/systemctl restart " + service_name + ".service")
-            elif needs_reload:
+                log(LOG_ACTION, "Starting " + service_name)
+                shell_command("/bin/systemctl start " + service_name + ".service")
+            else:
+                log(LOG_NO_ACTION, service_name + " is already running")
+                if needs_restart:
+                    change_made = True
+                    log(LOG_ACTION, "Restarting " + service_name)
+                    shell_command("/bin/systemctl restart " + service_name + ".service")
+                elif needs_reload:
+                    change_made = True
+                    log(LOG_ACTION, "Reloading " + service_name)
+                    shell_command("/bin/systemctl reload-or-restart " + service_name + ".service")
+            if shell_command("/bin/systemctl --quiet is-enabled " + service_name + ".service"):
                 change_made = True
-                log(LOG_ACTION, "Reloading " + service_name)
-                shell_command("/bin/systemctl reload-or-restart " + service_name + ".service")
-        if shell_command("/bin/systemctl --quiet is-enabled " + service_name + ".service"):
-            change_made = True
-            log(LOG_ACTION, "Enabling " + service_name)
-            shell_command("/bin/systemctl enable " + service_name + ".service")
+                log(LOG_ACTION, "Enabling " + service_name)
+                shell_command("/bin/systemctl enable " + service_name + ".service")
+            else:
+                log(LOG_NO_ACTION, service_name + " is already enabled")
+    except EnvironmentError, e:
+        if e.filename == None:
+            log(LOG_ERROR, "Error: " + str(e))
         else:
-            log(LOG_NO_ACTION, service_name + " is already enabled")
+            log(LOG_ERROR, "Error: " + e.filename + ": " + e.strerror)
+    except PysysconfError, e:
+        log(LOG_ERROR, "Error: " + str(e))
     return change_made
 
 def check_service_disabled(service_name):
@@ -794,39 +1637,47 @@ def check_service_disabled(service_name):
     >>> check_service_disabled("httpd")
     """
     change_made = False
-    if not service_exists(service_name):
-        log(LOG_NO_ACTION,
-            "service %s is not installed, so is already disabled"
-            % service_name)
-        return change_made
-    if dist_version < 17:
-        if not shell_command("/sbin/service " + service_name + " status"
-                             + " > /dev/null"):
-            change_made = True
-            log(LOG_ACTION, "Stopping " + service_name);
-            shell_command("/sbin/service " + service_name + " stop")
-        else:
-            log(LOG_NO_ACTION, service_name + " is already stopped")
-        if not shell_command("/sbin/chkconfig --list " + service_name \
-                             + " | grep -q \":on\""):
-            change_made = True
-            log(LOG_ACTION, "Turning off " + service_name);
-            shell_command("/sbin/chkconfig " + service_name + " off")
-        else:
-            log(LOG_NO_ACTION, service_name + " is already off")
-    else:
-        if not shell_command("/bin/systemctl --quiet is-active " + service_name + ".service"):
-            change_made = True
-            log(LOG_ACTION, "Stopping " + service_name);
-            shell_command("/bin/systemctl stop " + service_name + ".service")
+    try:
+        if not service_exists(service_name):
+            log(LOG_NO_ACTION,
+                "service %s is not installed, so is already disabled"
+                % service_name)
+            return change_made
+        if dist_version < 17:
+            if not shell_command("/sbin/service " + service_name + " status"
+                                 + " > /dev/null"):
+                change_made = True
+                log(LOG_ACTION, "Stopping " + service_name);
+                shell_command("/sbin/service " + service_name + " stop")
+            else:
+                log(LOG_NO_ACTION, service_name + " is already stopped")
+            if not shell_command("/sbin/chkconfig --list " + service_name \
+                                 + " | grep -q \":on\""):
+                change_made = True
+                log(LOG_ACTION, "Turning off " + service_name);
+                shell_command("/sbin/chkconfig " + service_name + " off")
+            else:
+                log(LOG_NO_ACTION, service_name + " is already off")
         else:
-            log(LOG_NO_ACTION, service_name + " is already stopped")
-        if not shell_command("/bin/systemctl --quiet is-enabled " + service_name + ".service"):
-            change_made = True
-            log(LOG_ACTION, "Enabling " + service_name);
-            shell_command("/bin/systemctl disable " + service_name + ".service")
+            if not shell_command("/bin/systemctl --quiet is-active " + service_name + ".service"):
+                change_made = True
+                log(LOG_ACTION, "Stopping " + service_name);
+                shell_command("/bin/systemctl stop " + service_name + ".service")
+            else:
+                log(LOG_NO_ACTION, service_name + " is already stopped")
+            if not shell_command("/bin/systemctl --quiet is-enabled " + service_name + ".service"):
+                change_made = True
+                log(LOG_ACTION, "Enabling " + service_name);
+                shell_command("/bin/systemctl disable " + service_name + ".service")
+            else:
+                log(LOG_NO_ACTION, service_name + " is already disabled")
+    except EnvironmentError, e:
+        if e.filename == None:
+            log(LOG_ERROR, "Error: " + str(e))
         else:
-            log(LOG_NO_ACTION, service_name + " is already disabled")
+            log(LOG_ERROR, "Error: " + e.filename + ": " + e.strerror)
+    except PysysconfError, e:
+        log(LOG_ERROR, "Error: " + str(e))
     return change_made
 
 def check_service_status(service_name, should_be_running,
@@ -862,35 +1713,101 @@ def check_service_status(service_name, should_be_running,
         change_made = check_service_disabled(service_name)
     return change_made
 
+def rpm_installed(rpm_name):
+    """Test if an installed package satisfies rpm_name.
+
+    rpm_name : string
+        Package name, optionally followed by a version constraint as
+        for check_rpm_installed().
+
+    return : boolean
+        Whether a matching package is installed, according to the
+        package backend. Errors are logged and give False.
+
+    e.g. Only configure matlab where a recent version is installed:
+    >>> if rpm_installed("matlab >= 2012a"):
+    >>>     check_copy("license.dat", "/usr/local/matlab/license.dat")
+    """
+    try:
+        (name, op, evr) = _parse_rpm_spec(rpm_name)
+        return _rpm_spec_installed(_package_backend(), name, op, evr)
+    except EnvironmentError, e:
+        if e.filename == None:
+            log(LOG_ERROR, "Error: " + str(e))
+        else:
+            log(LOG_ERROR, "Error: " + e.filename + ": " + e.strerror)
+    except PysysconfError, e:
+        log(LOG_ERROR, "Error: " + str(e))
+    return False
+
 def check_rpm_installed(rpm_name):
     """Ensure that the given rpm is installed, using yum for installation.
 
     rpm_name : string
-        Name of rpm to install.
+        Name of rpm to install, which may include a version, release,
+        and architecture as for "rpm -q" (such as "glibc.i686" or
+        "httpd-2.4.3-1.fc17"), optionally followed by a version
+        constraint "<op> [epoch:]version[-release]", where <op> is
+        one of <, <=, =, >=, or >. Versions are compared as rpm does,
+        and the release is only compared if it is given. If no
+        installed version satisfies the constraint, then "=" installs
+        exactly that version, ">" and ">=" update to the latest
+        version, and "<" and "<=" are reported as an error.
 
     return : boolean
 	Whether the rpm had to be installed.
 
+    Presence is tested with the package backend (see package_backend),
+    which by default reads the whole installed package set once and
+    answers later queries from memory.
+
     e.g. make sure the latest version of matlab is installed:
     >>> check_rpm_installed("matlab")
+
+    e.g. make sure openssl is at least a fixed version:
+    >>> check_rpm_installed("openssl >= 1.0.0j-1")
     """
     change_made = False
-    if shell_command("/bin/rpm -q " + rpm_name + " > /dev/null"):
+    try:
+        (name, op, evr) = _parse_rpm_spec(rpm_name)
+        backend = _package_backend()
+        if _rpm_spec_installed(backend, name, op, evr):
+            log(LOG_NO_ACTION, rpm_name + " is already installed")
+            return change_made
+        (base_name, arch) = _resolve_rpm_name(backend, name)[:2]
+        if op in ("<", "<=") and backend.installed(base_name, arch):
+            raise PysysconfError("cannot install " + rpm_name + " because"
+                                 " a newer version is installed")
+        if op in ("<", "<="):
+            raise PysysconfError("cannot install " + rpm_name + " because"
+                                 " no exact version is given (use \"=\")")
         change_made = True
         log(LOG_ACTION, "Installing " + rpm_name)
-        if shell_command("/usr/bin/yum -e 0 -d 0 -y install " + rpm_name):
-            log(LOG_ERROR, "Error installing " + rpm_name)
+        if op == "=":
+            installed = backend.install(name, evr)
         else:
+            installed = backend.install(name)
+        if installed and _rpm_spec_installed(backend, name, op, evr):
             log(LOG_ACTION, "Successfully installed " + rpm_name)
-    else:
-        log(LOG_NO_ACTION, rpm_name + " is already installed")
+        else:
+            log(LOG_ERROR, "Error installing " + rpm_name)
+    except EnvironmentError, e:
+        if e.filename == None:
+            log(LOG_ERROR, "Error: " + str(e))
+        else:
+            log(LOG_ERROR, "Error: " + e.filename + ": " + e.strerror)
+    except PysysconfError, e:
+        log(LOG_ERROR, "Error: " + str(e))
     return change_made
 
 def check_rpm_not_installed(rpm_name):
     """Ensure that the given rpm is not installed, using yum for removal.
 
     rpm_name : string
-        Name of rpm to remove.
+        Name of rpm to remove, in any of the forms accepted by
+        check_rpm_installed(), optionally followed by a version
+        constraint. If a version is given, only the installed
+        versions that match it are removed.
 
     return : boolean
 	Whether the rpm had to be removed.
@@ -899,15 +1816,37 @@ def check_rpm_not_installed(rpm_name):
     >>> check_rpm_not_installed("matlab")
     """
     change_made = False
-    if not shell_command("/bin/rpm -q " + rpm_name + " > /dev/null"):
+    try:
+        (name, op, evr) = _parse_rpm_spec(rpm_name)
+        backend = _package_backend()
+        if not _rpm_spec_installed(backend, name, op, evr):
+            log(LOG_NO_ACTION, rpm_name + " is already not installed")
+            return change_made
         change_made = True
         log(LOG_ACTION, "Removing " + rpm_name)
-        if shell_command("/usr/bin/yum -e 0 -d 0 -y remove " + rpm_name):
-            log(LOG_ERROR, "Error removing " + rpm_name)
+        (base_name, arch, name_evr) = _resolve_rpm_name(backend, name)
+        if op == None and name_evr == None:
+            targets = [name]
         else:
+            targets = [_rpm_target(base_name, inst_evr, arch)
+                       for inst_evr in backend.installed(base_name, arch)
+                       if (name_evr == None
+                           or _rpm_matches([inst_evr], "=", name_evr))
+                       and _rpm_matches([inst_evr], op, evr)]
+        removed = True
+        for target in targets:
+            removed = backend.remove(target) and removed
+        if removed and not _rpm_spec_installed(backend, name, op, evr):
             log(LOG_ACTION, "Successfully removed " + rpm_name)
-    else:
-        log(LOG_NO_ACTION, rpm_name + " is already not installed")
+        else:
+            log(LOG_ERROR, "Error removing " + rpm_name)
+    except EnvironmentError, e:
+        if e.filename == None:
+            log(LOG_ERROR, "Error: " + str(e))
+        else:
+            log(LOG_ERROR, "Error: " + e.filename + ": " + e.strerror)
+    except PysysconfError, e:
+        log(LOG_ERROR, "Error: " + str(e))
     return change_made
 
 def check_selinux_bool(bool_name, bool_value):
@@ -925,33 +1864,525 @@ def check_selinux_bool(bool_name, bool_value):
     e.g. make sure the webserver can access user home directories:
     >>> check_sebool("httpd_enable_homedirs", True)
     """
-    if not selinux.is_selinux_enabled():
+    selinux = _selinux()
+    if selinux == None or not selinux.is_selinux_enabled():
         log(LOG_NO_ACTION, "Not testing SELinux boolean %s as SELinux is not enabled"
             % bool_name)
         return False
     change_made = False
-    if bool_value == True:
-        if shell_command("/usr/sbin/getsebool %s | grep -q \"%s --> on\""
-                         % (bool_name, bool_name)):
-            change_made = True
-            log(LOG_ACTION, "Setting SELinux boolean %s to on" % bool_name)
-            shell_command("/usr/sbin/setsebool -P %s 1" % bool_name)
+    try:
+        if bool_value == True:
+            if shell_command("/usr/sbin/getsebool %s | grep -q \"%s --> on\""
+                             % (bool_name, bool_name)):
+                change_made = True
+                log(LOG_ACTION, "Setting SELinux boolean %s to on" % bool_name)
+                shell_command("/usr/sbin/setsebool -P %s 1" % bool_name)
+            else:
+                log(LOG_NO_ACTION, "SELinux boolean %s already set to on" % bool_name)
         else:
-            log(LOG_NO_ACTION, "SELinux boolean %s already set to on" % bool_name)
-    else:
-        if shell_command("/usr/sbin/getsebool %s | grep -q \"%s --> off\""
-                         % (bool_name, bool_name)):
-            change_made = True
-            log(LOG_ACTION, "Setting SELinux boolean %s to off" % bool_name)
-            shell_command("/usr/sbin/setsebool -P %s 0" % bool_name)
+            if shell_command("/usr/sbin/getsebool %s | grep -q \"%s --> off\""
+                             % (bool_name, bool_name)):
+                change_made = True
+                log(LOG_ACTION, "Setting SELinux boolean %s to off" % bool_name)
+                shell_command("/usr/sbin/setsebool -P %s 0" % bool_name)
+            else:
+                log(LOG_NO_ACTION, "SELinux boolean %s already set to off" % bool_name)
+    except EnvironmentError, e:
+        if e.filename == None:
+            log(LOG_ERROR, "Error: " + str(e))
         else:
-            log(LOG_NO_ACTION, "SELinux boolean %s already set to off" % bool_name)
+            log(LOG_ERROR, "Error: " + e.filename + ": " + e.strerror)
+    except PysysconfError, e:
+        log(LOG_ERROR, "Error: " + str(e))
     return change_made
             
+def check_groups(groups, backup = True):
+    """Ensure that the given local groups exist with the given
+    properties. /etc/group (and /etc/gshadow, if present) are read
+    once and rewritten at most once, atomically, while holding the
+    standard lock on the account databases.
+
+    groups : dictionary
+        Mapping of group names to dictionaries of properties, with
+        the optional keys:
+            "gid" : integer GID. If not given, a new group is given
+                the lowest free GID of at least 1000 (or 201 for a
+                system group), and an existing group keeps its GID.
+            "members" : list of usernames that must be members of
+                the group. Other existing members are not removed.
+            "system" : boolean, whether a new group is a system
+                group (default False).
+
+    backup : boolean
+	(optional: default = True)
+        Whether to backup each file that is changed.
+
+    return : boolean
+	Whether any change was made.
+
+    e.g. Make sure the web and backup groups exist:
+    >>> check_groups({"webadmin": {"gid": 1500, "members": ["alice"]},
+    ...               "backup": {"system": True}})
+    """
+    change_made = False
+    try:
+        group_name = _root_path(group_file)
+        gshadow_name = _root_path(gshadow_file)
+        lock_fd = _lock_account_files(group_name)
+        try:
+            group = _read_account_file(group_name)
+            gshadow = None
+            if os.path.exists(gshadow_name):
+                gshadow = _read_account_file(gshadow_name)
+            new_group = list(group)
+            new_gshadow = gshadow and list(gshadow)
+            group_index = _account_index(new_group)
+            used_gids = _used_ids(new_group, 3)
+            for name in sorted(groups.keys()):
+                spec = groups[name]
+                if name in group_index:
+                    fields = new_group[group_index[name]].split(":")
+                    old_fields = list(fields)
+                    if spec.get("gid") != None:
+                        fields[2] = str(spec["gid"])
+                    members = [m for m in fields[3].split(",") if m]
+                    members.extend([m for m in spec.get("members", [])
+                                    if m not in members])
+                    fields[3] = ",".join(members)
+                    if fields != old_fields:
+                        new_group[group_index[name]] = ":".join(fields)
+                        log(LOG_ACTION, "Changing group " + name + " to "
+                            + new_group[group_index[name]])
+                    else:
+                        log(LOG_NO_ACTION, "Group " + name
+                            + " already exists")
+                else:
+                    gid = spec.get("gid")
+                    if gid == None:
+                        gid = _next_free_id(used_gids,
+                                            spec.get("system", False))
+                    used_gids.add(gid)
+                    members = ",".join(spec.get("members", []))
+                    new_group.append("%s:x:%d:%s" % (name, gid, members))
+                    group_index[name] = len(new_group) - 1
+                    log(LOG_ACTION, "Adding group " + new_group[-1])
+                if new_gshadow != None:
+                    gshadow_index = _account_index(new_gshadow)
+                    members = new_group[group_index[name]].split(":")[3]
+                    if name not in gshadow_index:
+                        new_gshadow.append("%s:!::%s" % (name, members))
+                    else:
+                        fields = new_gshadow[gshadow_index[name]].split(":")
+                        if len(fields) >= 4 and fields[3] != members:
+                            fields[3] = members
+                            new_gshadow[gshadow_index[name]] = \
+                                ":".join(fields)
+            if new_group != group:
+                _write_account_file(group_name, new_group, backup)
+                change_made = True
+            if new_gshadow != gshadow:
+                _write_account_file(gshadow_name, new_gshadow, backup)
+                change_made = True
+        finally:
+            os.close(lock_fd)
+        if change_made:
+            _uid_cache.clear()
+            _gid_cache.clear()
+    except EnvironmentError, e:
+        if e.filename == None:
+            log(LOG_ERROR, "Error: " + str(e))
+        else:
+            log(LOG_ERROR, "Error: " + e.filename + ": " + e.strerror)
+    except PysysconfError, e:
+        log(LOG_ERROR, "Error: " + str(e))
+    return change_made
+
+def check_users(users, backup = True):
+    """Ensure that the given local user accounts exist with the given
+    properties. /etc/passwd and /etc/shadow are read once and each
+    rewritten at most once, atomically, while holding the standard
+    lock on the account databases. Passwords of existing users are
+    never changed, and new users are created with locked passwords.
+    Home directories are not created.
+
+    users : dictionary
+        Mapping of usernames to dictionaries of properties, with the
+        optional keys:
+            "uid" : integer UID. If not given, a new user is given
+                the lowest free UID of at least 1000 (or 201 for a
+                system user), and an existing user keeps its UID.
+            "gid" : group name or integer GID of the primary group.
+                Defaults to the group with the same name as the user.
+            "gecos" : comment field.
+            "home" : home directory (default /home/<username>, or /
+                for a system user).
+            "shell" : login shell (default /bin/bash, or
+                /sbin/nologin for a system user).
+            "system" : boolean, whether a new user is a system user
+                (default False).
+        Properties that are not given are not changed for existing
+        users.
+
+    backup : boolean
+	(optional: default = True)
+        Whether to backup each file that is changed.
+
+    return : boolean
+	Whether any change was made.
+
+    e.g. Make sure a service user exists, after creating its group:
+    >>> check_groups({"myapp": {"system": True}})
+    >>> check_users({"myapp": {"system": True, "home": "/var/lib/myapp"}})
+    """
+    change_made = False
+    try:
+        passwd_name = _root_path(passwd_file)
+        shadow_name = _root_path(shadow_file)
+        lock_fd = _lock_account_files(passwd_name)
+        try:
+            passwd = _read_account_file(passwd_name)
+            group = _read_account_file(_root_path(group_file))
+            shadow = None
+            if os.path.exists(shadow_name):
+                shadow = _read_account_file(shadow_name)
+            new_passwd = list(passwd)
+            new_shadow = shadow and list(shadow)
+            passwd_index = _account_index(new_passwd)
+            group_gids = {}
+            for line in group:
+                fields = line.split(":")
+                if len(fields) >= 3:
+                    group_gids[fields[0]] = fields[2]
+            used_uids = _used_ids(new_passwd, 6)
+            for name in sorted(users.keys()):
+                spec = users[name]
+                system = spec.get("system", False)
+                gid = spec.get("gid")
+                if gid == None and name not in passwd_index:
+                    gid = name
+                if isinstance(gid, str):
+                    if gid not in group_gids:
+                        raise PysysconfError("Group " + gid + " for user "
+                                             + name + " does not exist")
+                    gid = group_gids[gid]
+                if name in passwd_index:
+                    fields = new_passwd[passwd_index[name]].split(":")
+                    old_fields = list(fields)
+                    for (i, key) in [(2, "uid"), (4, "gecos"),
+                                     (5, "home"), (6, "shell")]:
+                        if spec.get(key) != None:
+                            fields[i] = str(spec[key])
+                    if gid != None:
+                        fields[3] = str(gid)
+                    if fields != old_fields:
+                        new_passwd[passwd_index[name]] = ":".join(fields)
+                        log(LOG_ACTION, "Changing user " + name + " to "
+                            + new_passwd[passwd_index[name]])
+                    else:
+                        log(LOG_NO_ACTION, "User " + name
+                            + " already exists")
+                else:
+                    uid = spec.get("uid")
+                    if uid == None:
+                        uid = _next_free_id(used_uids, system)
+                    used_uids.add(uid)
+                    if system:
+                        default_home = "/"
+                        default_shell = "/sbin/nologin"
+                    else:
+                        default_home = "/home/" + name
+                        default_shell = "/bin/bash"
+                    new_passwd.append("%s:x:%d:%s:%s:%s:%s"
+                                      % (name, uid, gid,
+                                         spec.get("gecos", ""),
+                                         spec.get("home", default_home),
+                                         spec.get("shell", default_shell)))
+                    passwd_index[name] = len(new_passwd) - 1
+                    log(LOG_ACTION, "Adding user " + new_passwd[-1])
+                if new_shadow != None \
+                        and name not in _account_index(new_shadow):
+                    days = int(time.time() / 86400)
+                    new_shadow.append("%s:!!:%d:0:99999:7:::" % (name, days))
+            if new_passwd != passwd:
+                _write_account_file(passwd_name, new_passwd, backup)
+                change_made = True
+            if new_shadow != shadow:
+                _write_account_file(shadow_name, new_shadow, backup)
+                change_made = True
+        finally:
+            os.close(lock_fd)
+        if change_made:
+            _uid_cache.clear()
+            _gid_cache.clear()
+    except EnvironmentError, e:
+        if e.filename == None:
+            log(LOG_ERROR, "Error: " + str(e))
+        else:
+            log(LOG_ERROR, "Error: " + e.filename + ": " + e.strerror)
+    except PysysconfError, e:
+        log(LOG_ERROR, "Error: " + str(e))
+    return change_made
+
+def run_roots(policy, roots, processes = None):
+    """Apply a policy to each of several root directories in parallel,
+    with pysysconf.root set to each root in turn. The roots are shared
+    out between a pool of processes, which share a cache of source
+    file digests so that each source file is only read once.
+
+    policy : function
+        Function taking no arguments that calls check_* functions. It
+        must be defined at the top level of a module so that it can
+        be passed to other processes.
+
+    roots : list of strings
+        Root directories to apply the policy to.
+
+    processes : integer or None
+        (optional: default = None)
+        Number of processes to use. If None, use one per CPU.
+
+    return : dictionary
+        Mapping of each root to None if the policy completed, or to a
+        string describing the exception that stopped it.
+
+    e.g. Apply the same policy to every diskless client image:
+    >>> def policy():
+    ...     check_copy("hosts.diskless", "/etc/hosts")
+    >>> run_roots(policy, glob.glob("/srv/images/*"))
+    """
+    import multiprocessing
+    manager = multiprocessing.Manager()
+    try:
+        pool = multiprocessing.Pool(processes, _run_roots_init,
+                                    (manager.dict(),))
+        try:
+            results = pool.map(_run_root, [(policy, r) for r in roots], 1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        manager.shutdown()
+    outcome = {}
+    for (r, error) in zip(roots, results):
+        outcome[r] = error
+        if error != None:
+            log(LOG_ERROR, "Error: policy failed for root " + r + ": "
+                + error)
+    return outcome
+
+def run_checks(checks, deadline = None):
+    """Run checks in order of priority, deferring those that do not fit
+    in the time left before a run deadline.
+
+    checks : list of tuples (priority, timeout, function, args)
+        Each check is the call function(*args), where function is
+        usually one of the check_* functions. Checks with a higher
+        priority are run first, and checks with equal priorities are
+        run in the order given. If timeout is not None, the external
+        commands run by the check are limited to that many seconds
+        in total, as for time_limit().
+
+    deadline : number or None
+        (optional: default = None)
+        Number of seconds that the whole run may take. A check is
+        deferred if no time is left, or if its timeout is longer than
+        the time left, and the commands of every check are limited to
+        the time left. If None, all checks are run.
+
+    return : list of tuples
+        The checks that were deferred, in the form given. Each is
+        also logged as an error.
+
+    e.g. Keep security updates ahead of slow optional software, and
+         finish within ten minutes so the next cron run is not held up:
+    >>> run_checks([(10, 120, check_rpm_installed, ("openssl >= 1.0.1c",)),
+    ...             (0, 300, check_rpm_installed, ("texlive",)),
+    ...             (5, 30, check_service_enabled, ("sshd",))],
+    ...            deadline = 600)
+    """
+    end = None
+    if deadline != None:
+        end = time.time() + deadline
+    order = range(len(checks))
+    order.sort(key = lambda i: -checks[i][0])
+    deferred = []
+    for i in order:
+        (priority, timeout, function, args) = checks[i]
+        limit = timeout
+        if end != None:
+            remaining = end - time.time()
+            if remaining <= 0 or (timeout != None and timeout > remaining):
+                log(LOG_ERROR, "Error: deferred " + _check_name(function,
+                    args) + " (priority " + str(priority)
+                    + ") as the run deadline is too close")
+                deferred.append(checks[i])
+                continue
+            if limit == None:
+                limit = remaining
+        try:
+            if limit == None:
+                function(*args)
+            else:
+                with time_limit(limit):
+                    function(*args)
+        except PysysconfError, e:
+            log(LOG_ERROR, "Error: " + _check_name(function, args) + ": "
+                + str(e))
+    return deferred
+
+def stat_specs(table):
+    """Create stat_spec objects in bulk, as for a table of resources.
+
+    table : list of dictionaries
+        Keyword arguments of stat_spec() for each spec.
+
+    return : list of stat_spec objects
+        The spec for each row, in order. Rows with the same settings
+        share a single object.
+
+    e.g. Give a set of configuration files their ownership and modes:
+    >>> files = [("sshd_config", {"perm": "0600"}),
+    ...          ("ssh_config", {"perm": "0644"}),
+    ...          ("krb5.conf", {"perm": "0644"})]
+    >>> specs = stat_specs([attrs for (name, attrs) in files])
+    >>> for ((name, attrs), spec) in zip(files, specs):
+    ...     check_copy(name, "/etc/" + name, spec = spec)
+    """
+    shared = {}
+    specs = []
+    for row in table:
+        spec = stat_spec(**row)
+        specs.append(shared.setdefault(spec.key(), spec))
+    return specs
+
+def profile_run(policy, output, memory = False):
+    """Run a policy under cProfile, recording the time taken (and
+    optionally the memory allocated) by each call of a check_*
+    function.
+
+    policy : function
+        Function taking no arguments that calls check_* functions.
+        Calls are only recorded if the policy looks the functions up
+        in this module when it runs (as with pysysconf.check_copy, or
+        "from pysysconf import *" inside the policy), since they are
+        replaced by recording versions while it runs.
+
+    output : string
+        Prefix of the output filenames. The profile is written in
+        pstats format to output.pstats, and the time of each call
+        stack ending in a check_* call is written to output.collapsed
+        as "frame;frame;... microseconds" lines, which can be drawn
+        with flamegraph.pl.
+
+    memory : boolean
+        (optional: default = False)
+        Whether to also record the memory allocated by each call,
+        using the tracemalloc module (if it is available).
+
+    return : list of tuples (site, calls, seconds, bytes)
+        For each place that a check_* function is called from,
+        described as "filename:line function", the number of calls,
+        the total time, and the net memory allocated (or None), with
+        the slowest first.
+
+    Setting the environment variable PYSYSCONF_PROFILE to an output
+    prefix profiles the whole of a policy script in the same way,
+    writing the files when it exits (and setting
+    PYSYSCONF_PROFILE_MEMORY=1 records memory too).
+
+    e.g. Find the slowest resources in a policy:
+    >>> for (site, calls, seconds, bytes) in profile_run(policy,
+    ...                                                  "/tmp/policy")[:10]:
+    ...     print "%8.3f %s" % (seconds, site)
+    """
+    _profile_start(memory)
+    try:
+        policy()
+    finally:
+        sites = _profile_stop(output)
+    return sites
+
+def start_report(output):
+    """Start writing a report of every call of a check_* function as a
+    stream of JSON objects, one per line. The events are written by a
+    background thread, so that reporting does not slow the run.
+
+    output : string or file object
+        Filename to append the report to, or a file object to write
+        it to.
+
+    Calls are only reported if the policy looks the check_* functions
+    up in this module when it runs, as for profile_run(). Setting the
+    environment variable PYSYSCONF_REPORT to a filename reports every
+    call of a policy script.
+
+    Each event has these keys, whose meaning will not change (new
+    keys may be added, with a new schema number only if existing keys
+    change):
+
+    schema : integer
+        1.
+
+    run : string
+        Identifier of the run, the same for every event of a report.
+
+    seq : integer
+        Number of the event within the run, from 1, in the order that
+        the calls finished.
+
+    host : string
+        Name of the host.
+
+    time : string
+        UTC time at which the call started, in ISO 8601 format.
+
+    check : string
+        Name of the check_* function.
+
+    resource : string or null
+        The dst argument, or else the first argument if it is a string.
+
+    action : string
+        "changed", "unchanged", or "error".
+
+    before, after : object or null
+        For checks with a dst argument, the state of dst before and
+        after the call, with keys type ("file", "directory",
+        "symlink", or "other"), mode (octal string), uid, gid, size,
+        and mtime, or null if dst did not exist.
+
+    duration : number
+        Seconds taken by the call.
+
+    bytes : integer
+        Bytes of file data copied by the call.
+
+    error : string or null
+        The first error logged by the call (or raised by it), if any.
+
+    e.g. Report a run to a file for a central collector:
+    >>> start_report("/var/log/pysysconf/report.jsonl")
+    """
+    global _active_report
+    if _active_report != None:
+        raise PysysconfError("a report is already being written")
+    _active_report = _reporter(output)
+
+def finish_report():
+    """Stop reporting, and wait until all events have been written.
+    Does nothing if no report is being written.
+    """
+    global _active_report
+    reporter = _active_report
+    _active_report = None
+    if reporter != None:
+        reporter.stop()
+
 ##############################################################################
 # private functions
 
-def _copy_file(src, dst, backup, log_no_action = True):
+def _copy_file(src, dst, backup, log_no_action = True, verifier = None,
+               src_stat = None):
     """Copy a regular file.
 
     src : string
@@ -971,12 +2402,22 @@ def _copy_file(src, dst, backup, log_no_action = True):
         Whether to log in the case that no action was taken (if
         log_no_action is True).
 
+    verifier : _copy_verifier object or None
+        (optional: default = None)
+        If not None, dst is passed to it for checking once it has
+        been copied.
+
+    src_stat : stat result or None
+        (optional: default = None)
+        Result of os.lstat(src), if the caller already has it.
+
     return : boolean
         Returns True if the file was copied, otherwise False.
     """
+    fs = _fs()
     dst_exists = True;
     try:
-        dst_stat = os.lstat(dst)
+        dst_stat = fs.lstat(dst)
         dst_mode = dst_stat.st_mode
     except OSError, e:
         if e.errno == errno.ENOENT:
@@ -986,22 +2427,30 @@ def _copy_file(src, dst, backup, log_no_action = True):
     need_copy = True
     if dst_exists:
         if stat.S_ISREG(dst_mode):
-            src_stat = os.lstat(src)
+            if src_stat == None:
+                src_stat = fs.lstat(src)
             src_mode = src_stat.st_mode
             if not stat.S_ISREG(src_mode):
                 raise PyError("src " + src + " changed as we were " \
                               "watching (expected a regular file)")
-            if filecmp.cmp(src, dst, shallow = False):
+            if dst_stat.st_size == src_stat.st_size \
+                    and _file_digest(dst) == _source_digest(src, src_stat):
                 need_copy = False
     if need_copy:
         if dst_exists:
             _remove(dst, backup)
-        log(LOG_ACTION, "Copying " + src + " to " + dst)
+        _log_item(LOG_ACTION, "copied", "Copying %s to %s", src, dst)
         did_copy = True
-        _copy_file_data(src, dst)
+        if verifier == None:
+            _copy_file_data(src, dst)
+        else:
+            verifier.add(src, dst,
+                         _copy_file_data(src, dst, verifier.hash_name))
     else:
+        if verifier != None and verifier.hash_name != "sha1":
+            verifier.add(src, dst, None)
         if log_no_action:
-            log(LOG_NO_ACTION, dst + " is already the same as " + src)
+            log(LOG_NO_ACTION, "%s is already the same as %s", dst, src)
     return need_copy
 
 def _copy_link(src, dst, backup, log_no_action = True):
@@ -1027,39 +2476,39 @@ def _copy_link(src, dst, backup, log_no_action = True):
     return : boolean
         Returns True if the symlink was copied, otherwise False.
     """
+    fs = _fs()
     dst_exists = True;
     try:
-        dst_stat = os.lstat(dst)
+        dst_stat = fs.lstat(dst)
         dst_mode = dst_stat.st_mode
     except OSError, e:
         if e.errno == errno.ENOENT:
             dst_exists = False
         else:
             raise
-    src_stat = os.lstat(src)
+    src_stat = fs.lstat(src)
     src_mode = src_stat.st_mode
     if not stat.S_ISLNK(src_mode):
         raise PyError("src " + src + " changed as we were " \
                       "watching (expected a symlink)")
-    srclink = os.readlink(src)
+    srclink = fs.readlink(src)
     need_copy = True
     if dst_exists:
         if stat.S_ISLNK(dst_mode):
-            if os.readlink(dst) == srclink:
+            if fs.readlink(dst) == srclink:
                 need_copy = False
     if need_copy:
         if dst_exists:
             _remove(dst, backup)
-        log(LOG_ACTION, "Copying " + src + " to " + dst)
-        os.symlink(srclink, dst)
+        _log_item(LOG_ACTION, "copied", "Copying %s to %s", src, dst)
+        fs.symlink(srclink, dst)
     else:
         if log_no_action:
-            log(LOG_NO_ACTION, dst + " is already the same as " + src)
+            log(LOG_NO_ACTION, "%s is already the same as %s", dst, src)
     return need_copy
 
-def _copy_dir(src, dst, uid, gid, perm, umask, dmask, se_context,
-              se_user, se_role, se_type, se_level, backup, purge,
-              log_no_action = True):
+def _copy_dir(src, dst, options, log_no_action = True, rel_dir = "",
+              src_stat = None):
     """Copy a directory and all its contents.
 
     src : string
@@ -1068,84 +2517,35 @@ def _copy_dir(src, dst, uid, gid, perm, umask, dmask, se_context,
     dst : string
         Filename of the destination directory.
 
-    uid : string, integer, or None
-        Username (if a string) or UID (if an int) that should own the
-        dst object. In the case of a directory copy, uid will be
-        applied recursively to all subdirectories and their files. If
-        uid is None then the uid of dst is required to be the same as
-        that of src.
-
-    gid : string, integer, or None
-        Groupname or GID, as for uid.
-
-    perm : string, integer, or None
-        Permissions of dst. Can be a string containing an octal
-        number, such as "0644", or an integer containing the
-        same value, such as 0644. If None, then the permissions
-        of dst will be the same as those of src, masked by
-        umask (for files) or dmask (for directories).
-
-    umask : string, integer, or None
-        Mask for permissions of dst for the case that dst is not a
-        directory. Will be applied to perm if it is not None,
-        otherwise will be applied to the permissions of src. The
-        format is the same as that of perm.
-
-    dmask : string, integer, or None
-        Mask for permissions of dst for the case that dst is a
-        directory, as for umask.
-
-    se_context : string or None
-        SELinux context given as a string "user:role:type:level". If
-        se_context is not None then all of se_user, se_role, se_type,
-        and se_level must be None. If se_context is None then the
-        context of dst is not changed (except possibly by se_user,
-        se_role, se_type, or se_level).
-
-    se_user : string or None
-        SELinux context user as a string. Cannot be specified
-        simultaneously with se_context. If None, then the user
-        component of the context of dst is not changed (except
-        possibly by se_context).
-
-    se_role : string or None
-        SELinux context role as a string. Cannot be specified
-        simultaneously with se_context. If None, then the role
-        component of the context of dst is not changed (except
-        possibly by se_context).
-
-    se_type : string or None
-        SELinux context type as a string. Cannot be specified
-        simultaneously with se_context. If None, then the type
-        component of the context of dst is not changed (except
-        possibly by se_context).
-
-    se_level : string or None
-        SELinux context level as a string. Cannot be specified
-        simultaneously with se_context. If None, then the level
-        component of the context of dst is not changed (except
-        possibly by se_context).
-
-    backup : boolean
-        Whether to backup dst if it will be overwritten.
-
-    purge : boolean
-        Whether to delete files in dst (if it is a directory) if
-        they are not present in src.
+    options : _copy_options object
+        Settings of the copy, which are the same at every level.
 
     log_no_action : boolean
         (optional: default = True)
         Whether to log in the case that no action was taken (if
         log_no_action is True).
+
+    rel_dir : string
+        (optional: default = "")
+        Pathname of src relative to the top of the copy, against
+        which options.path_filter is matched.
+
+    src_stat : stat result or None
+        (optional: default = None)
+        Result of os.lstat(src), if the caller already has it.
     """
-    src_stat = os.lstat(src)
+    fs = _fs()
+    spec = options.spec
+    path_filter = options.path_filter
+    if src_stat == None:
+        src_stat = fs.lstat(src)
     src_mode = src_stat.st_mode
     if not stat.S_ISDIR(src_mode):
         raise PyError("src " + src + " changed as we were " \
                       "watching (expected a directory)")
     dst_exists = True;
     try:
-        dst_stat = os.lstat(dst)
+        dst_stat = fs.lstat(dst)
         dst_mode = dst_stat.st_mode
     except OSError, e:
         if e.errno == errno.ENOENT:
@@ -1157,220 +2557,2281 @@ def _copy_dir(src, dst, uid, gid, perm, umask, dmask, se_context,
         dst_exists = False
     did_copy = False
     if not dst_exists:
-        log(LOG_ACTION, "Copying " + src + " to " + dst)
-        os.mkdir(dst)
+        _log_item(LOG_ACTION, "copied", "Copying %s to %s", src, dst)
+        fs.mkdir(dst)
         did_copy = True
-    if _chkstatsrc(src, dst, uid, gid, perm,
-                   umask, dmask, se_context,
-                   se_user, se_role, se_type, se_level):
+        dst_stat = None
+    if _chkstatsrc(src, dst, spec, src_stat, dst_stat):
         did_copy = True
-    dst_dir = os.listdir(dst)
-    src_dir = os.listdir(src)
-    dst_dir.sort()
-    src_dir.sort()
-    dst_i = 0;
-    src_i = 0;
+    dst_dir = _sorted_dir(dst)
+    src_dir = _sorted_dir(src)
+    dst_entry = next(dst_dir, None)
+    src_entry = next(src_dir, None)
     while True:
-        if dst_i < len(dst_dir):
-            dst_entry = dst_dir[dst_i]
-        else:
-            dst_entry = None
-        if src_i < len(src_dir):
-            src_entry = src_dir[src_i]
-        else:
-            src_entry = None
         if dst_entry == None and src_entry == None:
             break
         need_copy = False
+        entry = src_entry
         if src_entry:
             if dst_entry == None:
                 need_copy = True
-                src_i = src_i + 1
+                src_entry = next(src_dir, None)
             elif src_entry < dst_entry:
                 need_copy = True
-                src_i = src_i + 1
+                src_entry = next(src_dir, None)
             elif src_entry == dst_entry:
                 need_copy = True
-                src_i = src_i + 1
-                dst_i = dst_i + 1
+                src_entry = next(src_dir, None)
+                dst_entry = next(dst_dir, None)
         if need_copy:
-            src_file = os.path.join(src, src_entry)
-            dst_file = os.path.join(dst, src_entry)
-            src_entry_stat = os.lstat(src_file)
+            rel_file = os.path.join(rel_dir, entry)
+            if path_filter != None and path_filter.excluded(rel_file):
+                continue
+            src_file = os.path.join(src, entry)
+            dst_file = os.path.join(dst, entry)
+            src_entry_stat = fs.lstat(src_file)
             src_entry_mode = src_entry_stat.st_mode
-            if stat.S_ISREG(src_entry_mode):
-                if _copy_file(src_file, dst_file, backup,
-                              log_no_action = False):
+            if path_filter != None and not stat.S_ISDIR(src_entry_mode) \
+                    and not path_filter.included(rel_file):
+                continue
+            if stat.S_ISREG(src_entry_mode) and options.link_map != None \
+                    and src_entry_stat.st_nlink > 1:
+                if _copy_hardlink(src_file, dst_file, src_entry_stat,
+                                  options.link_map, options.backup,
+                                  options.verifier):
+                    did_copy = True
+            elif stat.S_ISREG(src_entry_mode):
+                if _copy_file(src_file, dst_file, options.backup,
+                              log_no_action = False,
+                              verifier = options.verifier,
+                              src_stat = src_entry_stat):
                     did_copy = True
             elif stat.S_ISLNK(src_entry_mode):
-                if _copy_link(src_file, dst_file, backup,
+                if _copy_link(src_file, dst_file, options.backup,
                               log_no_action = False):
                     did_copy = True
             elif stat.S_ISDIR(src_entry_mode):
-                if _copy_dir(src_file, dst_file, uid, gid,
-                             perm, umask, dmask, se_context,
-                             se_user, se_role, se_type,
-                             se_level, backup, purge,
-                             log_no_action = False):
+                if _copy_dir(src_file, dst_file, options,
+                             log_no_action = False, rel_dir = rel_file,
+                             src_stat = src_entry_stat):
                     did_copy = True
             else:
                 raise PysysconfError("src " + src + " is not" \
                                   " a regular file, a symlink," \
                                   " or a directory")
-            if _chkstatsrc(src, dst, uid, gid, perm, umask, dmask,
-                           se_context, se_user, se_role, se_type, se_level):
+            # subdirectories are checked by the recursive copy, and the
+            # attributes of symlinks are not followed
+            if stat.S_ISREG(src_entry_mode) \
+                    and _chkstatsrc(src_file, dst_file, spec,
+                                    src_entry_stat):
                 did_copy = True
         else:
-            if purge:
+            if options.purge:
                 dst_file = os.path.join(dst, dst_entry)
-                log(LOG_ACTION, "Deleting " + dst_file)
-                _remove(dst_file, backup = False)
-                did_copy = True
-            dst_i = dst_i + 1
+                if path_filter == None:
+                    _log_item(LOG_ACTION, "deleted", "Deleting %s",
+                              dst_file)
+                    _remove(dst_file, backup = False)
+                    did_copy = True
+                elif _purge_filtered(dst_file,
+                                     os.path.join(rel_dir, dst_entry),
+                                     path_filter):
+                    did_copy = True
+            dst_entry = next(dst_dir, None)
     if not did_copy and log_no_action:
-        log(LOG_NO_ACTION, dst + " is already the same as " + src)
+        log(LOG_NO_ACTION, "%s is already the same as %s", dst, src)
     return did_copy
 
-def _rm_tree(dst):
-    """Remove the directory dst and all its contents.
+class _copy_options(object):
+    """Settings of a directory copy that are the same at every level,
+    so that they are passed down the recursion as one object.
 
-    dst : string
-        Name of directory to delete. Must currently exist.
-    """
-    dst_stat = os.lstat(dst)
-    dst_mode = dst_stat.st_mode
-    if stat.S_ISDIR(dst_mode):
-        dst_list = os.listdir(dst)
-        for f in dst_list:
-            f_name = os.path.join(dst, f)
-            _rm_tree(f_name)
-        os.rmdir(dst)
-    else:
-        os.unlink(dst)
+    spec : stat_spec object
+        Ownership, permissions, and SELinux context of the copies.
 
-def _remove(dst, backup):
-    """Remove or renames the object dst.
+    backup, purge :
+        As for check_copy().
 
-    dst : string
-        Name of object to remove. Must currently exist. May be
-        a regular file, a symlink, or a directory.
+    link_map : dictionary or None
+        If not None, hard links within src are preserved, and
+        link_map maps the (st_dev, st_ino) of each multiply-linked
+        source file already copied to the name of its copy in dst.
 
-    backup : boolean
-        Whether to backup the current dst to the same name
-        with a date/time string appended (if backup is True)
-        or to simply delete dst (if backup is False).
+    path_filter : _path_filter object or None
+        If not None, entries it excludes are skipped (and neither
+        copied nor purged), as are non-directories it does not
+        include.
+
+    verifier : _copy_verifier object or None
+        If not None, each file copied is passed to it for checking.
     """
-    dst_stat = os.lstat(dst)
-    dst_mode = dst_stat.st_mode
-    if backup:
-        d = datetime.datetime.today()
-        newname = dst + "." + d.isoformat()
-        os.rename(dst, newname)
-    else:
-        if stat.S_ISDIR(dst_mode):
-            _rm_tree(dst)
-        else:
-            os.unlink(dst)
+    __slots__ = ("spec", "backup", "purge", "link_map", "path_filter",
+                 "verifier")
+
+    def __init__(self, spec, backup, purge, link_map = None,
+                 path_filter = None, verifier = None):
+        self.spec = spec
+        self.backup = backup
+        self.purge = purge
+        self.link_map = link_map
+        self.path_filter = path_filter
+        self.verifier = verifier
+
+def _purge_filtered(dst, rel_name, path_filter):
+    """Delete an object in a copied directory that is not present in
+    the source, leaving anything that path_filter excludes or (for
+    non-directories) does not include. A directory is only deleted
+    if it is empty once its contents have been purged.
 
-def _copy_file_data(src, dst):
-    """Do an actual file copy from src to dst.
+    dst : string
+        Filename of the object to delete.
+
+    rel_name : string
+        Pathname of dst relative to the top of the copy.
+
+    path_filter : _path_filter object
+        Filter for the copy.
+
+    return : boolean
+        Returns True if anything was deleted, otherwise False.
+    """
+    fs = _fs()
+    if path_filter.excluded(rel_name):
+        return False
+    dst_stat = fs.lstat(dst)
+    if stat.S_ISDIR(dst_stat.st_mode):
+        change_made = _remove_by_test(dst, test_true(), backup = False,
+                                      path_filter = path_filter,
+                                      rel_dir = rel_name)
+        if _dir_is_empty(dst):
+            _log_item(LOG_ACTION, "deleted", "Deleting %s", dst)
+            fs.rmdir(dst)
+            change_made = True
+        return change_made
+    if not path_filter.included(rel_name):
+        return False
+    _log_item(LOG_ACTION, "deleted", "Deleting %s", dst)
+    _remove(dst, backup = False)
+    return True
+
+def _copy_hardlink(src, dst, src_stat, link_map, backup, verifier = None):
+    """Copy a regular file that has several hard links, making dst a
+    hard link to the copy of any other link to the same file.
+
+    src : string
+        Filename of src file. Must exist and be a regular file.
+
+    dst : string
+        Filename of destination file. May or may not exist.
+
+    src_stat : stat result
+        Result of os.lstat(src).
+
+    link_map : dictionary
+        Mapping of (st_dev, st_ino) of source files to the names of
+        their copies, as for _copy_dir(). Updated by this function.
+
+    backup : boolean
+        Whether to backup dst if it is replaced.
+
+    verifier : _copy_verifier object or None
+        (optional: default = None)
+        As for _copy_file().
+
+    return : boolean
+        Returns True if dst was changed, otherwise False.
+    """
+    fs = _fs()
+    key = (src_stat.st_dev, src_stat.st_ino)
+    if key not in link_map:
+        link_map[key] = dst
+        return _copy_file(src, dst, backup, log_no_action = False,
+                          verifier = verifier)
+    first_dst = link_map[key]
+    first_stat = fs.lstat(first_dst)
+    try:
+        dst_stat = fs.lstat(dst)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        dst_stat = None
+    if dst_stat != None:
+        if (dst_stat.st_dev, dst_stat.st_ino) \
+                == (first_stat.st_dev, first_stat.st_ino):
+            return False
+        _remove(dst, backup)
+    _log_item(LOG_ACTION, "copied", "Hard linking %s to %s", dst, first_dst)
+    fs.link(first_dst, dst)
+    return True
+
+class _copy_verifier:
+    """Pool of threads that check copied files against their sources.
+
+    Files are hashed while the copy continues, since hashlib releases
+    the interpreter lock while it works. The queue of files waiting
+    to be checked is bounded, so a copy cannot run far ahead of the
+    checks.
+    """
+    def __init__(self, hash_name, n_threads):
+        import hashlib, threading, Queue
+        try:
+            hashlib.new(hash_name)
+        except ValueError:
+            raise PysysconfError("Unknown hash " + str(hash_name))
+        self.hash_name = hash_name
+        self.mismatches = []
+        self.queue = Queue.Queue(4 * n_threads)
+        self.threads = []
+        for i in range(n_threads):
+            t = threading.Thread(target = self._worker)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def add(self, src, dst, src_digest):
+        """Queue dst to be checked against src.
+
+        src_digest : string or None
+            Digest of src with hash_name, or None if it must be read.
+        """
+        self.queue.put((src, dst, src_digest))
+
+    def finish(self):
+        """Wait for all queued checks and stop the threads.
+
+        return : list of strings
+            A message for each file that did not match its source.
+        """
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        return self.mismatches
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item == None:
+                return
+            (src, dst, src_digest) = item
+            try:
+                if src_digest == None:
+                    src_digest = _source_digest(src, _fs().lstat(src),
+                                                self.hash_name)
+                if _file_digest(dst, self.hash_name) != src_digest:
+                    self.mismatches.append(dst + " does not match " + src)
+            except EnvironmentError, e:
+                self.mismatches.append(str(e))
+
+def _iter_dir(path):
+    """Iterate over the names of the entries in the directory path,
+    reading the directory lazily with the scandir module or, without
+    it, with readdir() from the C library. Only if neither is
+    available, or path is not in the real filesystem, is the whole
+    directory listed at once.
+
+    path : string
+        Name of the directory.
+
+    return : iterator of strings
+        Entry names, in directory order.
+    """
+    fs = _fs()
+    native_path = fs.native_path(path)
+    if native_path == None:
+        return iter(fs.listdir(path))
+    scandir = _scandir()
+    if scandir != None:
+        return (entry.name for entry in scandir(native_path))
+    if _libc_dir_functions() != None:
+        return _readdir(native_path)
+    return iter(os.listdir(native_path))
+
+def _readdir(path):
+    """Iterate over the names of the entries in the directory path
+    with opendir() and readdir() from the C library. The directory is
+    opened (and errors in opening it are raised) immediately, and is
+    closed when the iterator is exhausted or discarded.
+    """
+    import ctypes
+    (opendir, readdir, closedir) = _libc_dir_functions()
+    dirp = opendir(path)
+    if not dirp:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), path)
+    def entries():
+        try:
+            while True:
+                ctypes.set_errno(0)
+                entry = readdir(dirp)
+                if not entry:
+                    e = ctypes.get_errno()
+                    if e != 0:
+                        raise OSError(e, os.strerror(e), path)
+                    return
+                name = entry.contents.d_name
+                if name != "." and name != "..":
+                    yield name
+        finally:
+            closedir(dirp)
+    return entries()
+
+def _libc_dir_functions():
+    """Return the C library functions (opendir, readdir, closedir),
+    with readdir returning a pointer to a struct dirent64, or None if
+    they are not available.
+    """
+    global _libc_dir
+    if _libc_dir == False:
+        try:
+            import ctypes, ctypes.util
+            class dirent64(ctypes.Structure):
+                _fields_ = [("d_ino", ctypes.c_uint64),
+                            ("d_off", ctypes.c_int64),
+                            ("d_reclen", ctypes.c_ushort),
+                            ("d_type", ctypes.c_ubyte),
+                            ("d_name", ctypes.c_char * 256)]
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                               use_errno = True)
+            opendir = libc.opendir
+            opendir.argtypes = [ctypes.c_char_p]
+            opendir.restype = ctypes.c_void_p
+            readdir = libc.readdir64
+            readdir.argtypes = [ctypes.c_void_p]
+            readdir.restype = ctypes.POINTER(dirent64)
+            closedir = libc.closedir
+            closedir.argtypes = [ctypes.c_void_p]
+            closedir.restype = ctypes.c_int
+            _libc_dir = (opendir, readdir, closedir)
+        except (ImportError, OSError, AttributeError):
+            _libc_dir = None
+    return _libc_dir
+
+def _sorted_dir(path):
+    """Read all entry names in the directory path and return them in
+    sorted order. Directories with more than external_sort_threshold
+    entries are sorted in chunks of that size which are written to
+    temporary files and then merged, to bound the memory used.
+
+    path : string
+        Name of the directory.
+
+    return : iterator of strings
+        Sorted entry names.
+    """
+    chunk = []
+    chunk_files = []
+    for name in _iter_dir(path):
+        chunk.append(name)
+        if len(chunk) >= external_sort_threshold:
+            chunk.sort()
+            chunk_files.append(_write_sort_chunk(chunk))
+            chunk = []
+    chunk.sort()
+    if not chunk_files:
+        return iter(chunk)
+    return heapq.merge(iter(chunk), *[_read_sort_chunk(f)
+                                      for f in chunk_files])
+
+def _write_sort_chunk(names):
+    """Write a sorted list of names to an anonymous temporary file,
+    each terminated by a NUL character (which cannot occur in a
+    filename).
+
+    return : file object
+        The temporary file, which is deleted when it is closed.
+    """
+    import tempfile
+    f = tempfile.TemporaryFile()
+    f.write("\0".join(names) + "\0")
+    f.seek(0)
+    return f
+
+def _read_sort_chunk(f):
+    """Iterate over the names written by _write_sort_chunk(), closing
+    the file when they have all been read.
+    """
+    try:
+        rest = ""
+        while True:
+            buf = f.read(65536)
+            if not buf:
+                break
+            names = (rest + buf).split("\0")
+            rest = names.pop()
+            for name in names:
+                yield name
+    finally:
+        f.close()
+
+class _path_filter:
+    """Compiled include and exclude patterns for a directory traversal.
+
+    Each pattern is either a glob string or a compiled regular
+    expression. A glob without a "/" is matched against the name of
+    each entry, and a glob containing a "/" against its pathname
+    relative to the top of the traversal. A regular expression is
+    searched for in the relative pathname. All the globs in a list
+    are compiled into a single regular expression.
+    """
+    def __init__(self, include = None, exclude = None):
+        self.include = self._compile(include)
+        self.exclude = self._compile(exclude)
+
+    def _compile(self, patterns):
+        if patterns == None:
+            return None
+        import fnmatch
+        name_globs = []
+        path_globs = []
+        regexps = []
+        for pattern in patterns:
+            if not isinstance(pattern, basestring):
+                regexps.append(pattern)
+            elif "/" in pattern:
+                path_globs.append(fnmatch.translate(pattern.strip("/")))
+            else:
+                name_globs.append(fnmatch.translate(pattern))
+        name_re = None
+        path_re = None
+        if name_globs:
+            name_re = re.compile("|".join(name_globs))
+        if path_globs:
+            path_re = re.compile("|".join(path_globs))
+        return (name_re, path_re, regexps)
+
+    def _matches(self, compiled, rel_name):
+        (name_re, path_re, regexps) = compiled
+        if name_re != None \
+                and name_re.match(os.path.basename(rel_name)):
+            return True
+        if path_re != None and path_re.match(rel_name):
+            return True
+        for regexp in regexps:
+            if regexp.search(rel_name):
+                return True
+        return False
+
+    def excluded(self, rel_name):
+        """Return whether the entry rel_name (a pathname relative to
+        the top of the traversal) and everything below it should be
+        skipped. This only needs the name, so pruned entries are
+        never stat'ed or listed.
+        """
+        return self.exclude != None \
+            and self._matches(self.exclude, rel_name)
+
+    def included(self, rel_name):
+        """Return whether the non-directory entry rel_name should be
+        processed. Directories are always descended into unless they
+        are excluded.
+        """
+        return self.include == None \
+            or self._matches(self.include, rel_name)
+
+    def key(self):
+        """Return a string describing the patterns, for use in the
+        inputs recorded in the state database.
+        """
+        parts = []
+        for compiled in (self.include, self.exclude):
+            if compiled == None:
+                parts.append(None)
+            else:
+                (name_re, path_re, regexps) = compiled
+                parts.append(([r.pattern for r in (name_re, path_re)
+                               if r != None],
+                              [(r.pattern, r.flags) for r in regexps]))
+        return repr(parts)
+
+def _dir_is_empty(path):
+    """Return whether the directory path has no entries.
+    """
+    return next(_iter_dir(path), None) == None
+
+def _rm_tree(dst):
+    """Remove the directory dst and all its contents.
+
+    dst : string
+        Name of directory to delete. Must currently exist.
+    """
+    fs = _fs()
+    dst_stat = fs.lstat(dst)
+    dst_mode = dst_stat.st_mode
+    if stat.S_ISDIR(dst_mode):
+        dst_list = fs.listdir(dst)
+        for f in dst_list:
+            f_name = os.path.join(dst, f)
+            _rm_tree(f_name)
+        fs.rmdir(dst)
+    else:
+        fs.unlink(dst)
+
+def _trash_tree(dst):
+    """Move the directory dst into the trash directory for its
+    filesystem and queue it for deletion by the background threads.
+
+    dst : string
+        Name of directory to delete. Must currently exist.
+
+    return : boolean
+        Returns True if dst was moved to the trash, or False if
+        this was not possible and dst is unchanged.
+    """
+    trash_dir = _trash_dir_for(dst)
+    if trash_dir == None:
+        return False
+    trash_name = os.path.join(trash_dir, "%d.%d.%s"
+                              % (os.getpid(), _trash_counter.next(),
+                                 os.path.basename(dst.rstrip("/"))))
+    try:
+        os.rename(dst, trash_name)
+    except OSError, e:
+        if e.errno in (errno.EXDEV, errno.EACCES, errno.EPERM,
+                       errno.EROFS, errno.EBUSY):
+            return False
+        raise
+    _reap_queue.put(_reap_job(trash_name))
+    return True
+
+def _trash_dir_for(dst):
+    """Find (and create if necessary) the trash directory on the same
+    filesystem as dst. The first time a trash directory is used, any
+    leftover contents from earlier runs are queued for deletion.
+
+    dst : string
+        Name of an existing object.
+
+    return : string or None
+        The trash directory, or None if no usable trash directory
+        could be found on the filesystem.
+
+    The trash directory is .pysysconf-trash at the top of the
+    filesystem, unless the setting trash_dir names another directory,
+    which is then used for dst only if it is on the same filesystem.
+    """
+    global _reap_queue
+    parent = os.path.dirname(os.path.abspath(dst))
+    dev = os.lstat(parent).st_dev
+    _reap_lock.acquire()
+    try:
+        if (dev, trash_dir) in _trash_dirs:
+            return _trash_dirs[(dev, trash_dir)]
+        _trash_dirs[(dev, trash_dir)] = None
+        if trash_dir != None:
+            name = os.path.abspath(trash_dir)
+            if os.lstat(os.path.dirname(name)).st_dev != dev:
+                return None
+        else:
+            mount_point = parent
+            while mount_point != "/":
+                up = os.path.dirname(mount_point)
+                if os.lstat(up).st_dev != dev:
+                    break
+                mount_point = up
+            name = os.path.join(mount_point, ".pysysconf-trash")
+        try:
+            os.mkdir(name, 0700)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                log(LOG_NO_ACTION, "Unable to create %s, removing"
+                    " directories in the foreground" % name)
+                return None
+        trash_stat = os.lstat(name)
+        if not stat.S_ISDIR(trash_stat.st_mode) \
+                or trash_stat.st_uid != os.geteuid() \
+                or stat.S_IMODE(trash_stat.st_mode) & 077:
+            log(LOG_ERROR, "Error: %s is not a private directory, removing"
+                " directories in the foreground" % name)
+            return None
+        if _reap_queue == None:
+            import threading, Queue
+            _reap_queue = Queue.Queue()
+            for i in range(max(remove_threads, 1)):
+                t = threading.Thread(target = _reap_worker,
+                                     name = "pysysconf-reaper-%d" % i)
+                t.setDaemon(True)
+                t.start()
+        for f in os.listdir(name):
+            if _trash_owner_running(f):
+                continue
+            log(LOG_ACTION, "Removing leftover trash "
+                + os.path.join(name, f))
+            _reap_queue.put(_reap_job(os.path.join(name, f)))
+        _trash_dirs[(dev, trash_dir)] = name
+        return name
+    finally:
+        _reap_lock.release()
+
+def _trash_owner_running(trash_name):
+    """Test whether the trash entry trash_name (named as by
+    _trash_tree()) belongs to another process that is still running,
+    and so may still be deleting it.
+    """
+    try:
+        pid = int(trash_name.split(".", 1)[0])
+    except ValueError:
+        return False
+    if pid == os.getpid():
+        return False
+    try:
+        os.getsid(pid)
+        return True
+    except OSError:
+        return False
+
+class _reap_job:
+    """An object in the trash that is being deleted.
+
+    Each directory counts how many of its subdirectories (plus its own
+    listing) are still being processed, and is removed by whichever
+    thread finishes the last of these.
+    """
+    def __init__(self, path, parent = None):
+        self.path = path
+        self.parent = parent
+        self.pending = 1
+        self.is_dir = False
+
+def _reap_worker():
+    """Body of the background threads that delete trashed objects.
+    """
+    while True:
+        job = _reap_queue.get()
+        try:
+            _reap(job)
+        finally:
+            _reap_queue.task_done()
+
+def _reap(job):
+    """Delete the non-directory contents of a trashed object, and queue
+    its subdirectories as new jobs.
+
+    job : _reap_job
+        Object to process.
+    """
+    try:
+        job.is_dir = stat.S_ISDIR(os.lstat(job.path).st_mode)
+        if job.is_dir:
+            for f in os.listdir(job.path):
+                f_name = os.path.join(job.path, f)
+                if stat.S_ISDIR(os.lstat(f_name).st_mode):
+                    child = _reap_job(f_name, job)
+                    _reap_lock.acquire()
+                    job.pending = job.pending + 1
+                    _reap_lock.release()
+                    _reap_queue.put(child)
+                else:
+                    os.unlink(f_name)
+    except EnvironmentError, e:
+        if e.errno != errno.ENOENT:
+            log(LOG_ERROR, "Error: " + str(e))
+    _reap_done(job)
+
+def _reap_done(job):
+    """Mark one piece of work on job as finished, removing job (and
+    then its parents) once nothing remains to be done inside it.
+
+    job : _reap_job
+        Object to mark.
+    """
+    while job != None:
+        _reap_lock.acquire()
+        job.pending = job.pending - 1
+        pending = job.pending
+        _reap_lock.release()
+        if pending > 0:
+            return
+        try:
+            if job.is_dir:
+                os.rmdir(job.path)
+            else:
+                os.unlink(job.path)
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                log(LOG_ERROR, "Error: " + str(e))
+        job = job.parent
+
+def _remove(dst, backup):
+    """Remove or renames the object dst.
+
+    dst : string
+        Name of object to remove. Must currently exist. May be
+        a regular file, a symlink, or a directory.
+
+    backup : boolean
+        Whether to backup the current dst to the same name
+        with a date/time string appended, or to the backup store
+        if backup_dir is set (if backup is True), or to simply
+        delete dst (if backup is False).
+
+    The backup store and removal in the background are only used if
+    dst is in the real filesystem.
+    """
+    fs = _fs()
+    native_dst = fs.native_path(dst)
+    dst_stat = fs.lstat(dst)
+    dst_mode = dst_stat.st_mode
+    if backup and backup_dir != None and native_dst != None:
+        _backup_save(native_dst)
+        _remove(dst, backup = False)
+    elif backup:
+        d = datetime.datetime.today()
+        newname = dst + "." + d.isoformat()
+        fs.rename(dst, newname)
+    else:
+        if stat.S_ISDIR(dst_mode):
+            if not (remove_in_background and native_dst != None
+                    and _trash_tree(native_dst)):
+                _rm_tree(dst)
+        else:
+            fs.unlink(dst)
+
+def _backup_save(dst):
+    """Save the object dst (and its contents, if it is a directory)
+    in the backup store in backup_dir and record it in the index.
+
+    dst : string
+        Name of object to save. Must currently exist.
+    """
+    objects_dir = os.path.join(backup_dir, "objects")
+    if not os.path.isdir(objects_dir):
+        os.makedirs(objects_dir, 0700)
+    with _backup_lock():
+        _backup_save_locked(dst, objects_dir)
+    log(LOG_ACTION, "Saved " + dst + " in backup store " + backup_dir)
+
+def _backup_save_locked(dst, objects_dir):
+    """Save dst in the backup store, as for _backup_save(), while the
+    caller holds the lock on the store.
+    """
+    import json
+    now = datetime.datetime.now().isoformat()
+    entries = []
+    pending = [dst]
+    while pending:
+        path = pending.pop()
+        path_stat = os.lstat(path)
+        path_mode = path_stat.st_mode
+        entry = {"time": now, "path": os.path.abspath(path),
+                 "mode": stat.S_IMODE(path_mode),
+                 "uid": path_stat.st_uid, "gid": path_stat.st_gid}
+        if stat.S_ISREG(path_mode):
+            entry["type"] = "file"
+            entry["object"] = _backup_store_file(path, path_stat,
+                                                 objects_dir)
+        elif stat.S_ISLNK(path_mode):
+            entry["type"] = "link"
+            entry["target"] = os.readlink(path)
+        elif stat.S_ISDIR(path_mode):
+            entry["type"] = "dir"
+            pending.extend([os.path.join(path, f)
+                            for f in os.listdir(path)])
+        else:
+            continue
+        entries.append(json.dumps(entry) + "\n")
+    f = open(os.path.join(backup_dir, "index"), "a")
+    try:
+        f.write("".join(entries))
+    finally:
+        f.close()
+
+@contextlib.contextmanager
+def _backup_lock():
+    """Context manager that holds an exclusive flock on the file lock in
+    backup_dir, so that backups saved by one process are not lost from
+    the index, or their contents deleted, by check_backups_pruned() in
+    another. Raises PysysconfError if the lock is not acquired within
+    _BACKUP_LOCK_TIMEOUT seconds.
+    """
+    lock_name = os.path.join(backup_dir, "lock")
+    fd = os.open(lock_name, os.O_CREAT | os.O_RDWR, 0600)
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETFD,
+                    fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        deadline = time.time() + _BACKUP_LOCK_TIMEOUT
+        delay = 0.01
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PysysconfError("unable to lock backup store "
+                                         + backup_dir)
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 0.5)
+        yield
+    finally:
+        os.close(fd)
+
+def _backup_store_file(path, path_stat, objects_dir):
+    """Store the contents of the regular file path in the backup
+    store, unless identical contents are already stored.
+
+    path : string
+        Name of the file to store.
+
+    path_stat : stat result
+        Result of os.lstat(path).
+
+    objects_dir : string
+        Directory holding the stored objects.
+
+    return : string
+        The SHA-1 digest of the contents, which identifies the object.
+    """
+    digest = _file_digest(path)
+    object_dir = os.path.join(objects_dir, digest[:2])
+    object_name = os.path.join(object_dir, digest)
+    if backup_compress:
+        object_name = object_name + ".gz"
+    if os.path.exists(object_name):
+        return digest
+    if not os.path.isdir(object_dir):
+        os.mkdir(object_dir, 0700)
+    tmp_name = "%s.%d.tmp" % (object_name, os.getpid())
+    linked = False
+    if not backup_compress and path_stat.st_nlink == 1:
+        # the file is about to be removed, so we can simply keep its
+        # inode, provided nothing else can modify it
+        try:
+            os.link(path, tmp_name)
+            linked = True
+        except OSError, e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    if not linked:
+        if backup_compress:
+            import gzip
+            fdst = gzip.open(tmp_name, "wb")
+        else:
+            fdst = open(tmp_name, "wb")
+        try:
+            fsrc = open(path, "rb")
+            try:
+                while True:
+                    buf = fsrc.read(65536)
+                    if not buf:
+                        break
+                    fdst.write(buf)
+            finally:
+                fsrc.close()
+        finally:
+            fdst.close()
+    os.rename(tmp_name, object_name)
+    return digest
+
+def _render_template(src, vars):
+    """Render the template file src with the given variables, using
+    cached results where possible. Template files are cached by their
+    stat data, and rendered output by the template digest and a hash
+    of the variables. Each cache holds at most template_cache_entries
+    entries.
+
+    src : string
+        Filename of the template.
+
+    vars : dictionary
+        Values of the variables used in the template.
+
+    return : (string, string) tuple
+        The rendered output and its SHA-1 digest.
+    """
+    import hashlib, string
+    src_stat = os.stat(src)
+    src_key = (os.path.abspath(src), src_stat.st_dev, src_stat.st_ino,
+               src_stat.st_size, src_stat.st_mtime, src_stat.st_ctime)
+    if src_key not in _template_sources:
+        f = open(src, "rb")
+        try:
+            text = f.read()
+        finally:
+            f.close()
+        _cache_put(_template_sources, src_key,
+                   (text, hashlib.sha1(text).hexdigest()))
+    (text, src_digest) = _template_sources[src_key]
+    vars_hash = hashlib.sha1(repr(sorted(vars.items()))).hexdigest()
+    render_key = (src_digest, vars_hash)
+    if render_key not in _template_renders:
+        try:
+            rendered = string.Template(text).substitute(vars)
+        except KeyError, e:
+            raise PysysconfError("template " + src
+                                 + " uses undefined variable " + str(e))
+        except ValueError, e:
+            raise PysysconfError("template " + src + ": " + str(e))
+        if isinstance(rendered, unicode):
+            rendered = rendered.encode("utf-8")
+        _cache_put(_template_renders, render_key,
+                   (rendered, hashlib.sha1(rendered).hexdigest()))
+    return _template_renders[render_key]
+
+def _cache_put(cache, key, value):
+    """Store value in the dictionary cache under key, first discarding
+    an arbitrary entry if the cache already holds
+    template_cache_entries entries.
+    """
+    if key not in cache and cache \
+            and len(cache) >= template_cache_entries:
+        del cache[next(iter(cache))]
+    cache[key] = value
+
+def _mmap_file(dst):
+    """Map the regular file dst read-only into memory.
+
+    dst : string
+        Filename to map.
+
+    return : mmap object or None
+        The mapping, or None if dst does not exist or is empty.
+    """
+    try:
+        f = open(dst, "rb")
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    try:
+        if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+            raise PysysconfError(dst + " is not a regular file")
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+def _mmap_has_line(mm, line):
+    """Test whether the mapped file mm contains line as a complete line.
+
+    mm : mmap object or None
+        File contents, as returned by _mmap_file().
+
+    line : string
+        Line to search for, without a trailing newline.
+    """
+    if mm == None:
+        return False
+    n = len(line)
+    if mm[:n + 1] == line + "\n" or (len(mm) == n and mm[:] == line):
+        return True
+    if mm.find("\n" + line + "\n") != -1:
+        return True
+    return len(mm) > n and mm[-n - 1:] == "\n" + line
+
+def _rewrite_file(dst, edit, backup):
+    """Atomically replace the file dst with an edited version, keeping
+    its ownership, permissions, and SELinux context.
+
+    dst : string
+        Filename of the file to replace. If it does not exist, it is
+        created with mode 0644. If it is a symlink, the file it
+        points to is replaced (see _root_realpath()).
+
+    edit : function
+        Called as edit(f_in, f_out) to write the new contents to f_out
+        from the old contents in f_in, which is None if dst does not
+        exist.
+
+    backup : boolean
+        Whether to backup the old dst, as for _remove().
+    """
+    dst = _root_realpath(dst)
+    try:
+        dst_stat = os.stat(dst)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        dst_stat = None
+    import tempfile
+    (fd, tmp_name) = tempfile.mkstemp(prefix = "." + os.path.basename(dst)
+                                      + ".", dir = os.path.dirname(dst)
+                                      or ".")
+    try:
+        f_out = os.fdopen(fd, "wb")
+        try:
+            if dst_stat == None:
+                edit(None, f_out)
+            else:
+                f_in = open(dst, "rb")
+                try:
+                    edit(f_in, f_out)
+                finally:
+                    f_in.close()
+            f_out.flush()
+            os.fsync(f_out.fileno())
+        finally:
+            f_out.close()
+        if dst_stat == None:
+            os.chmod(tmp_name, 0644)
+        else:
+            os.chown(tmp_name, dst_stat.st_uid, dst_stat.st_gid)
+            os.chmod(tmp_name, stat.S_IMODE(dst_stat.st_mode))
+            selinux = _selinux()
+            if selinux != None and selinux.is_selinux_enabled():
+                selinux.lsetfilecon(tmp_name, selinux.getfilecon(dst)[1])
+            if backup:
+                _backup_in_place(dst)
+        os.rename(tmp_name, dst)
+    except:
+        os.unlink(tmp_name)
+        raise
+
+def _backup_in_place(dst):
+    """Backup the regular file dst, which is about to be replaced by
+    renaming another file over it, to the backup store if backup_dir
+    is set, or otherwise as a hard link named dst with a date/time
+    string appended.
+    """
+    if backup_dir != None:
+        _backup_save(dst)
+    else:
+        os.link(dst, dst + "." + datetime.datetime.today().isoformat())
+
+def _run_with_deadline(command, deadline):
+    """Run command in a shell as for os.system(), killing it and all
+    the processes it started if it is still running at time deadline.
+
+    return : integer
+        The exit status of the command, as for os.system(). If the
+        command was killed, this is the signal that killed it, and
+        the timeout is logged as an error.
+    """
+    import subprocess, signal
+    p = subprocess.Popen(command, shell = True, preexec_fn = os.setsid)
+    delay = 0.001
+    while p.poll() == None:
+        left = deadline - time.time()
+        if left <= 0:
+            log(LOG_ERROR, "Error: command \"" + command + "\" timed out")
+            for sig in (signal.SIGTERM, signal.SIGKILL):
+                try:
+                    os.killpg(p.pid, sig)
+                except OSError, e:
+                    if e.errno != errno.ESRCH:
+                        raise
+                for j in range(20):
+                    if p.poll() != None:
+                        break
+                    time.sleep(0.05)
+                if p.poll() != None:
+                    break
+            if p.returncode == None:
+                return signal.SIGKILL
+            break
+        time.sleep(min(delay, left))
+        delay = min(delay * 2, 0.05)
+    if p.returncode < 0:
+        return -p.returncode
+    return p.returncode << 8
+
+@contextlib.contextmanager
+def _log_aggregated(dst):
+    """Context manager within which, if log_aggregate is set, messages
+    logged with _log_item() are counted rather than logged, and are
+    summarized by a message for each action at the end, such as
+    "removed 98,211 objects under /var/spool/x". Nested uses count
+    towards the outermost one.
+
+    dst : string
+        Name of the directory that the messages are about.
+    """
+    global _log_counts
+    if not log_aggregate or _log_counts != None:
+        yield
+        return
+    _log_counts = {}
+    try:
+        yield
+    finally:
+        counts = _log_counts
+        _log_counts = None
+        for ((level, action), count) in sorted(counts.items()):
+            if count == 1:
+                noun = "object"
+            else:
+                noun = "objects"
+            log(level, "%s %s %s under %s", action, format(count, ","),
+                noun, dst)
+
+def _log_item(level, action, message, *args):
+    """Log a message about a single object within a directory, or count
+    it under action if messages are being aggregated (see
+    _log_aggregated()).
+
+    action : string
+        Past tense of the action, such as "removed", used in the
+        summary.
+    """
+    if _log_counts == None:
+        log(level, message, *args)
+    elif level <= verbosity or level <= syslog_verbosity:
+        key = (level, action)
+        _log_counts[key] = _log_counts.get(key, 0) + 1
+
+def _check_name(function, args):
+    """Describe the call function(*args) for log messages.
+    """
+    return getattr(function, "__name__", str(function)) \
+        + "(" + ", ".join([repr(a) for a in args]) + ")"
+
+class _profiler:
+    """Profile of a policy run, as for profile_run().
+
+    While it is active, each check_* function in this module is
+    replaced by a version that records the time spent in each call,
+    keyed by the call site and by the stack of callers leading to it.
+    The time recorded for a stack excludes that of the check_* calls
+    nested inside it, as flame graphs expect.
+    """
+    def __init__(self, memory):
+        import cProfile
+        self.profile = cProfile.Profile()
+        self.tracemalloc = None
+        if memory:
+            try:
+                import tracemalloc
+            except ImportError:
+                log(LOG_ERROR, "Error: the tracemalloc module is not"
+                    " available, so memory will not be profiled")
+            else:
+                tracemalloc.start()
+                self.tracemalloc = tracemalloc
+        self.sites = {}
+        self.stacks = {}
+        self.child_times = []
+        self.originals = {}
+        module = sys.modules[__name__]
+        for name in dir(module):
+            if name.startswith("check_"):
+                self.originals[name] = getattr(module, name)
+                setattr(module, name,
+                        self._wrap(name, self.originals[name]))
+        self.skip_codes = set([self._call.im_func.func_code,
+                               profile_run.func_code])
+        self.skip_codes.add(self._wrap("", None).func_code)
+        self.profile.enable()
+
+    def _wrap(self, name, function):
+        def profiled_check(*args, **kwargs):
+            return self._call(name, function, args, kwargs)
+        profiled_check.__name__ = name
+        profiled_check.__doc__ = getattr(function, "__doc__", None)
+        return profiled_check
+
+    def _call(self, name, function, args, kwargs):
+        frames = []
+        f = sys._getframe(2)
+        site = "%s:%d %s" % (f.f_code.co_filename, f.f_lineno, name)
+        while f != None:
+            if f.f_code not in self.skip_codes:
+                frames.append("%s (%s:%d)" % (f.f_code.co_name,
+                    os.path.basename(f.f_code.co_filename), f.f_lineno))
+            f = f.f_back
+        frames.reverse()
+        frames.append(name)
+        stack = ";".join(frames)
+        self.child_times.append(0.0)
+        mem_before = None
+        if self.tracemalloc != None:
+            mem_before = self.tracemalloc.get_traced_memory()[0]
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            mem = None
+            if mem_before != None:
+                mem = self.tracemalloc.get_traced_memory()[0] - mem_before
+            child_time = self.child_times.pop()
+            if self.child_times:
+                self.child_times[-1] = self.child_times[-1] + elapsed
+            (calls, seconds, n_bytes) = self.sites.get(site, (0, 0.0, None))
+            if mem != None:
+                n_bytes = (n_bytes or 0) + mem
+            self.sites[site] = (calls + 1, seconds + elapsed, n_bytes)
+            self.stacks[stack] = self.stacks.get(stack, 0) \
+                + int((elapsed - child_time) * 1e6)
+
+    def stop(self, output):
+        """Stop profiling, restore the check_* functions, and write the
+        output files.
+
+        return : list of tuples
+            As for profile_run().
+        """
+        self.profile.disable()
+        module = sys.modules[__name__]
+        for (name, function) in self.originals.items():
+            setattr(module, name, function)
+        if self.tracemalloc != None:
+            self.tracemalloc.stop()
+        self.profile.dump_stats(output + ".pstats")
+        f = open(output + ".collapsed", "w")
+        try:
+            for stack in sorted(self.stacks):
+                f.write("%s %d\n" % (stack, self.stacks[stack]))
+        finally:
+            f.close()
+        sites = [(site, calls, seconds, n_bytes) for (site, (calls, seconds,
+                 n_bytes)) in self.sites.items()]
+        sites.sort(key = lambda s: -s[2])
+        return sites
+
+def _profile_start(memory):
+    """Start profiling the check_* calls of a policy run.
+    """
+    global _active_profiler
+    if _active_profiler != None:
+        raise PysysconfError("a policy run is already being profiled")
+    _active_profiler = _profiler(memory)
+
+def _profile_stop(output):
+    """Stop the profile started by _profile_start() and write it to
+    files named with the prefix output.
+
+    return : list of tuples
+        As for profile_run().
+    """
+    global _active_profiler
+    profiler = _active_profiler
+    _active_profiler = None
+    return profiler.stop(output)
+
+class _reporter:
+    """Report of a run, as for start_report().
+
+    While it is active, each check_* function in this module is
+    replaced by a version that records an event for each call, and the
+    events are passed through a bounded queue to a thread that writes
+    them. Calls made in other processes (such as those of run_roots())
+    are not reported.
+    """
+    def __init__(self, output):
+        import json, threading, Queue
+        self.json = json
+        if isinstance(output, basestring):
+            self.f = open(output, "a", 65536)
+            self.close_file = True
+        else:
+            self.f = output
+            self.close_file = False
+        self.pid = os.getpid()
+        self.host = os.uname()[1]
+        self.run_id = "%s:%d:%d" % (self.host, self.pid, int(time.time()))
+        self.seq = itertools.count(1)
+        # [bytes, error] of each check call in progress, innermost last
+        self.frames = []
+        self.queue = Queue.Queue(1024)
+        # first error in writing the report, and the events not written
+        self.write_error = None
+        self.dropped = 0
+        self.thread = threading.Thread(target = self._writer)
+        self.thread.daemon = True
+        self.thread.start()
+        self.originals = {}
+        module = sys.modules[__name__]
+        for name in dir(module):
+            if name.startswith("check_"):
+                self.originals[name] = getattr(module, name)
+                setattr(module, name,
+                        self._wrap(name, self.originals[name]))
+
+    def _wrap(self, name, function):
+        def reported_check(*args, **kwargs):
+            return self._call(name, function, args, kwargs)
+        reported_check.__name__ = name
+        reported_check.__doc__ = getattr(function, "__doc__", None)
+        return reported_check
+
+    def _call(self, name, function, args, kwargs):
+        if os.getpid() != self.pid:
+            return function(*args, **kwargs)
+        resource = None
+        path = None
+        code = getattr(function, "func_code", None)
+        arg_names = ()
+        if code != None:
+            arg_names = code.co_varnames[:code.co_argcount]
+        if "dst" in arg_names:
+            i = arg_names.index("dst")
+            if len(args) > i:
+                resource = args[i]
+            else:
+                resource = kwargs.get("dst")
+            if isinstance(resource, basestring):
+                try:
+                    path = _root_path(resource)
+                except PysysconfError:
+                    pass
+        elif args:
+            resource = args[0]
+        if not isinstance(resource, basestring):
+            resource = None
+        before = self._state(path)
+        frame = [0, None]
+        self.frames.append(frame)
+        start = time.time()
+        result = None
+        try:
+            result = function(*args, **kwargs)
+            return result
+        except Exception, e:
+            if frame[1] == None:
+                frame[1] = str(e)
+            raise
+        finally:
+            duration = time.time() - start
+            self.frames.pop()
+            if self.frames:
+                self.frames[-1][0] = self.frames[-1][0] + frame[0]
+            if frame[1] != None:
+                action = "error"
+            elif result:
+                action = "changed"
+            else:
+                action = "unchanged"
+            started = datetime.datetime.utcfromtimestamp(start).isoformat()
+            self.queue.put({
+                "schema": 1,
+                "run": self.run_id,
+                "seq": self.seq.next(),
+                "host": self.host,
+                "time": started + "Z",
+                "check": name,
+                "resource": _report_text(resource),
+                "action": action,
+                "before": before,
+                "after": self._state(path),
+                "duration": duration,
+                "bytes": frame[0],
+                "error": _report_text(frame[1]),
+                })
+
+    def _state(self, path):
+        if path == None:
+            return None
+        try:
+            st = _fs().lstat(path)
+        except EnvironmentError:
+            return None
+        if stat.S_ISREG(st.st_mode):
+            file_type = "file"
+        elif stat.S_ISDIR(st.st_mode):
+            file_type = "directory"
+        elif stat.S_ISLNK(st.st_mode):
+            file_type = "symlink"
+        else:
+            file_type = "other"
+        return {"type": file_type, "mode": "%04o" % stat.S_IMODE(st.st_mode),
+                "uid": st.st_uid, "gid": st.st_gid, "size": st.st_size,
+                "mtime": st.st_mtime}
+
+    def error(self, message, args):
+        """Record an error logged by the innermost check in progress.
+        """
+        if self.frames and self.frames[-1][1] == None \
+                and os.getpid() == self.pid:
+            if args:
+                message = message % args
+            self.frames[-1][1] = message
+
+    def add_bytes(self, n_bytes):
+        """Count n_bytes of file data copied by the innermost check in
+        progress.
+        """
+        if self.frames:
+            self.frames[-1][0] = self.frames[-1][0] + n_bytes
+
+    def _writer(self):
+        # after an error, keep taking events off the queue (and drop
+        # them), so that checks are never blocked by a full queue
+        while True:
+            event = self.queue.get()
+            if event == None:
+                break
+            if self.write_error != None:
+                self.dropped = self.dropped + 1
+                continue
+            try:
+                self.f.write(self.json.dumps(event, sort_keys = True)
+                             + "\n")
+            except Exception, e:
+                self.write_error = e
+                self.dropped = self.dropped + 1
+        if self.write_error == None:
+            try:
+                self.f.flush()
+            except Exception, e:
+                self.write_error = e
+
+    def stop(self):
+        """Restore the check_* functions and write out the remaining
+        events. An error in writing the report is logged.
+        """
+        module = sys.modules[__name__]
+        for (name, function) in self.originals.items():
+            setattr(module, name, function)
+        self.queue.put(None)
+        self.thread.join()
+        if self.close_file:
+            try:
+                self.f.close()
+            except EnvironmentError, e:
+                if self.write_error == None:
+                    self.write_error = e
+        if self.write_error != None:
+            log(LOG_ERROR, "Error: writing report: %s (%d events not"
+                " written)", self.write_error, self.dropped)
+
+def _report_text(value):
+    """Return value as unicode for a JSON report, replacing bytes that
+    are not UTF-8 (as may occur in filenames).
+    """
+    if isinstance(value, str):
+        return value.decode("utf-8", "replace")
+    return value
+
+def _parse_mode(name, mode):
+    """Convert permissions or a mask given as an octal string or an
+    integer to an integer, or None if mode is None.
+    """
+    if isinstance(mode, str):
+        try:
+            return int(mode, 8)
+        except ValueError:
+            pass
+    elif mode == None or isinstance(mode, int):
+        return mode
+    raise PysysconfError("Bad " + name + " specificiation: " + str(mode))
+
+def _stat_spec_arg(spec, uid = None, gid = None, perm = None, umask = None,
+                   dmask = None, se_context = None, se_user = None,
+                   se_role = None, se_type = None, se_level = None):
+    """Return the stat_spec for a check_* call, which is spec if it is
+    not None (in which case no other settings may be given), and
+    otherwise one made from the other arguments.
+    """
+    settings = (uid, gid, perm, umask, dmask, se_context, se_user,
+                se_role, se_type, se_level)
+    if spec != None:
+        if settings != (None,) * len(settings):
+            raise PysysconfError("Cannot specify spec simultaneously"
+                                 " with ownership, permissions, or"
+                                 " SELinux settings.")
+        return spec
+    if settings == (None,) * len(settings):
+        return _DEFAULT_STAT_SPEC
+    return stat_spec(*settings)
+
+def _fs():
+    """Return the filesystem_backend object to use: filesystem if it is
+    set, otherwise the real filesystem.
+    """
+    if filesystem == None:
+        return _REAL_FILESYSTEM
+    return filesystem
+
+def _package_backend():
+    """Return the package_db object to use for package queries:
+    package_backend if it is set, otherwise an rpm_package_db that is
+    created on first use and kept for the rest of the run.
+    """
+    global _default_package_backend
+    if package_backend != None:
+        return package_backend
+    if _default_package_backend == None:
+        _default_package_backend = rpm_package_db()
+    return _default_package_backend
+
+def _parse_rpm_spec(rpm_spec):
+    """Split a package name with an optional version constraint.
+
+    rpm_spec : string
+        Package name, optionally followed by an operator and a
+        version, such as "openssl >= 1.0.0j-1".
+
+    return : tuple (name, op, evr)
+        The package name, the operator (one of <, <=, =, >=, >, or
+        None if there is no constraint), and the (epoch, version,
+        release) tuple of the version (or None).
+    """
+    words = rpm_spec.split()
+    if len(words) == 1:
+        return (words[0], None, None)
+    if len(words) == 3 and words[1] in ("<", "<=", "=", "==", ">=", ">"):
+        op = words[1]
+        if op == "==":
+            op = "="
+        return (words[0], op, _parse_evr(words[2]))
+    raise PysysconfError("invalid package specification \""
+                         + rpm_spec + "\"")
+
+def _rpm_target(name, evr, arch = None):
+    """Return the package name for yum of version evr (an (epoch,
+    version, release) tuple) of the package name, as
+    "name-[epoch:]version[-release][.arch]".
+    """
+    target = name + "-" + evr[1]
+    if evr[0] != 0:
+        target = name + "-" + str(evr[0]) + ":" + evr[1]
+    if evr[2] != None:
+        target = target + "-" + evr[2]
+    if arch != None:
+        target = target + "." + arch
+    return target
+
+def _split_rpm_arch(name):
+    """Split a package name "name.arch" into a tuple (name, arch), if
+    arch is a known architecture, otherwise return (name, None).
+    """
+    if "." in name:
+        (base, arch) = name.rsplit(".", 1)
+        if arch in _RPM_ARCHES:
+            return (base, arch)
+    return (name, None)
+
+def _resolve_rpm_name(backend, name):
+    """Interpret a package name as rpm -q does, as one of NAME,
+    NAME.ARCH, NAME-VERSION, NAME-VERSION-RELEASE, or
+    NAME-VERSION-RELEASE.ARCH, taking the first form whose NAME is
+    installed.
+
+    return : tuple (name, arch, evr)
+        The package NAME, the architecture (or None), and the
+        (epoch, version, release) tuple that name gives (or None).
+        If no form names an installed package, (name, None, None).
+    """
+    if backend.installed(name):
+        return (name, None, None)
+    forms = [(name, None)]
+    (base, arch) = _split_rpm_arch(name)
+    if arch != None:
+        forms.insert(0, (base, arch))
+    for (form, form_arch) in forms:
+        if backend.installed(form, form_arch):
+            return (form, form_arch, None)
+        for parts in (form.rsplit("-", 2), form.rsplit("-", 1)):
+            if len(parts) > 1 and parts[1][:1].isdigit() \
+                    and backend.installed(parts[0], form_arch):
+                evr = _parse_evr(parts[1])
+                if len(parts) == 3:
+                    evr = (evr[0], evr[1], parts[2])
+                return (parts[0], form_arch, evr)
+    return (name, None, None)
+
+def _rpm_spec_installed(backend, name, op, evr):
+    """Return whether an installed package satisfies the package name
+    (in any of the forms accepted by _resolve_rpm_name()) and the
+    version constraint op, evr.
+    """
+    (name, arch, name_evr) = _resolve_rpm_name(backend, name)
+    installed = backend.installed(name, arch)
+    if name_evr != None and not _rpm_matches(installed, "=", name_evr):
+        return False
+    return _rpm_matches(installed, op, evr)
+
+def _parse_evr(evr):
+    """Split a version string "[epoch:]version[-release]" into a tuple
+    (epoch, version, release). The epoch is an integer (0 if it is not
+    given) and the release is None if it is not given.
+    """
+    epoch = 0
+    version = evr
+    if ":" in version:
+        (epoch_str, version) = version.split(":", 1)
+        try:
+            epoch = int(epoch_str)
+        except ValueError:
+            raise PysysconfError("invalid epoch in version " + evr)
+    release = None
+    if "-" in version:
+        (version, release) = version.rsplit("-", 1)
+    return (epoch, version, release)
+
+def _rpm_matches(installed, op, evr):
+    """Return whether any of the installed versions satisfies a
+    version constraint.
+
+    installed : list of (epoch, version, release) tuples
+        Installed versions of a package.
+
+    op, evr :
+        Constraint, as returned by _parse_rpm_spec().
+    """
+    if op == None:
+        return len(installed) > 0
+    for inst_evr in installed:
+        c = _evr_compare(inst_evr, evr)
+        if (c < 0 and op in ("<", "<=")) or (c == 0 and "=" in op) \
+                or (c > 0 and op in (">", ">=")):
+            return True
+    return False
+
+def _evr_compare(evr_a, evr_b):
+    """Compare two (epoch, version, release) tuples as rpm does,
+    returning -1, 0, or 1. The releases are only compared if both are
+    given.
+    """
+    if evr_a[0] != evr_b[0]:
+        return cmp(evr_a[0], evr_b[0])
+    c = _rpm_vercmp(evr_a[1], evr_b[1])
+    if c != 0 or evr_a[2] == None or evr_b[2] == None:
+        return c
+    return _rpm_vercmp(evr_a[2], evr_b[2])
+
+def _rpm_vercmp(a, b):
+    """Compare two version (or release) strings with the algorithm of
+    rpmvercmp(), returning -1, 0, or 1.
+
+    The strings are split into runs of digits and of letters, which
+    are compared in turn: digits numerically, letters as strings, and
+    digits are newer than letters. A "~" sorts before anything, even
+    the end of the string, and a "^" sorts after the end of the
+    string but before anything else.
+    """
+    if a == b:
+        return 0
+    segs_a = _RPM_SEGMENT.findall(a)
+    segs_b = _RPM_SEGMENT.findall(b)
+    i = 0
+    while True:
+        seg_a = None
+        seg_b = None
+        if i < len(segs_a):
+            seg_a = segs_a[i]
+        if i < len(segs_b):
+            seg_b = segs_b[i]
+        i = i + 1
+        if seg_a == "~" or seg_b == "~":
+            if seg_a != "~":
+                return 1
+            if seg_b != "~":
+                return -1
+            continue
+        if seg_a == "^" or seg_b == "^":
+            if seg_a == None:
+                return -1
+            if seg_b == None:
+                return 1
+            if seg_a != "^":
+                return 1
+            if seg_b != "^":
+                return -1
+            continue
+        if seg_a == None or seg_b == None:
+            break
+        if seg_a.isdigit() != seg_b.isdigit():
+            if seg_a.isdigit():
+                return 1
+            return -1
+        if seg_a.isdigit():
+            c = cmp(int(seg_a), int(seg_b))
+        else:
+            c = cmp(seg_a, seg_b)
+        if c != 0:
+            return c
+    if seg_a == None and seg_b == None:
+        return 0
+    if seg_a == None:
+        return -1
+    return 1
+
+def _selinux():
+    """Return the selinux module, importing it on first use, or None
+    if it is not available.
+    """
+    global _selinux_module
+    if _selinux_module == False:
+        try:
+            import selinux
+            _selinux_module = selinux
+        except ImportError:
+            _selinux_module = None
+    return _selinux_module
+
+def _scandir():
+    """Return the scandir() function from the scandir module, importing
+    it on first use, or None if it is not available.
+    """
+    global _scandir_function
+    if _scandir_function == False:
+        try:
+            import scandir
+            _scandir_function = scandir.scandir
+        except ImportError:
+            _scandir_function = None
+    return _scandir_function
+
+def _root_path(path):
+    """Return the name of path within the current root directory. The
+    directories leading to it are resolved with _root_realpath(), so
+    that absolute symlinks among them (such as /var/run -> /run in a
+    disk image) point into root rather than out to the host. The last
+    component is not resolved.
+
+    path : string
+        Pathname. Only absolute pathnames are changed.
+
+    Raises PysysconfError if the directories lead outside root.
+    """
+    if root == None or not os.path.isabs(path):
+        return path
+    (parent, name) = os.path.split(os.path.join(root, path.lstrip("/")))
+    return os.path.join(_root_realpath(parent), name)
+
+def _root_realpath(path):
+    """Return path with all symlinks resolved, as os.path.realpath()
+    does, but treating the current root directory as / (so that the
+    absolute symlinks in a disk image point into the image).
+
+    path : string
+        Pathname, already within root (as returned by _root_path()).
+
+    Raises PysysconfError if path, or a symlink it passes through,
+    leads outside root.
+    """
+    if root == None:
+        return os.path.realpath(path)
+    top = os.path.abspath(root)
+    rel_path = os.path.relpath(os.path.abspath(path), top)
+    if rel_path == ".." or rel_path.startswith("../"):
+        raise PysysconfError(path + " is not within root " + root)
+    parts = rel_path.split("/")
+    resolved = []
+    n_links = 0
+    while parts:
+        part = parts.pop(0)
+        if part in ("", "."):
+            continue
+        if part == "..":
+            if not resolved:
+                raise PysysconfError(path + " leads outside root " + root)
+            resolved.pop()
+            continue
+        name = os.path.join(top, *(resolved + [part]))
+        if not os.path.islink(name):
+            resolved.append(part)
+            continue
+        n_links = n_links + 1
+        if n_links > 40:
+            raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), path)
+        target = os.readlink(name)
+        if target.startswith("/"):
+            resolved = []
+        parts = target.split("/") + parts
+    return os.path.join(top, *resolved)
+
+def _run_roots_init(source_digests):
+    """Initialize a process used by run_roots().
+    """
+    global _source_digests
+    _source_digests = source_digests
+
+def _run_root(args):
+    """Apply a policy to one root in a process used by run_roots().
+
+    args : (function, string) tuple
+        The policy and the root directory.
+
+    return : string or None
+        Description of the exception raised by the policy, if any.
+    """
+    global root
+    (policy, root) = args
+    try:
+        policy()
+    except Exception, e:
+        return "%s: %s" % (e.__class__.__name__, e)
+    finally:
+        wait_for_removals()
+    return None
+
+def _source_digest(src, src_stat, hash_name = "sha1", digest = None):
+    """Return the digest of the source file src, caching it by the
+    stat data of src so that it is read at most once per run (or once
+    across all processes of run_roots()).
+
+    src : string
+        Filename of the source file.
+
+    src_stat : stat result
+        Result of os.lstat(src).
+
+    hash_name : string
+        (optional: default = "sha1")
+        Name of the hashlib algorithm to use.
+
+    digest : string or None
+        (optional: default = None)
+        If not None, the digest of src, which was computed while it
+        was read for some other purpose. It is stored in the cache
+        and returned.
+    """
+    key = (os.path.abspath(src), src_stat.st_dev, src_stat.st_ino,
+           src_stat.st_size, src_stat.st_mtime, src_stat.st_ctime)
+    if hash_name != "sha1":
+        key = key + (hash_name,)
+    if digest == None:
+        digest = _source_digests.get(key)
+    if digest == None:
+        digest = _file_digest(src, hash_name)
+    _source_digests[key] = digest
+    return digest
+
+def _file_digest(path, hash_name = "sha1"):
+    """Return the digest of the contents of the file path with the
+    hashlib algorithm hash_name (SHA-1 by default), as a hexadecimal
+    string.
+
+    Files of at least large_file_size bytes in the real filesystem are
+    read by _large_file_digest() instead.
+    """
+    import hashlib
+    fs = _fs()
+    h = hashlib.new(hash_name)
+    native_path = fs.native_path(path)
+    if large_file_size != None and native_path != None \
+            and os.stat(native_path).st_size >= large_file_size:
+        _large_file_digest(native_path, h)
+        return h.hexdigest()
+    f = fs.open(path, "rb")
+    try:
+        while True:
+            buf = f.read(65536)
+            if not buf:
+                break
+            h.update(buf)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+def _tree_fingerprint(path, extra = ""):
+    """Compute a fingerprint of the stat data of path and, if it is a
+    directory, of everything below it. Any change to the contents,
+    ownership, permissions, or SELinux context of an object changes
+    its ctime and hence the fingerprint.
+
+    path : string
+        Name of object to fingerprint. Need not exist.
+
+    extra : string
+        (optional: default = "")
+        Additional data to include in the fingerprint.
+
+    return : string
+        The fingerprint, as a hexadecimal digest.
+    """
+    import hashlib
+    fs = _fs()
+    h = hashlib.sha1(extra)
+    pending = [""]
+    while pending:
+        rel_name = pending.pop()
+        try:
+            st = fs.lstat(os.path.join(path, rel_name))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            h.update("%r missing\n" % rel_name)
+            continue
+        h.update("%r %o %d %d %d %d %r %r\n"
+                 % (rel_name, st.st_mode, st.st_uid, st.st_gid, st.st_size,
+                    st.st_ino, st.st_mtime, st.st_ctime))
+        if stat.S_ISDIR(st.st_mode):
+            entries = fs.listdir(os.path.join(path, rel_name))
+            entries.sort(reverse = True)
+            pending.extend([os.path.join(rel_name, f) for f in entries])
+    return h.hexdigest()
+
+def _state_connection():
+    """Return the connection to the state database in state_db,
+    opening and initializing it if necessary.
+    """
+    global _state_conn, _state_conn_name
+    if _state_conn == None or _state_conn_name != state_db:
+        import sqlite3
+        _state_conn = sqlite3.connect(state_db)
+        _state_conn_name = state_db
+        _state_conn.execute("PRAGMA synchronous = NORMAL")
+        _state_conn.execute("CREATE TABLE IF NOT EXISTS state"
+                            " (resource TEXT PRIMARY KEY, inputs TEXT,"
+                            " observed TEXT, time REAL)")
+        _state_conn.execute("CREATE TABLE IF NOT EXISTS expiry"
+                            " (dir BLOB, test TEXT, mtime REAL,"
+                            " ctime REAL, next_expiry REAL, subdirs BLOB,"
+                            " PRIMARY KEY (dir, test))")
+    return _state_conn
+
+def _state_unchanged(resource, inputs, dst):
+    """Test whether resource was last converged with the same inputs,
+    and dst has not changed since then.
+
+    resource : string
+        Name identifying the resource.
+
+    inputs : string
+        Fingerprint of the source and arguments of the check.
+
+    dst : string
+        Destination object of the check.
+
+    return : boolean
+        Returns True if the check can be skipped.
+    """
+    if force_full_run:
+        return False
+    row = _state_connection().execute("SELECT inputs, observed FROM state"
+                                      " WHERE resource = ?",
+                                      (resource,)).fetchone()
+    if row == None or row[0] != inputs:
+        return False
+    return row[1] == _tree_fingerprint(dst)
+
+def _state_record(resource, inputs, observed):
+    """Record that resource was successfully converged.
+
+    resource : string
+        Name identifying the resource.
+
+    inputs : string
+        Fingerprint of the source and arguments of the check.
+
+    observed : string
+        Fingerprint of the destination after convergence.
+    """
+    conn = _state_connection()
+    conn.execute("INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)",
+                 (resource, inputs, observed, time.time()))
+    conn.commit()
+
+class _expiry_index:
+    """Record in state_db of when the entries of each directory are next
+    due to be removed by a test, as used by _remove_by_test().
+
+    Directories are identified by their absolute pathnames, and each
+    row holds the mtime and ctime of the directory when its entries
+    were last tested, the earliest time any entry left in it is due
+    (NULL if none ever will be), and the names of the subdirectories
+    visited below it.
+
+    test_key : string
+        Identifies the test and filter, so that checks with different
+        tests keep separate records.
+    """
+    def __init__(self, test_key):
+        import sqlite3
+        self.binary = sqlite3.Binary
+        self.conn = _state_connection()
+        self.test_key = test_key
+        self.now = time.time()
+
+    def get(self, dir_name):
+        """Return the record of dir_name as a tuple (mtime, ctime,
+        next_expiry, subdirs), or None if there is none or
+        force_full_run is set.
+        """
+        if force_full_run:
+            return None
+        row = self.conn.execute("SELECT mtime, ctime, next_expiry, subdirs"
+                                " FROM expiry WHERE dir = ? AND test = ?",
+                                (self.binary(os.path.abspath(dir_name)),
+                                 self.test_key)).fetchone()
+        if row == None:
+            return None
+        subdirs = []
+        if row[3]:
+            subdirs = str(row[3]).split("\0")
+        return (row[0], row[1], row[2], subdirs)
+
+    def put(self, dir_name, dir_stat, next_expiry, subdirs):
+        """Record that the entries of dir_name were tested when it had
+        the stat data dir_stat.
+
+        If dir_name changed within _TIMESTAMP_GRANULARITY seconds of
+        the start of the check, an entry may have been added since it
+        was listed without changing its mtime or ctime, so (as git does
+        for racily clean files) the record is marked as due at once.
+        """
+        if max(dir_stat.st_mtime, dir_stat.st_ctime) \
+                >= self.now - _TIMESTAMP_GRANULARITY:
+            next_expiry = 0.0
+        self.conn.execute("INSERT OR REPLACE INTO expiry"
+                          " VALUES (?, ?, ?, ?, ?, ?)",
+                          (self.binary(os.path.abspath(dir_name)),
+                           self.test_key, dir_stat.st_mtime,
+                           dir_stat.st_ctime, next_expiry,
+                           self.binary("\0".join(subdirs))))
+
+    def forget(self, dir_name):
+        """Delete the records of dir_name and everything below it.
+        """
+        dir_name = os.path.abspath(dir_name)
+        # names below dir_name sort between dir_name + "/" and
+        # dir_name + "0", the character after "/"
+        self.conn.execute("DELETE FROM expiry WHERE test = ? AND"
+                          " (dir = ? OR (dir > ? AND dir < ?))",
+                          (self.test_key, self.binary(dir_name),
+                           self.binary(dir_name + "/"),
+                           self.binary(dir_name + "0")))
+
+    def commit(self):
+        self.conn.commit()
+
+def _copy_file_data(src, dst, hash_name = None):
+    """Do an actual file copy from src to dst.
 
     src : string
         Filename to copy from. Must exist and be a regular file.
 
     dst : string
         Filename to copy to.
+
+    hash_name : string or None
+        (optional: default = None)
+        If not None, the name of a hashlib algorithm with which to
+        hash the data as it is copied.
+
+    return : string or None
+        The digest of the data copied, if hash_name was given and the
+        file was copied in a single stream, otherwise None.
+
+    Files of at least large_file_size bytes in the real filesystem are
+    copied by _copy_large_file_data() instead.
     """
+    fs = _fs()
+    native_src = fs.native_path(src)
+    native_dst = fs.native_path(dst)
+    if large_file_size != None and native_src != None \
+            and native_dst != None:
+        size = os.stat(native_src).st_size
+        if size >= large_file_size:
+            _copy_large_file_data(native_src, native_dst)
+            if _active_report != None:
+                _active_report.add_bytes(size)
+            return None
+    h = None
+    if hash_name != None:
+        import hashlib
+        h = hashlib.new(hash_name)
     fsrc = None
     fdst = None
+    n_bytes = 0
     try:
-        fsrc = open(src, 'r')
-        fdst = open(dst, 'w')
+        fsrc = fs.open(src, 'r')
+        if h != None:
+            src_stat = fs.lstat(src)
+        fdst = fs.open(dst, 'w')
         while True:
             buf = fsrc.read(8192)
             if not buf:
                 break
+            if h != None:
+                h.update(buf)
             fdst.write(buf)
+            n_bytes = n_bytes + len(buf)
     finally:
         if fdst:
             fdst.close()
         if fsrc:
             fsrc.close()
+        if _active_report != None:
+            _active_report.add_bytes(n_bytes)
+    if h == None:
+        return None
+    return _source_digest(src, src_stat, hash_name, h.hexdigest())
+
+def _copy_large_file_data(src, dst):
+    """Copy a large file from src to dst, preserving holes, without
+    filling the page cache.
+
+    Only the data regions of src (found with SEEK_DATA and SEEK_HOLE)
+    are copied, and the blocks for each are allocated in dst with
+    fallocate() before writing. The kernel is told that src is read
+    sequentially, and every _LARGE_FILE_FLUSH bytes both files are
+    written back and dropped from the page cache with posix_fadvise().
 
-def _chkstat(dst, uid, gid, perm, se_context,
-             se_user, se_role, se_type, se_level):
-    """Check the uid, gid, and permissions of dst.
+    src : string
+        Filename to copy from. Must exist and be a regular file.
 
     dst : string
-        Filename of object to check.
+        Filename to copy to.
+    """
+    fsrc = os.open(src, os.O_RDONLY)
+    try:
+        size = os.fstat(fsrc).st_size
+        fdst = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+        try:
+            _fadvise(fsrc, 0, 0, _POSIX_FADV_SEQUENTIAL)
+            unflushed = 0
+            for (start, end) in _data_regions(fsrc, size):
+                _fallocate(fdst, start, end - start)
+                os.lseek(fsrc, start, os.SEEK_SET)
+                os.lseek(fdst, start, os.SEEK_SET)
+                pos = start
+                while pos < end:
+                    buf = os.read(fsrc, min(1024 * 1024, end - pos))
+                    if not buf:
+                        break
+                    pos = pos + len(buf)
+                    unflushed = unflushed + len(buf)
+                    while buf:
+                        buf = buf[os.write(fdst, buf):]
+                    if unflushed >= _LARGE_FILE_FLUSH:
+                        os.fdatasync(fdst)
+                        _fadvise(fsrc, 0, pos, _POSIX_FADV_DONTNEED)
+                        _fadvise(fdst, 0, pos, _POSIX_FADV_DONTNEED)
+                        unflushed = 0
+            os.ftruncate(fdst, size)
+            os.fdatasync(fdst)
+            _fadvise(fdst, 0, 0, _POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fdst)
+        _fadvise(fsrc, 0, 0, _POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fsrc)
 
-    uid : string, integer, or None
-        Username (if a string) or UID (if an int) that should
-        own the dst object. If None, then the uid of dst is
-        not changed.
+def _large_file_digest(path, h):
+    """Update the hashlib object h with the contents of a large file,
+    without filling the page cache. As in _copy_large_file_data(), the
+    kernel is told that the file is read sequentially, and every
+    _LARGE_FILE_FLUSH bytes what has been read is dropped from the
+    page cache.
 
-    gid : string, integer, or None
-        Groupname, GID, or None, as for uid.
+    path : string
+        Filename to read. Must exist and be a regular file.
 
-    perm : string, integer, or None
-        Permissions of dst. Can be a string containing an octal
-        number, such as "0644", or an integer containing the
-        same value, such as 0644. If None, then the permissions
-        of dst are not changed.
+    h : hashlib object
+        Hash to update with the data read.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        _fadvise(fd, 0, 0, _POSIX_FADV_SEQUENTIAL)
+        pos = 0
+        unflushed = 0
+        while True:
+            buf = os.read(fd, 1024 * 1024)
+            if not buf:
+                break
+            h.update(buf)
+            pos = pos + len(buf)
+            unflushed = unflushed + len(buf)
+            if unflushed >= _LARGE_FILE_FLUSH:
+                _fadvise(fd, 0, pos, _POSIX_FADV_DONTNEED)
+                unflushed = 0
+        _fadvise(fd, 0, 0, _POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def _data_regions(fd, size):
+    """Iterate over the regions of the open file fd that contain data,
+    as (start, end) offsets. If the filesystem cannot report holes,
+    the whole file is treated as data.
+    """
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, _SEEK_DATA)
+        except OSError, e:
+            if e.errno == errno.ENXIO:
+                return
+            if e.errno == errno.EINVAL:
+                yield (pos, size)
+                return
+            raise
+        end = min(os.lseek(fd, start, _SEEK_HOLE), size)
+        yield (start, end)
+        pos = end
+
+def _libc_function(name):
+    """Return the named function from the C library, or None if it is
+    not available.
+    """
+    if name not in _libc_functions:
+        try:
+            import ctypes, ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                               use_errno = True)
+            function = getattr(libc, name)
+            function.argtypes = [ctypes.c_int, ctypes.c_int,
+                                 ctypes.c_int64, ctypes.c_int64]
+            if name == "posix_fadvise64":
+                function.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                     ctypes.c_int64, ctypes.c_int]
+            _libc_functions[name] = function
+        except (ImportError, OSError, AttributeError):
+            _libc_functions[name] = None
+    return _libc_functions[name]
+
+def _fadvise(fd, offset, length, advice):
+    """Give the kernel advice about the use of part of an open file, as
+    for posix_fadvise(). Does nothing if this is not supported.
+    """
+    function = _libc_function("posix_fadvise64")
+    if function != None:
+        function(fd, offset, length, advice)
+
+def _fallocate(fd, offset, length):
+    """Allocate blocks for part of an open file, as for fallocate().
+    Does nothing if this is not supported by the filesystem.
+    """
+    function = _libc_function("fallocate64")
+    if function != None and length > 0:
+        function(fd, 0, offset, length)
+
+def _chkstat(dst, uid, gid, perm, spec, dst_stat = None):
+    """Check the uid, gid, permissions, and SELinux context of dst.
+
+    dst : string
+        Filename of object to check.
 
-    se_context : string or None
-        SELinux context given as a string "user:role:type:level". If
-        se_context is not None then all of se_user, se_role, se_type,
-        and se_level must be None. If se_context is None then the
-        context of dst is not changed (except possibly by se_user,
-        se_role, se_type, or se_level).
+    uid : string, integer, or None
+        Username (if a string) or UID (if an int) that should
+        own the dst object. If None, then the uid of dst is
+        not changed.
 
-    se_user : string or None
-        SELinux context user as a string. Cannot be specified
-        simultaneously with se_context. If None, then the user
-        component of the context of dst is not changed (except
-        possibly by se_context).
+    gid : string, integer, or None
+        Groupname, GID, or None, as for uid.
 
-    se_role : string or None
-        SELinux context role as a string. Cannot be specified
-        simultaneously with se_context. If None, then the role
-        component of the context of dst is not changed (except
-        possibly by se_context).
+    perm : integer or None
+        Permissions of dst. If None, then the permissions of dst are
+        not changed.
 
-    se_type : string or None
-        SELinux context type as a string. Cannot be specified
-        simultaneously with se_context. If None, then the type
-        component of the context of dst is not changed (except
-        possibly by se_context).
+    spec : stat_spec object
+        Settings of the check, of which only the SELinux fields are
+        used (uid, gid, and perm are given separately as they may be
+        taken from a source object instead).
 
-    se_level : string or None
-        SELinux context level as a string. Cannot be specified
-        simultaneously with se_context. If None, then the level
-        component of the context of dst is not changed (except
-        possibly by se_context).
+    dst_stat : stat result or None
+        (optional: default = None)
+        Result of os.lstat(dst), if the caller already has it.
 
     return : boolean
         Returns True if an attributed of dst was changed, otherwise
         False.
     """
-    if (se_context != None) \
-            and ((se_user != None) or (se_role != None) \
-                     or (se_type != None) or (se_level != None)):
-        raise PysysconfError("Cannot specify se_context"
-                             " simultaneously with any of se_user,"
-                             " se_role, se_type, or se_level.")
-    dst_stat = os.lstat(dst)
+    fs = _fs()
+    if dst_stat == None:
+        dst_stat = fs.lstat(dst)
     dst_mode = dst_stat.st_mode
     dst_uid = dst_stat.st_uid
     dst_gid = dst_stat.st_gid
     dst_perm = stat.S_IMODE(dst_mode)
-    if (se_context != None) or (se_user != None) \
-            or (se_role != None) or (se_type != None) \
-            or (se_level != None):
-        if not _HAVE_SELINUX_MODULE:
+    if spec.has_selinux:
+        selinux = _selinux()
+        if selinux == None:
             raise PysysconfError("SELinux properties specified but"
                                  " no selinux module was imported.")
-        dst_se_context = selinux.lgetfilecon(dst)[1]
+        native_dst = fs.native_path(dst)
+        if native_dst == None:
+            raise PysysconfError("SELinux properties specified for "
+                                 + dst + ", which is not in the real"
+                                 " filesystem")
+        dst_se_context = selinux.lgetfilecon(native_dst)[1]
         if dst_se_context == None:
             raise PysysconfError("Error getting current SELinux"
                                  " context for file %s" % dst)
@@ -1378,43 +4839,41 @@ def _chkstat(dst, uid, gid, perm, se_context,
     did_action = False
     if uid != None:
         if isinstance(uid, str):
-            uid = pwd.getpwnam(uid)[2]
-        if not isinstance(uid, int):
-            raise PysysconfError("Bad uid specificiation: " + str(uid))
+            uid = _lookup_uid(uid)
         if uid != dst_uid:
             need_chown = True
     else:
-        uid = dst_uid
+        uid = -1
     if gid != None:
         if isinstance(gid, str):
-            gid = grp.getgrnam(gid)[2]
-        if not isinstance(gid, int):
-            raise PysysconfError("Bad gid specificiation: " + str(uid))
+            gid = _lookup_gid(gid)
         if gid != dst_gid:
             need_chown = True
     else:
-        gid = dst_gid
+        gid = -1
     if need_chown:
-        log(LOG_ACTION, "Changing uid of " + dst + " to (" \
-            + str(uid) + ", " + str(gid) + ")")
-        os.chown(dst, uid, gid)
+        _log_item(LOG_ACTION, "changed the owner of",
+                  "Changing uid of %s to (%s, %s)", dst, uid, gid)
+        fs.chown(dst, uid, gid)
         did_action = True
     if perm != None:
-        if isinstance(perm, str):
-            perm = int(perm, 8)
-        if not isinstance(perm, int):
-            raise PysysconfError("Bad perm specificiation: " + str(perm))
         if dst_perm != perm:
-            log(LOG_ACTION, "Changing permissions of %s from %o to %o" \
-				% (dst, dst_perm, perm))
+            _log_item(LOG_ACTION, "changed the permissions of",
+                      "Changing permissions of %s from %o to %o",
+                      dst, dst_perm, perm)
             try:
-                os.chmod(dst, perm)
+                fs.chmod(dst, perm)
                 did_action = True
             except OSError, e:
                 raise PysysconfError("Could not chmod " + dst + " to " + str(perm))
-    if (se_user != None) or (se_role != None) \
-            or (se_type != None) or (se_level != None):
+    se_context = spec.se_context
+    if (spec.se_user != None) or (spec.se_role != None) \
+            or (spec.se_type != None) or (spec.se_level != None):
         dst_se_context_elems = dst_se_context.split(":")
+        se_user = spec.se_user
+        se_role = spec.se_role
+        se_type = spec.se_type
+        se_level = spec.se_level
         if se_user == None:
             se_user = dst_se_context_elems[0]
         if se_role == None:
@@ -1425,17 +4884,15 @@ def _chkstat(dst, uid, gid, perm, se_context,
             se_level = ":".join(dst_se_context_elems[3:])
         se_context = ":".join([se_user, se_role, se_type, se_level])
     if se_context != None:
-        if not isinstance(se_context, str):
-            raise PysysconfError("Bad se_context specification: " + str(se_context))
         if dst_se_context != se_context:
-            log(LOG_ACTION, "Changing SELinux context of %s from %s to %s"
-                % (dst, dst_se_context, se_context))
-        selinux.lsetfilecon(dst, se_context)
-        did_action = True
+            _log_item(LOG_ACTION, "changed the SELinux context of",
+                      "Changing SELinux context of %s from %s to %s",
+                      dst, dst_se_context, se_context)
+            selinux.lsetfilecon(native_dst, se_context)
+            did_action = True
     return did_action
 
-def _chkstatsrc(src, dst, uid, gid, perm, umask, dmask,
-                se_context, se_user, se_role, se_type, se_level):
+def _chkstatsrc(src, dst, spec, src_stat = None, dst_stat = None):
     """Ensure that the stat data for dst matches that for src and
     change the SELinux context if specified.
 
@@ -1445,94 +4902,169 @@ def _chkstatsrc(src, dst, uid, gid, perm, umask, dmask,
     dst : string
         Filename of the destination object.
 
-    uid : string, integer, or None
-        Username (if a string) or UID (if an int) that should own the
-        dst object. If uid is None then the uid of dst is required to
-        be the same as that of src, masked by umask (if not None).
-
-    gid : string, integer, or None
-        Groupname, GID, or None, as for uid.
-
-    perm : string, integer, or None
-        Permissions of dst. Can be a string containing an octal
-        number, such as "0644", or an integer containing the same
-        value, such as 0644. If None, then the permissions of dst will
-        be the same as those of src, masked by umask (if src is a
-        file) or dmask (if src is a directory).
-
-    umask : string, integer, or None
-        Mask for permissions of dst for the case that src is not a
-        directory. Will be applied to perm if it is not None,
-        otherwise will be applied to the permissions of src. The
-        format is the same as that of perm.
-
-    dmask : string, integer, or None
-        Mask for permissions of dst for the case that src is a
-        directory, as for umask.
-
-    se_context : string or None
-        SELinux context given as a string "user:role:type:level". If
-        se_context is not None then all of se_user, se_role, se_type,
-        and se_level must be None. If se_context is None then the
-        context of dst is not changed (except possibly by se_user,
-        se_role, se_type, or se_level).
-
-    se_user : string or None
-        SELinux context user as a string. Cannot be specified
-        simultaneously with se_context. If None, then the user
-        component of the context of dst is not changed (except
-        possibly by se_context).
-
-    se_role : string or None
-        SELinux context role as a string. Cannot be specified
-        simultaneously with se_context. If None, then the role
-        component of the context of dst is not changed (except
-        possibly by se_context).
+    spec : stat_spec object
+        Settings of the check. Where its uid, gid, or perm is None,
+        that of src is used instead, with the permissions masked by
+        umask (if src is not a directory) or dmask (if src is a
+        directory).
 
-    se_type : string or None
-        SELinux context type as a string. Cannot be specified
-        simultaneously with se_context. If None, then the type
-        component of the context of dst is not changed (except
-        possibly by se_context).
+    src_stat : stat result or None
+        (optional: default = None)
+        Result of os.lstat(src), if the caller already has it.
 
-    se_level : string or None
-        SELinux context level as a string. Cannot be specified
-        simultaneously with se_context. If None, then the level
-        component of the context of dst is not changed (except
-        possibly by se_context).
+    dst_stat : stat result or None
+        (optional: default = None)
+        Result of os.lstat(dst), if the caller already has it.
 
     return : boolean
         Returns True if an attributed of dst was changed, otherwise
         False.
     """
-    src_stat = os.lstat(src)
+    fs = _fs()
+    if src_stat == None:
+        src_stat = fs.lstat(src)
     src_mode = src_stat.st_mode
-    src_uid = src_stat.st_uid
-    src_gid = src_stat.st_gid
-    src_perm = stat.S_IMODE(src_mode)
+    uid = spec.uid
     if uid == None:
-        uid = src_uid
+        uid = src_stat.st_uid
+    gid = spec.gid
     if gid == None:
-        gid = src_gid
+        gid = src_stat.st_gid
+    perm = spec.perm
     if perm == None:
+        perm = stat.S_IMODE(src_mode)
         if stat.S_ISDIR(src_mode):
-            if dmask == None:
-                perm = src_perm
-            else:
-                perm = src_perm & dmask
+            if spec.dmask != None:
+                perm = perm & spec.dmask
         else:
-            if umask == None:
-                perm = src_perm
-            else:
-                perm = src_perm & umask
-    return _chkstat(dst, uid, gid, perm, se_context, se_user,
-                    se_role, se_type, se_level)
+            if spec.umask != None:
+                perm = perm & spec.umask
+    return _chkstat(dst, uid, gid, perm, spec, dst_stat)
+
+def _lookup_uid(name):
+    """Return the UID for the username name, caching the result. If
+    root is set, the user is looked up in the passwd_file within root
+    rather than in the host's user database.
+    """
+    key = (root, name)
+    if key not in _uid_cache:
+        if root == None:
+            _uid_cache[key] = pwd.getpwnam(name)[2]
+        else:
+            _uid_cache[key] = _lookup_account_id(_root_path(passwd_file),
+                                                 name)
+    return _uid_cache[key]
+
+def _lookup_gid(name):
+    """Return the GID for the group name, caching the result, as for
+    _lookup_uid() (using group_file).
+    """
+    key = (root, name)
+    if key not in _gid_cache:
+        if root == None:
+            _gid_cache[key] = grp.getgrnam(name)[2]
+        else:
+            _gid_cache[key] = _lookup_account_id(_root_path(group_file),
+                                                 name)
+    return _gid_cache[key]
+
+def _lookup_account_id(file_name, name):
+    """Return the ID (the third field) of the entry for name in the
+    account database file_name.
+    """
+    for line in _read_account_file(file_name):
+        fields = line.split(":")
+        if fields[0] == name and len(fields) > 2 and fields[2].isdigit():
+            return int(fields[2])
+    raise PysysconfError("No entry for " + name + " in " + file_name)
+
+def _lock_account_files(file_name):
+    """Take the lock used by the shadow utilities (lckpwdf()) before
+    changing the account databases, waiting for up to 15 seconds.
+
+    file_name : string
+        Name of one of the account databases to be changed.
+
+    return : integer
+        File descriptor holding the lock. Closing it releases the lock.
+    """
+    lock_name = os.path.join(os.path.dirname(file_name), ".pwd.lock")
+    fd = os.open(lock_name, os.O_CREAT | os.O_WRONLY, 0600)
+    deadline = time.time() + 15
+    while True:
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES) \
+                    or time.time() > deadline:
+                os.close(fd)
+                raise PysysconfError("unable to lock " + lock_name)
+            time.sleep(0.1)
+
+def _read_account_file(file_name):
+    """Return the lines of an account database (such as /etc/passwd),
+    without trailing newlines.
+    """
+    f = open(file_name)
+    try:
+        return f.read().splitlines()
+    finally:
+        f.close()
 
-def _remove_by_test(dst, test, follow_links = False, backup = True):
+def _write_account_file(file_name, lines, backup):
+    """Atomically replace an account database with the given lines.
+    """
+    log(LOG_ACTION, "Writing " + file_name)
+    contents = "".join([line + "\n" for line in lines])
+    _rewrite_file(file_name, lambda f_in, f_out: f_out.write(contents),
+                  backup)
+
+def _account_index(lines):
+    """Return a dictionary mapping the names in the first field of the
+    lines of an account database to their line numbers.
+    """
+    index = {}
+    for (i, line) in enumerate(lines):
+        name = line.split(":", 1)[0]
+        if name not in index:
+            index[name] = i
+    return index
+
+def _used_ids(lines, n_colons):
+    """Return the set of IDs (third fields) in the lines of an account
+    database, skipping lines with fewer than n_colons colons and those
+    whose ID is not a number (such as NIS compat entries like +::::::).
+    """
+    used_ids = set()
+    for line in lines:
+        if line.count(":") >= n_colons:
+            field = line.split(":")[2]
+            if field.isdigit():
+                used_ids.add(int(field))
+    return used_ids
+
+def _next_free_id(used_ids, system):
+    """Return the lowest UID or GID not in used_ids, in the system
+    range (201 to 999) or the normal range (1000 upwards).
+    """
+    if system:
+        next_id = 201
+    else:
+        next_id = 1000
+    while next_id in used_ids:
+        next_id = next_id + 1
+    if system and next_id >= 1000:
+        raise PysysconfError("No free system UIDs or GIDs")
+    return next_id
+
+def _remove_by_test(dst, test, follow_links = False, backup = True,
+                    keep_at_least = None, path_filter = None, rel_dir = "",
+                    index = None):
     """Delete files in dst that satisfy test.
 
     dst : string
-        Directory name to remove files in.
+	Directory name to remove files in.
 
     test : remove_test object
 	Whether to remove a given file or directory.
@@ -1548,37 +5080,246 @@ def _remove_by_test(dst, test, follow_links = False, backup = True):
 	Whether to rename objects to <filename>.<isodate> rather than
 	deleting them.
 
+    keep_at_least : integer or None
+	(optional: default = None)
+	Minimum number of entries to leave in each directory. If not
+	None, objects satisfying test are removed oldest-first until
+	only keep_at_least entries remain.
+
+    path_filter : _path_filter object or None
+	(optional: default = None)
+	If not None, entries it excludes are skipped without being
+	stat'ed, and non-directories it does not include are never
+	removed. A directory satisfying test then has its contents
+	removed subject to the filter, and is itself only removed if
+	that leaves it empty.
+
+    rel_dir : string
+	(optional: default = "")
+	Pathname of dst relative to the top of the removal, against
+	which path_filter is matched.
+
+    index : _expiry_index object or None
+	(optional: default = None)
+	If not None, the index of when the entries of each directory
+	are next due to satisfy test, which must have an expiry()
+	method. Directories that are unchanged since they were indexed
+	and have nothing due are not listed, and only their indexed
+	subdirectories are visited. The index is updated for each
+	directory that is listed.
+
     return : boolean
 	Whether any change was made to dst.
     """
+    fs = _fs()
     change_made = False
-    dst_stat = os.lstat(dst)
+    dst_stat = fs.lstat(dst)
     dst_mode = dst_stat.st_mode
     if not stat.S_ISDIR(dst_mode):
-	log(LOG_ERROR, "A test was specified for deleting in "
+        log(LOG_ERROR, "A test was specified for deleting in "
             + dst + ", but it is not a directory")
-    dst_list = os.listdir(dst)
+    if index != None:
+        entry = index.get(dst)
+        if entry != None and entry[0] == dst_stat.st_mtime \
+                and entry[1] == dst_stat.st_ctime \
+                and (entry[2] == None or entry[2] > index.now):
+            for f in entry[3]:
+                rel_name = None
+                if path_filter != None:
+                    rel_name = os.path.join(rel_dir, f)
+                change_made = _remove_by_test(os.path.join(dst, f), test,
+                                              follow_links, backup,
+                                              keep_at_least, path_filter,
+                                              rel_name, index) \
+                              or change_made
+            return change_made
+    if backup and backup_dir == None:
+        # backups are renamed within dst, so they must not be seen
+        # by a listing that is still in progress
+        dst_list = fs.listdir(dst)
+    else:
+        dst_list = _iter_dir(dst)
+    n_entries = 0
+    candidates = []
+    # earliest time an entry left in dst is due, and the directories
+    # visited below dst, for the index
+    next_expiry = None
+    subdirs = []
+    removed_here = False
     for f in dst_list:
+        n_entries = n_entries + 1
         f_name = os.path.join(dst, f)
-	if follow_links:
-	    f_stat = os.stat(f_name)
-	else:
-	    f_stat = os.lstat(f_name)
-	f_mode = f_stat.st_mode
-	if test.test(f_name, f_stat):
-	    _remove(f_name, backup)
+        rel_name = None
+        if path_filter != None:
+            rel_name = os.path.join(rel_dir, f)
+            if path_filter.excluded(rel_name):
+                continue
+        if follow_links:
+            f_stat = fs.stat(f_name)
+        else:
+            f_stat = fs.lstat(f_name)
+        f_mode = f_stat.st_mode
+        if test.test(f_name, f_stat):
+            if path_filter != None and stat.S_ISDIR(f_mode):
+                change_made = _remove_by_test(f_name, test_true(),
+                                              follow_links, backup, None,
+                                              path_filter, rel_name) \
+                              or change_made
+                if _dir_is_empty(f_name):
+                    _remove(f_name, backup)
+                    change_made = True
+                    removed_here = True
+                    _log_item(LOG_ACTION, "removed", "%s removed", f_name)
+                else:
+                    next_expiry = 0.0
+            elif path_filter != None \
+                    and not path_filter.included(rel_name):
+                pass
+            elif keep_at_least == None:
+                _remove(f_name, backup)
+                change_made = True
+                removed_here = True
+                _log_item(LOG_ACTION, "removed", "%s removed", f_name)
+            else:
+                candidates.append((_stat_time(f_stat,
+                                              getattr(test, "age_type",
+                                                      "mtime")),
+                                   f_name))
+            if index != None and stat.S_ISDIR(f_mode):
+                index.forget(f_name)
+        else:
+            if stat.S_ISDIR(f_mode):
+                change_made = _remove_by_test(f_name, test, follow_links,
+                                              backup, keep_at_least,
+                                              path_filter, rel_name,
+                                              index) \
+                              or change_made
+                subdirs.append(f)
+            if index != None and (path_filter == None
+                                  or stat.S_ISDIR(f_mode)
+                                  or path_filter.included(rel_name)):
+                f_expiry = test.expiry(f_name, f_stat)
+                if next_expiry == None or f_expiry < next_expiry:
+                    next_expiry = f_expiry
+    if candidates:
+        if len(candidates) > n_entries - keep_at_least:
+            next_expiry = 0.0
+        for (f_time, f_name) in _oldest_excess(candidates,
+                                               n_entries - keep_at_least):
+            _remove(f_name, backup)
             change_made = True
-            log(LOG_ACTION, f_name + " removed")
-	else:
-	    if stat.S_ISDIR(f_mode):
-	    	change_made = _remove_by_test(f_name, test, follow_links,
-					      backup) \
-			      or change_made
+            removed_here = True
+            _log_item(LOG_ACTION, "removed", "%s removed", f_name)
+    if index != None:
+        if removed_here and not (backup and backup_dir == None):
+            dst_stat = fs.lstat(dst)
+        index.put(dst, dst_stat, next_expiry, subdirs)
     return change_made
 
+class _dir_snapshot:
+    """Compact record of the size and age of every non-directory
+    object below a directory, gathered in a single scan.
+
+    Sizes and times are held in arrays and each object stores only
+    its name and the index of its parent directory, so no stat
+    results or full pathnames are kept.
+    """
+    def __init__(self, dst, age_type = "mtime"):
+        dst_stat = os.lstat(dst)
+        if not stat.S_ISDIR(dst_stat.st_mode):
+            raise PysysconfError(dst + " is not a directory")
+        self.dir_names = [dst]
+        self.dir_parents = array.array("l", [-1])
+        self.names = []
+        self.parents = array.array("l")
+        self.sizes = array.array("d")
+        self.times = array.array("d")
+        dir_i = 0
+        while dir_i < len(self.dir_names):
+            dir_name = self.dir_path(dir_i)
+            for f in os.listdir(dir_name):
+                f_stat = os.lstat(os.path.join(dir_name, f))
+                if stat.S_ISDIR(f_stat.st_mode):
+                    self.dir_names.append(f)
+                    self.dir_parents.append(dir_i)
+                else:
+                    self.names.append(f)
+                    self.parents.append(dir_i)
+                    self.sizes.append(f_stat.st_size)
+                    self.times.append(_stat_time(f_stat, age_type))
+            dir_i = dir_i + 1
+
+    def dir_path(self, dir_i):
+        """Return the full pathname of the directory with index dir_i.
+        """
+        parts = []
+        while dir_i >= 0:
+            parts.append(self.dir_names[dir_i])
+            dir_i = self.dir_parents[dir_i]
+        parts.reverse()
+        return os.path.join(*parts)
+
+    def path(self, i):
+        """Return the full pathname of the object with index i.
+        """
+        return os.path.join(self.dir_path(self.parents[i]), self.names[i])
+
+def _oldest_excess(candidates, n_remove):
+    """Select the oldest entries from a list of removal candidates.
+
+    candidates : list of (time, name) tuples
+        Objects that may be removed. The list is reordered in place.
+
+    n_remove : integer
+        Maximum number of candidates to select.
+
+    return : iterator of (time, name) tuples
+        The oldest min(n_remove, len(candidates)) candidates, in
+        oldest-first order.
+
+    Only the candidates that must be kept are held in a bounded heap,
+    so selection costs O(n log k) for k = len(candidates) - n_remove.
+    """
+    n_keep = len(candidates) - max(n_remove, 0)
+    if n_keep > 0:
+        kept = heapq.nlargest(n_keep, candidates)
+        kept_names = set([name for (t, name) in kept])
+        candidates = [c for c in candidates if c[1] not in kept_names]
+    heapq.heapify(candidates)
+    while candidates:
+        yield heapq.heappop(candidates)
+
+def _stat_time(file_stat, age_type):
+    """Return the time of the given type from a stat result.
+
+    file_stat : stat result
+        Result of os.stat() or os.lstat().
+
+    age_type : string
+        One of "mtime", "atime", or "ctime".
+
+    return : float
+        The requested time, in seconds since the epoch.
+    """
+    if age_type == "mtime":
+        return file_stat.st_mtime
+    elif age_type == "atime":
+        return file_stat.st_atime
+    elif age_type == "ctime":
+        return file_stat.st_ctime
+    else:
+        raise PysysconfError("Unknown age_type " + str(age_type))
+
 class remove_test:
     """Class that implements a test for whether a given file or
     directory should be removed.
+
+    A subclass whose result for a file only changes once, at a time
+    that can be computed from its stat data, may also define
+    expiry(file_name, file_stat), returning that time in seconds since
+    the epoch, and key(), returning a string that identifies the test
+    and its settings. check_not_exists() can then skip directories
+    with nothing due (see expiry_index).
     """
     def test(self, file_name, file_stat):
 	return False
@@ -1606,15 +5347,7 @@ class test_age(remove_test):
 	self.age_type = age_type
 
     def test(self, file_name, file_stat):
-   	file_mode = file_stat.st_mode
-    	if self.age_type == "mtime":
-	    file_time = file_stat.st_mtime
-    	elif self.age_type == "atime":
-	    file_time = file_stat.st_atime
-    	elif self.age_type == "ctime":
-	    file_time = file_stat.st_ctime
-    	else:
-            raise PysysconfError("Unknown age_type " + str(self.age_type))
+        file_time = _stat_time(file_stat, self.age_type)
         file_datetime = datetime.datetime.fromtimestamp(file_time)
     	now_datetime = datetime.datetime.now()
     	file_age = now_datetime - file_datetime
@@ -1623,6 +5356,15 @@ class test_age(remove_test):
 	else:
 	    return False
 
+    def expiry(self, file_name, file_stat):
+        if self.age == None:
+            return 0.0
+        return _stat_time(file_stat, self.age_type) \
+            + self.age.total_seconds()
+
+    def key(self):
+        return repr(("age", self.age, self.age_type))
+
 class test_regexp(remove_test):
     """Tests whether a filename matches a given regexp.
     """
@@ -1637,6 +5379,549 @@ class test_regexp(remove_test):
 	else:
 	    return False
 
+class package_db:
+    """Class that answers queries about the installed packages and
+    installs and removes them. Set pysysconf.package_backend to an
+    object of a subclass to change how packages are managed.
+    """
+    def installed(self, name, arch = None):
+        """Return the installed versions of the package name, as a list
+        of (epoch, version, release) tuples (empty if it is not
+        installed). If arch is not None, only versions built for that
+        architecture are returned.
+        """
+        return []
+
+    def install(self, name, evr = None):
+        """Install (or update) the package name, or the given version
+        of it if evr is not None. Return whether this succeeded.
+        """
+        return False
+
+    def remove(self, name):
+        """Remove the package name, which may give a version and
+        architecture as for "rpm -q" (see _rpm_target()) to remove
+        only that version. Return whether this succeeded.
+        """
+        return False
+
+class rpm_package_db(package_db):
+    """Query the rpm database and install and remove packages with yum.
+
+    The whole installed package set is read once, with the rpm module
+    if it is available or otherwise with a single "rpm -qa", and is
+    read again only after a package has been installed or removed.
+    """
+    def __init__(self):
+        self._index = None
+
+    def installed(self, name, arch = None):
+        if self._index == None:
+            self._index = self._read_index()
+        return [(epoch, version, release) for (epoch, version, release,
+                inst_arch) in self._index.get(name, [])
+                if arch == None or inst_arch == arch]
+
+    def install(self, name, evr = None):
+        if evr != None:
+            target = _rpm_target(name, evr)
+            command = "install"
+        elif self.installed(name):
+            target = name
+            command = "update"
+        else:
+            target = name
+            command = "install"
+        self._index = None
+        return shell_command("/usr/bin/yum -e 0 -d 0 -y " + command
+                             + " '" + target + "'") == 0
+
+    def remove(self, name):
+        self._index = None
+        return shell_command("/usr/bin/yum -e 0 -d 0 -y remove '"
+                             + name + "'") == 0
+
+    def _read_index(self):
+        index = {}
+        try:
+            import rpm
+        except ImportError:
+            rpm = None
+        if rpm != None:
+            try:
+                for h in rpm.TransactionSet().dbMatch():
+                    index.setdefault(h["name"], []).append(
+                        (h["epochnum"], h["version"], h["release"],
+                         h["arch"]))
+            except rpm.error, e:
+                raise PysysconfError("reading rpm database: " + str(e))
+            return index
+        import subprocess
+        p = subprocess.Popen(["/bin/rpm", "-qa", "--qf",
+                              "%{NAME} %{EPOCHNUM} %{VERSION} %{RELEASE}"
+                              " %{ARCH}\n"],
+                             stdout = subprocess.PIPE)
+        for line in p.stdout:
+            (name, epoch, version, release, arch) = line.split()
+            index.setdefault(name, []).append((int(epoch), version,
+                                               release, arch))
+        if p.wait() != 0:
+            raise PysysconfError("rpm -qa failed")
+        return index
+
+class fake_package_db(package_db):
+    """Package database held in memory, for testing policies.
+
+    installed : dictionary
+        Maps package names, optionally with an architecture (as in
+        "glibc.i686"), to lists of installed version strings
+        "[epoch:]version-release".
+
+    available : dictionary or None
+        (optional: default = None)
+        Maps names of packages that can be installed to the version
+        string that installing them gives.
+
+    Installs and removals are recorded in the list actions as tuples
+    ("install", name) and ("remove", name).
+    """
+    def __init__(self, installed, available = None):
+        self.packages = {}
+        for (name, versions) in installed.items():
+            self.packages[name] = [_parse_evr(v) for v in versions]
+        if available == None:
+            available = {}
+        self.available = available
+        self.actions = []
+
+    def installed(self, name, arch = None):
+        versions = []
+        for (key, key_versions) in self.packages.items():
+            (key_name, key_arch) = _split_rpm_arch(key)
+            if key_name == name and (arch == None or key_arch == arch):
+                versions.extend(key_versions)
+        return versions
+
+    def install(self, name, evr = None):
+        self.actions.append(("install", name))
+        if evr == None:
+            if name not in self.available:
+                return False
+            evr = _parse_evr(self.available[name])
+        self.packages[name] = [evr]
+        return True
+
+    def remove(self, name):
+        self.actions.append(("remove", name))
+        (name, arch, evr) = _resolve_rpm_name(self, name)
+        removed = False
+        for (key, versions) in self.packages.items():
+            (key_name, key_arch) = _split_rpm_arch(key)
+            if key_name != name or (arch != None and key_arch != arch):
+                continue
+            kept = [v for v in versions
+                    if evr != None and not _rpm_matches([v], "=", evr)]
+            removed = removed or len(kept) < len(versions)
+            if kept:
+                self.packages[key] = kept
+            else:
+                del self.packages[key]
+        return removed
+
+class stat_spec(object):
+    """Ownership, permissions, and SELinux context that the check_*
+    functions should give the objects they check, converted and
+    checked once when the object is created rather than on every
+    check. A spec can be passed as the spec argument of check_copy(),
+    check_template(), check_link(), check_file_exists(), and
+    check_dir_exists() instead of the separate arguments, and many
+    resources can share one spec.
+
+    uid, gid, perm, umask, dmask, se_context, se_user, se_role,
+    se_type, se_level :
+        (optional: default = None)
+        As for check_copy(). Permissions and masks given as octal
+        strings are stored as integers. User and group names are
+        looked up when they are first used, as the accounts may be
+        created by the same policy.
+
+    Specs should not be changed once created. stat_specs() creates
+    specs in bulk.
+
+    e.g. Share one spec between many files:
+    >>> web = stat_spec(uid = "apache", gid = "apache", perm = "0640")
+    >>> for name in ["index.html", "style.css"]:
+    ...     check_copy("site/" + name, "/var/www/html/" + name, spec = web)
+    """
+    __slots__ = ("uid", "gid", "perm", "umask", "dmask", "se_context",
+                 "se_user", "se_role", "se_type", "se_level",
+                 "has_selinux")
+
+    def __init__(self, uid = None, gid = None, perm = None, umask = None,
+                 dmask = None, se_context = None, se_user = None,
+                 se_role = None, se_type = None, se_level = None):
+        for (name, value) in (("uid", uid), ("gid", gid)):
+            if value != None and not isinstance(value, (str, int)):
+                raise PysysconfError("Bad " + name + " specificiation: "
+                                     + str(value))
+        if se_context != None and not isinstance(se_context, str):
+            raise PysysconfError("Bad se_context specification: "
+                                 + str(se_context))
+        if (se_context != None) \
+                and ((se_user != None) or (se_role != None) \
+                         or (se_type != None) or (se_level != None)):
+            raise PysysconfError("Cannot specify se_context"
+                                 " simultaneously with any of se_user,"
+                                 " se_role, se_type, or se_level.")
+        self.uid = uid
+        self.gid = gid
+        self.perm = _parse_mode("perm", perm)
+        self.umask = _parse_mode("umask", umask)
+        self.dmask = _parse_mode("dmask", dmask)
+        self.se_context = se_context
+        self.se_user = se_user
+        self.se_role = se_role
+        self.se_type = se_type
+        self.se_level = se_level
+        self.has_selinux = (se_context, se_user, se_role, se_type,
+                            se_level) != (None,) * 5
+
+    def key(self):
+        """Return a tuple of all the settings, which is equal for equal
+        specs.
+        """
+        return (self.uid, self.gid, self.perm, self.umask, self.dmask,
+                self.se_context, self.se_user, self.se_role, self.se_type,
+                self.se_level)
+
+class filesystem_backend:
+    """Class through which check_copy(), check_link(),
+    check_file_exists(), check_dir_exists(), and check_not_exists()
+    reach the filesystem. Set pysysconf.filesystem to an object of a
+    subclass to change where they work.
+
+    Subclasses provide the methods lstat, stat, listdir, mkdir, rmdir,
+    unlink, rename, symlink, readlink, link, chown, and chmod, which
+    behave as the os functions of the same names (raising OSError on
+    failure), open(path, mode), which behaves as the builtin open()
+    for the modes "r", "rb", "w", and "wb", and create(path), which
+    creates an empty file if path does not exist.
+    """
+    def native_path(self, path):
+        """Return the name of path in the real filesystem, or None if it
+        is not in the real filesystem. Features that need the real
+        filesystem (the backup store, background removal, SELinux
+        contexts, copies of large files, and the scandir module) are
+        only used where this is not None.
+        """
+        return None
+
+class real_filesystem(filesystem_backend):
+    """The real filesystem, used through the os module.
+    """
+    def native_path(self, path):
+        return path
+
+    def lstat(self, path):
+        return os.lstat(self.native_path(path))
+
+    def stat(self, path):
+        return os.stat(self.native_path(path))
+
+    def listdir(self, path):
+        return os.listdir(self.native_path(path))
+
+    def mkdir(self, path, mode = 0777):
+        os.mkdir(self.native_path(path), mode)
+
+    def rmdir(self, path):
+        os.rmdir(self.native_path(path))
+
+    def unlink(self, path):
+        os.unlink(self.native_path(path))
+
+    def rename(self, src, dst):
+        os.rename(self.native_path(src), self.native_path(dst))
+
+    def symlink(self, target, path):
+        os.symlink(target, self.native_path(path))
+
+    def readlink(self, path):
+        return os.readlink(self.native_path(path))
+
+    def link(self, src, dst):
+        os.link(self.native_path(src), self.native_path(dst))
+
+    def chown(self, path, uid, gid):
+        os.chown(self.native_path(path), uid, gid)
+
+    def chmod(self, path, mode):
+        os.chmod(self.native_path(path), mode)
+
+    def open(self, path, mode = "r"):
+        return open(self.native_path(path), mode)
+
+    def create(self, path):
+        os.close(os.open(self.native_path(path), os.O_CREAT))
+
+class prefixed_filesystem(real_filesystem):
+    """The real filesystem, with every pathname (of sources as well as
+    destinations, unlike the root option) taken relative to the
+    directory root. Symlink targets are not changed.
+
+    root : string
+        Directory that stands for / (and for the current directory,
+        which relative pathnames are taken relative to).
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def native_path(self, path):
+        return os.path.join(self.root, os.path.abspath(path).lstrip("/"))
+
+class memory_filesystem(filesystem_backend):
+    """Filesystem held in memory, to test policies and to measure the
+    cost of the checks without any disk I/O. It starts with just an
+    empty root directory owned by the current user.
+
+    Ownership and permissions are recorded but not enforced, all
+    objects are on one device, and new objects get the permissions
+    they ask for masked by the attribute umask (default 022).
+    Relative pathnames are taken relative to the current directory.
+    """
+    umask = 022
+
+    def __init__(self):
+        self._inode_numbers = itertools.count(1)
+        self.root = self._new_inode(stat.S_IFDIR | 0755)
+        self.root.entries = {}
+        self.root.nlink = 2
+
+    def _new_inode(self, mode):
+        inode = _memory_inode()
+        inode.ino = self._inode_numbers.next()
+        inode.mode = mode
+        inode.uid = os.getuid()
+        inode.gid = os.getgid()
+        inode.nlink = 1
+        inode.atime = inode.mtime = inode.ctime = time.time()
+        inode.data = ""
+        inode.entries = None
+        inode.target = None
+        return inode
+
+    def _lookup(self, path, follow, depth = 0):
+        """Find the object path, following symlinks in its directory
+        components (and in the final component if follow is True).
+
+        return : tuple (parent, name, inode)
+            The inode of the parent directory (None for /), the final
+            component of path, and the inode of path (None if it does
+            not exist).
+        """
+        if depth > 40:
+            raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), path)
+        parts = [p for p in os.path.abspath(path).split("/") if p]
+        if not parts:
+            return (None, "", self.root)
+        parent = self.root
+        parent_path = "/"
+        for part in parts[:-1]:
+            inode = parent.entries.get(part)
+            if inode != None and stat.S_ISLNK(inode.mode):
+                inode = self._lookup(os.path.join(parent_path, inode.target),
+                                     True, depth + 1)[2]
+            if inode == None:
+                raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            if not stat.S_ISDIR(inode.mode):
+                raise OSError(errno.ENOTDIR, os.strerror(errno.ENOTDIR),
+                              path)
+            parent = inode
+            parent_path = os.path.join(parent_path, part)
+        inode = parent.entries.get(parts[-1])
+        if follow and inode != None and stat.S_ISLNK(inode.mode):
+            inode = self._lookup(os.path.join(parent_path, inode.target),
+                                 True, depth + 1)[2]
+        return (parent, parts[-1], inode)
+
+    def _get(self, path, follow):
+        inode = self._lookup(path, follow)[2]
+        if inode == None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return inode
+
+    def _add(self, path, mode):
+        (parent, name, inode) = self._lookup(path, False)
+        if inode != None:
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+        inode = self._new_inode(mode)
+        parent.entries[name] = inode
+        parent.mtime = parent.ctime = time.time()
+        return inode
+
+    def _stat_result(self, inode):
+        if stat.S_ISDIR(inode.mode):
+            size = 4096
+        elif stat.S_ISLNK(inode.mode):
+            size = len(inode.target)
+        else:
+            size = len(inode.data)
+        return os.stat_result((inode.mode, inode.ino, 0, inode.nlink,
+                               inode.uid, inode.gid, size, inode.atime,
+                               inode.mtime, inode.ctime))
+
+    def lstat(self, path):
+        return self._stat_result(self._get(path, False))
+
+    def stat(self, path):
+        return self._stat_result(self._get(path, True))
+
+    def listdir(self, path):
+        inode = self._get(path, True)
+        if not stat.S_ISDIR(inode.mode):
+            raise OSError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+        return inode.entries.keys()
+
+    def mkdir(self, path, mode = 0777):
+        inode = self._add(path, stat.S_IFDIR | (mode & 07777 & ~self.umask))
+        inode.entries = {}
+        inode.nlink = 2
+        self._lookup(path, False)[0].nlink += 1
+
+    def rmdir(self, path):
+        (parent, name, inode) = self._lookup(path, False)
+        if inode == None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        if not stat.S_ISDIR(inode.mode):
+            raise OSError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), path)
+        if inode.entries:
+            raise OSError(errno.ENOTEMPTY, os.strerror(errno.ENOTEMPTY),
+                          path)
+        del parent.entries[name]
+        parent.nlink -= 1
+        parent.mtime = parent.ctime = time.time()
+
+    def unlink(self, path):
+        (parent, name, inode) = self._lookup(path, False)
+        if inode == None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        if stat.S_ISDIR(inode.mode):
+            raise OSError(errno.EISDIR, os.strerror(errno.EISDIR), path)
+        del parent.entries[name]
+        inode.nlink -= 1
+        parent.mtime = parent.ctime = time.time()
+
+    def rename(self, src, dst):
+        (src_parent, src_name, inode) = self._lookup(src, False)
+        if inode == None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), src)
+        (dst_parent, dst_name, old) = self._lookup(dst, False)
+        if old is inode:
+            return
+        if old != None:
+            if stat.S_ISDIR(old.mode):
+                if not stat.S_ISDIR(inode.mode):
+                    raise OSError(errno.EISDIR, os.strerror(errno.EISDIR),
+                                  dst)
+                self.rmdir(dst)
+            elif stat.S_ISDIR(inode.mode):
+                raise OSError(errno.ENOTDIR, os.strerror(errno.ENOTDIR),
+                              dst)
+            else:
+                self.unlink(dst)
+        del src_parent.entries[src_name]
+        dst_parent.entries[dst_name] = inode
+        if stat.S_ISDIR(inode.mode):
+            src_parent.nlink -= 1
+            dst_parent.nlink += 1
+        now = time.time()
+        src_parent.mtime = src_parent.ctime = now
+        dst_parent.mtime = dst_parent.ctime = now
+        inode.ctime = now
+
+    def symlink(self, target, path):
+        self._add(path, stat.S_IFLNK | 0777).target = target
+
+    def readlink(self, path):
+        inode = self._get(path, False)
+        if not stat.S_ISLNK(inode.mode):
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL), path)
+        return inode.target
+
+    def link(self, src, dst):
+        inode = self._get(src, False)
+        if stat.S_ISDIR(inode.mode):
+            raise OSError(errno.EPERM, os.strerror(errno.EPERM), src)
+        (parent, name, old) = self._lookup(dst, False)
+        if old != None:
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+        parent.entries[name] = inode
+        inode.nlink += 1
+        inode.ctime = parent.mtime = parent.ctime = time.time()
+
+    def chown(self, path, uid, gid):
+        inode = self._get(path, True)
+        if uid != -1:
+            inode.uid = uid
+        if gid != -1:
+            inode.gid = gid
+        inode.ctime = time.time()
+
+    def chmod(self, path, mode):
+        inode = self._get(path, True)
+        inode.mode = stat.S_IFMT(inode.mode) | (mode & 07777)
+        inode.ctime = time.time()
+
+    def open(self, path, mode = "r"):
+        try:
+            (parent, name, inode) = self._lookup(path, True)
+            if mode in ("r", "rb"):
+                if inode == None:
+                    raise OSError(errno.ENOENT, os.strerror(errno.ENOENT),
+                                  path)
+                if stat.S_ISDIR(inode.mode):
+                    raise OSError(errno.EISDIR, os.strerror(errno.EISDIR),
+                                  path)
+                import cStringIO
+                return cStringIO.StringIO(inode.data)
+            if mode not in ("w", "wb"):
+                raise ValueError("unsupported mode " + mode)
+            if inode == None:
+                inode = self._add(path, stat.S_IFREG | (0666 & ~self.umask))
+            elif stat.S_ISDIR(inode.mode):
+                raise OSError(errno.EISDIR, os.strerror(errno.EISDIR), path)
+            return _memory_file(inode)
+        except OSError, e:
+            raise IOError(e.errno, e.strerror, e.filename)
+
+    def create(self, path):
+        if self._lookup(path, True)[2] == None:
+            self._add(path, stat.S_IFREG | (0777 & ~self.umask))
+
+class _memory_inode(object):
+    """An object in a memory_filesystem. Directories hold a dictionary
+    of entries, symlinks a target, and files their data.
+    """
+    __slots__ = ("ino", "mode", "uid", "gid", "nlink", "atime", "mtime",
+                 "ctime", "data", "entries", "target")
+
+class _memory_file:
+    """A file in a memory_filesystem open for writing, which replaces
+    the contents of the file when it is closed.
+    """
+    def __init__(self, inode):
+        self.inode = inode
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def close(self):
+        if self.chunks != None:
+            self.inode.data = "".join(self.chunks)
+            self.inode.mtime = self.inode.ctime = time.time()
+            self.chunks = None
+
 ##############################################################################
 # initialize logging
 
@@ -1645,49 +5930,194 @@ syslog_verbosity = LOG_ACTION
 syslog_priority = syslog.LOG_INFO
 syslog_facility = syslog.LOG_USER
 
-syslog.openlog("pysysconf")
+_syslog_opened = False
+
+# number of stdout messages to hold back and write at once (None to
+# print each message as it is logged)
+log_buffer_lines = None
+
+# whether messages about individual objects within a directory copy or
+# removal are summarized per check instead of being logged one by one
+log_aggregate = False
+
+_log_buffer = []
+_log_buffer_registered = False
+
+# counts of aggregated messages of the current check, or None
+_log_counts = None
+
+# _reporter object receiving the errors logged, or None (see
+# start_report())
+_active_report = None
+
+##############################################################################
+# selinux module, or None if it is not available (False until imported)
+
+_selinux_module = False
+
+##############################################################################
+# directory reading
+
+external_sort_threshold = 100000
+
+# scandir() function, or None if it is not available (False until imported)
+_scandir_function = False
+
+# C library (opendir, readdir, closedir), or None if they are not
+# available (False until loaded)
+_libc_dir = False
+
+##############################################################################
+# large file copies
+
+large_file_size = None
+
+_LARGE_FILE_FLUSH = 64 * 1024 * 1024
+_SEEK_DATA = getattr(os, "SEEK_DATA", 3)
+_SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
+_POSIX_FADV_SEQUENTIAL = 2
+_POSIX_FADV_DONTNEED = 4
+
+_libc_functions = {}
+
+##############################################################################
+# copy verification
+
+verify_hash = "sha1"
+verify_threads = 4
+
+##############################################################################
+# spec used by checks given no ownership, permissions, or SELinux settings
+
+_DEFAULT_STAT_SPEC = stat_spec()
+
+##############################################################################
+# filesystem used by the checks (None to use the real filesystem)
+
+filesystem = None
+
+_REAL_FILESYSTEM = real_filesystem()
+
+##############################################################################
+# package database (None to use an rpm_package_db)
+
+package_backend = None
+
+_default_package_backend = None
+_RPM_SEGMENT = re.compile(r"~|\^|[0-9]+|[a-zA-Z]+")
+
+# architectures recognized in package names such as "glibc.i686"
+_RPM_ARCHES = set(["noarch", "i386", "i486", "i586", "i686", "athlon",
+                   "x86_64", "ia64", "ppc", "ppc64", "ppc64le", "s390",
+                   "s390x", "armv5tel", "armv6hl", "armv7hl", "armv7hnl",
+                   "aarch64", "sparc", "sparcv9", "sparc64", "alpha",
+                   "src"])
+
+##############################################################################
+# external commands
+
+command_timeout = None
+
+_command_deadline = None
+
+##############################################################################
+# locks held by this process, mapping lock name to file descriptor
+
+_lock_fds = {}
+
+##############################################################################
+# backups
+
+backup_dir = None
+backup_compress = False
+
+# seconds to wait for another process saving to or pruning the store
+_BACKUP_LOCK_TIMEOUT = 60
+
+##############################################################################
+# account databases
+
+passwd_file = "/etc/passwd"
+shadow_file = "/etc/shadow"
+group_file = "/etc/group"
+gshadow_file = "/etc/gshadow"
+
+_uid_cache = {}
+_gid_cache = {}
+
+##############################################################################
+# root directory and source caches
+
+root = None
+
+_source_digests = {}
+
+##############################################################################
+# template caches
+
+# maximum number of template files, and of rendered outputs, to cache
+template_cache_entries = 64
+
+_template_sources = {}
+_template_renders = {}
+
+##############################################################################
+# convergence state
+
+state_db = None
+force_full_run = False
+
+# whether check_not_exists() keeps an index of when directories next
+# have entries due to be removed (see _expiry_index)
+expiry_index = False
+
+# coarsest resolution of file timestamps (in seconds) that the expiry
+# index allows for
+_TIMESTAMP_GRANULARITY = 1.0
+
+_state_conn = None
+_state_conn_name = None
+
+##############################################################################
+# background removal
+
+remove_in_background = False
+
+# directory to move directories being removed in the background into
+# (None for .pysysconf-trash at the top of each filesystem)
+trash_dir = None
+remove_threads = 4
+
+_reap_queue = None
+_reap_lock = thread.allocate_lock()
+_trash_dirs = {}
+_trash_counter = itertools.count()
 
 ##############################################################################
 # find distro version
 
 dist_version = None
 dist_name = ""
-if not shell_command("/bin/grep -q 'Fedora release 11 (Leonidas)' " +
-                           "/etc/system-release"):
-	dist_version = 11
-	dist_name = "f11"
-if not shell_command("/bin/grep -q 'Fedora release 12 (Constantine)' " +
-                           "/etc/system-release"):
-	dist_version = 12
-	dist_name = "f12"
-if not shell_command("/bin/grep -q 'Fedora release 13 (Goddard)' " +
-                           "/etc/system-release"):
-	dist_version = 13
-	dist_name = "f13"
-if not shell_command("/bin/grep -q 'Fedora release 14 (Laughlin)' " +
-                           "/etc/system-release"):
-	dist_version = 14
-	dist_name = "f14"
-
-if not shell_command("/bin/grep -q 'Fedora release 15 (Lovelock)' " +
-                           "/etc/system-release"):
-        dist_version = 15
-        dist_name = "f15"
-
-if not shell_command("/bin/grep -q 'Fedora release 16 (Verne)' " +
-                           "/etc/system-release"):
-        dist_version = 16
-        dist_name = "f16"
-
-if not shell_command("/bin/grep -q 'Fedora release 17 (Beefy Miracle)' " +
-                           "/etc/system-release"):
-        dist_version = 17
-        dist_name = "f17"
-
-if not shell_command("/bin/grep -q 'Fedora release 18 (Spherical Cow)' " +
-                           "/etc/system-release"):
-        dist_version = 18
-        dist_name = "f18"
+try:
+    _release_file = open("/etc/system-release")
+    try:
+        _release = _release_file.read()
+    finally:
+        _release_file.close()
+except IOError:
+    _release = ""
+for (_release_string, _version, _name) in [
+        ("Fedora release 11 (Leonidas)", 11, "f11"),
+        ("Fedora release 12 (Constantine)", 12, "f12"),
+        ("Fedora release 13 (Goddard)", 13, "f13"),
+        ("Fedora release 14 (Laughlin)", 14, "f14"),
+        ("Fedora release 15 (Lovelock)", 15, "f15"),
+        ("Fedora release 16 (Verne)", 16, "f16"),
+        ("Fedora release 17 (Beefy Miracle)", 17, "f17"),
+        ("Fedora release 18 (Spherical Cow)", 18, "f18")]:
+    if _release_string in _release:
+        dist_version = _version
+        dist_name = _name
 
 if dist_version is None:
 	log(LOG_ERROR, "Unable to determine distribution version")
@@ -1695,3 +6125,23 @@ if dist_version is None:
 
 log(LOG_NO_ACTION, "Found distribution: version = %d, name = %s"
 	           % (dist_version, dist_name))
+
+##############################################################################
+# reporting, started here if requested by the environment so that every
+# check of the policy script is reported
+
+if os.environ.get("PYSYSCONF_REPORT"):
+    import atexit
+    start_report(os.environ["PYSYSCONF_REPORT"])
+    atexit.register(finish_report)
+
+##############################################################################
+# profiling, started here if requested by the environment so that the
+# whole policy script is profiled
+
+_active_profiler = None
+
+if os.environ.get("PYSYSCONF_PROFILE"):
+    import atexit
+    _profile_start(os.environ.get("PYSYSCONF_PROFILE_MEMORY") == "1")
+    atexit.register(_profile_stop, os.environ["PYSYSCONF_PROFILE"])
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
-import pysysconf, unittest, os, stat, time, datetime
+import pysysconf, unittest, os, stat, time, datetime, fcntl, sys, subprocess
+import py_compile, re, StringIO, json, signal, errno
 
 pysysconf.verbosity = pysysconf.LOG_NONE
 pysysconf.syslog_verbosity = pysysconf.LOG_NONE
@@ -13,6 +14,71 @@ def rm_tree(dir_name):
 	else:
 		os.unlink(dir_name)
 
+def multi_root_policy():
+	pysysconf.check_dir_exists("/etc")
+	pysysconf.check_copy("test/testsrc", "/etc/testfile")
+	pysysconf.check_link("/etc/testfile", "/etc/testlink")
+
+# maximum time to import pysysconf, as a multiple of the time to start
+# an interpreter that imports nothing, both measured in the same run
+IMPORT_TIME_RATIO = 1.0
+
+# prints the modules that importing pysysconf loads but should not
+IMPORT_SCRIPT = """
+import sys
+before = set(sys.modules)
+import pysysconf
+deferred = ["selinux", "hashlib", "json", "gzip", "tempfile", "string",
+	    "threading", "Queue", "socket", "filecmp", "sqlite3",
+	    "multiprocessing", "subprocess", "ctypes"]
+print " ".join([m for m in deferred if m in sys.modules and m not in before])
+"""
+
+# logs fewer messages than the buffer holds, which must still be written
+BUFFERED_LOG_SCRIPT = """
+import pysysconf
+pysysconf.verbosity = pysysconf.LOG_ACTION
+pysysconf.syslog_verbosity = pysysconf.LOG_NONE
+pysysconf.log_buffer_lines = 100
+pysysconf.log(pysysconf.LOG_ACTION, "one")
+pysysconf.log(pysysconf.LOG_ACTION, "two")
+"""
+
+# os functions counted by count_calls(), and those that must not be
+# called at all when nothing needs to change
+COUNTED_CALLS = ["lstat", "stat", "fstat", "open", "read", "listdir",
+		 "readlink", "chown", "lchown", "chmod", "mkdir", "unlink",
+		 "rename", "symlink", "link", "rmdir"]
+CHANGING_CALLS = ["chown", "lchown", "chmod", "mkdir", "unlink", "rename",
+		  "symlink", "link", "rmdir"]
+
+def count_calls(function, *args, **kwargs):
+	"""Call function, counting the calls it makes to each function in
+	COUNTED_CALLS and to open() (counted as "file_open"). Directories
+	read with readdir() count as calls to listdir.
+	"""
+	counts = dict.fromkeys(COUNTED_CALLS + ["file_open"], 0)
+	def counter(name, f):
+		def counted(*args, **kwargs):
+			counts[name] = counts[name] + 1
+			return f(*args, **kwargs)
+		return counted
+	saved = {}
+	for name in COUNTED_CALLS:
+		saved[name] = getattr(os, name)
+		setattr(os, name, counter(name, saved[name]))
+	pysysconf.open = counter("file_open", open)
+	readdir = pysysconf._readdir
+	pysysconf._readdir = counter("listdir", readdir)
+	try:
+		result = function(*args, **kwargs)
+	finally:
+		for name in COUNTED_CALLS:
+			setattr(os, name, saved[name])
+		del pysysconf.open
+		pysysconf._readdir = readdir
+	return (result, counts)
+
 class TestPySysConfFunctions(unittest.TestCase):
 
 	def setUp(self):
@@ -20,6 +86,8 @@ class TestPySysConfFunctions(unittest.TestCase):
 			os.mkdir("test")
 
 	def tearDown(self):
+		pysysconf.trash_dir = None
+		pysysconf._trash_dirs.clear()
 		rm_tree("test")
 		pass
 
@@ -30,6 +98,27 @@ class TestPySysConfFunctions(unittest.TestCase):
 		self.failUnless(pysysconf.acquire_lock("test/lockfile"))
 		pysysconf.release_lock("test/lockfile")
 
+	def test_locking_shared(self):
+		self.failUnless(pysysconf.acquire_lock("test/lockfile",
+						      shared = True))
+		fd = os.open("test/lockfile", os.O_RDWR)
+		fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+		self.assertRaises(IOError, fcntl.flock, fd,
+				  fcntl.LOCK_EX | fcntl.LOCK_NB)
+		os.close(fd)
+		pysysconf.release_lock("test/lockfile")
+		fd = os.open("test/lockfile", os.O_RDWR)
+		fcntl.flock(fd, fcntl.LOCK_EX)
+		start = time.time()
+		self.failIf(pysysconf.acquire_lock("test/lockfile",
+						   timeout = 0.2))
+		self.failUnless(time.time() - start >= 0.2)
+		os.close(fd)
+		with pysysconf.locked("test/lockfile", timeout = 1):
+			self.failIf(pysysconf.acquire_lock("test/lockfile"))
+		self.failUnless(pysysconf.acquire_lock("test/lockfile"))
+		pysysconf.release_lock("test/lockfile")
+
 	def test_check_file_exists(self):
 		pysysconf.check_file_exists("test/testfile", perm = 0640)
 		st = os.stat("test/testfile")
@@ -83,6 +172,965 @@ class TestPySysConfFunctions(unittest.TestCase):
 		self.failIf(os.path.exists("test/testfile2"))
 		self.failIf(os.path.exists("test/testfile3"))
 
+	def test_check_not_exists_keep_at_least(self):
+		now = time.time()
+		for (i, days) in enumerate([5, 4, 3, 0, 0]):
+			pysysconf.check_file_exists("test/testfile%d" % i)
+			t = now - days * 86400
+			os.utime("test/testfile%d" % i, (t, t))
+		test_one_day = pysysconf.test_age(age = \
+				datetime.timedelta(days = 1))
+		pysysconf.check_not_exists("test", test = test_one_day,
+				keep_at_least = 4)
+		self.failIf(os.path.exists("test/testfile0"))
+		for i in range(1, 5):
+			self.failUnless(os.path.exists("test/testfile%d" % i))
+		pysysconf.check_not_exists("test", test = test_one_day,
+				keep_at_least = 1)
+		for i in range(0, 3):
+			self.failIf(os.path.exists("test/testfile%d" % i))
+		self.failUnless(os.path.exists("test/testfile3"))
+		self.failUnless(os.path.exists("test/testfile4"))
+
+	def test_check_dir_size_limit(self):
+		now = time.time()
+		pysysconf.check_dir_exists("test/testdir")
+		for (i, size) in enumerate([100, 300, 50]):
+			f = open("test/testdir/testfile%d" % i, "w")
+			f.write("x" * size)
+			f.close()
+			t = now - (3 - i) * 3600
+			os.utime("test/testdir/testfile%d" % i, (t, t))
+		self.failIf(pysysconf.check_dir_size_limit("test", 450))
+		self.failIf(pysysconf.check_dir_size_limit("test", 400,
+							  backup = True))
+		self.failUnless(os.path.exists("test/testdir/testfile0"))
+		pysysconf.check_dir_size_limit("test", 400)
+		self.failIf(os.path.exists("test/testdir/testfile0"))
+		self.failUnless(os.path.exists("test/testdir/testfile1"))
+		pysysconf.check_dir_size_limit("test", 100, order = "largest")
+		self.failIf(os.path.exists("test/testdir/testfile1"))
+		self.failUnless(os.path.exists("test/testdir/testfile2"))
+		self.failUnless(os.path.isdir("test/testdir"))
+
+	def test_remove_in_background(self):
+		pysysconf.check_dir_exists("test/testdir")
+		for d in ["a", "a/b", "a/b/c", "a/d"]:
+			pysysconf.check_dir_exists("test/testdir/" + d)
+			for i in range(10):
+				pysysconf.check_file_exists("test/testdir/%s/f%d"
+							    % (d, i))
+		pysysconf.remove_in_background = True
+		pysysconf.trash_dir = "test/trash"
+		try:
+			self.failUnless(pysysconf.check_not_exists("test/testdir"))
+			self.failIf(os.path.exists("test/testdir"))
+			self.failUnless(os.path.isdir("test/trash"))
+			pysysconf.wait_for_removals()
+			self.failIf(os.listdir("test/trash"))
+		finally:
+			pysysconf.remove_in_background = False
+
+	def test_backup_store(self):
+		pysysconf.check_dir_exists("test/backups")
+		pysysconf.backup_dir = "test/backups"
+		try:
+			for content in ["old", "new", "old", "new"]:
+				f = open("test/testsrc", "w")
+				f.write(content)
+				f.close()
+				pysysconf.check_copy("test/testsrc", "test/testfile")
+			self.failUnless(open("test/testfile").read() == "new")
+			self.failIf([f for f in os.listdir("test")
+				     if f.startswith("testfile.")])
+			index = open("test/backups/index").readlines()
+			self.failUnless(len(index) == 3)
+			objects = []
+			for d in os.listdir("test/backups/objects"):
+				objects.extend(os.listdir("test/backups/objects/" + d))
+			self.failUnless(len(objects) == 2)
+			self.failUnless(pysysconf.check_backups_pruned(max_count = 1))
+			index = open("test/backups/index").readlines()
+			self.failUnless(len(index) == 1)
+			objects = []
+			for d in os.listdir("test/backups/objects"):
+				objects.extend(os.listdir("test/backups/objects/" + d))
+			self.failUnless(len(objects) == 1)
+			fd = os.open("test/backups/lock", os.O_RDWR)
+			fcntl.flock(fd, fcntl.LOCK_EX)
+			timeout = pysysconf._BACKUP_LOCK_TIMEOUT
+			pysysconf._BACKUP_LOCK_TIMEOUT = 0.1
+			try:
+				f = open("test/testsrc", "w")
+				f.write("newer")
+				f.close()
+				pysysconf.check_copy("test/testsrc", "test/testfile")
+				self.failIf(pysysconf.check_backups_pruned(
+						max_count = 0))
+			finally:
+				pysysconf._BACKUP_LOCK_TIMEOUT = timeout
+				os.close(fd)
+			self.failUnless(open("test/testfile").read() == "new")
+			self.failUnless(len(open("test/backups/index")
+					    .readlines()) == 1)
+		finally:
+			pysysconf.backup_dir = None
+
+	def test_state_db(self):
+		pysysconf.check_dir_exists("test/testsrc")
+		f = open("test/testsrc/testfile", "w")
+		f.write("contents")
+		f.close()
+		calls = []
+		copy_dir = pysysconf._copy_dir
+		def counting_copy_dir(*args, **kwargs):
+			calls.append(args[0])
+			return copy_dir(*args, **kwargs)
+		pysysconf.state_db = "test/state.db"
+		pysysconf._copy_dir = counting_copy_dir
+		try:
+			self.failUnless(pysysconf.check_copy("test/testsrc",
+							     "test/testdst"))
+			self.failIf(pysysconf.check_copy("test/testsrc",
+							 "test/testdst"))
+			self.failUnless(len(calls) == 1)
+			f = open("test/testdst/testfile", "w")
+			f.write("changed")
+			f.close()
+			self.failUnless(pysysconf.check_copy("test/testsrc",
+							     "test/testdst"))
+			self.failUnless(open("test/testdst/testfile").read()
+					== "contents")
+			pysysconf.force_full_run = True
+			self.failIf(pysysconf.check_copy("test/testsrc",
+							 "test/testdst"))
+			self.failUnless(len(calls) == 3)
+		finally:
+			pysysconf._copy_dir = copy_dir
+			pysysconf.state_db = None
+			pysysconf.force_full_run = False
+
+	def test_check_template(self):
+		f = open("test/template", "w")
+		f.write("server $server\nport ${port}\n")
+		f.close()
+		os.chmod("test/template", 0640)
+		vars = {"server": "ntp1", "port": 123}
+		self.failUnless(pysysconf.check_template("test/template",
+				"test/testfile", vars, backup = False))
+		self.failUnless(open("test/testfile").read()
+				== "server ntp1\nport 123\n")
+		self.failUnless(stat.S_IMODE(os.stat("test/testfile").st_mode)
+				== 0640)
+		self.failIf(pysysconf.check_template("test/template",
+				"test/testfile", vars, backup = False))
+		vars["server"] = "ntp2"
+		self.failUnless(pysysconf.check_template("test/template",
+				"test/testfile", vars, backup = False))
+		self.failUnless(open("test/testfile").read()
+				== "server ntp2\nport 123\n")
+		self.failUnless(stat.S_IMODE(os.stat("test/testfile").st_mode)
+				== 0640)
+		self.failIf([f for f in os.listdir("test")
+			     if f not in ("template", "testfile")])
+		entries = pysysconf.template_cache_entries
+		pysysconf.template_cache_entries = 2
+		try:
+			for port in range(5):
+				vars["port"] = port
+				self.failUnless(pysysconf.check_template(
+						"test/template", "test/testfile",
+						vars))
+		finally:
+			pysysconf.template_cache_entries = entries
+		self.failUnless(len(pysysconf._template_renders) <= 2)
+		self.failUnless(open("test/testfile").read()
+				== "server ntp2\nport 4\n")
+		self.failUnless(len([f for f in os.listdir("test")
+				     if f.startswith("testfile.")]) == 5)
+		self.failIf(pysysconf.check_template("test/template",
+				"test/testfile2", {"server": "ntp1"}))
+		self.failIf(os.path.exists("test/testfile2"))
+
+	def test_check_line_in_file(self):
+		f = open("test/testfile", "w")
+		f.write("127.0.0.1 localhost\n10.0.0.1 a")
+		f.close()
+		os.chmod("test/testfile", 0604)
+		self.failIf(pysysconf.check_line_in_file("test/testfile",
+				["127.0.0.1 localhost", "10.0.0.1 a"]))
+		self.failUnless(pysysconf.check_line_in_file("test/testfile",
+				["10.0.0.1 a", "10.0.0.2 b"], backup = False))
+		self.failUnless(open("test/testfile").read() == "127.0.0.1"
+				" localhost\n10.0.0.1 a\n10.0.0.2 b\n")
+		self.failUnless(stat.S_IMODE(os.stat("test/testfile").st_mode)
+				== 0604)
+		self.failIf(pysysconf.check_line_in_file("test/testfile",
+							 "10.0.0.2 b"))
+		self.failIf([f for f in os.listdir("test") if f != "testfile"])
+
+	def test_check_config_values(self):
+		f = open("test/testfile", "w")
+		f.write("# a = 0\na=2\nb = 1\nabc = 5\n")
+		f.close()
+		self.failIf(pysysconf.check_config_values("test/testfile",
+							  {"b": 1}))
+		self.failUnless(pysysconf.check_config_values("test/testfile",
+				{"a": 1, "b": 1, "c": 3}))
+		self.failUnless(open("test/testfile").read()
+				== "# a = 0\na = 1\nb = 1\nabc = 5\nc = 3\n")
+		self.failUnless(len([f for f in os.listdir("test")
+				     if f.startswith("testfile.")]) == 1)
+		self.failIf(pysysconf.check_config_values("test/testfile",
+				{"a": 1, "c": 3}))
+
+	def test_check_users_groups(self):
+		# with NIS compat entries, whose IDs are not numbers
+		files = {"passwd": "root:x:0:0:root:/root:/bin/bash\n"
+				   "+::::::\n",
+			 "shadow": "root:*:15000:0:99999:7:::\n",
+			 "group": "root:x:0:\nwheel:x:10:root\n+:::\n",
+			 "gshadow": "root:::\nwheel:::root\n"}
+		saved = {}
+		for (name, contents) in files.items():
+			f = open("test/" + name, "w")
+			f.write(contents)
+			f.close()
+			saved[name] = getattr(pysysconf, name + "_file")
+			setattr(pysysconf, name + "_file", "test/" + name)
+		try:
+			self.failUnless(pysysconf.check_groups(
+				{"myapp": {"system": True},
+				 "wheel": {"members": ["alice"]}},
+				backup = False))
+			self.failUnless(pysysconf.check_users(
+				{"myapp": {"system": True},
+				 "alice": {"uid": 1500, "gid": "wheel"}},
+				backup = False))
+			self.failUnless(open("test/group").read()
+					== "root:x:0:\nwheel:x:10:root,alice\n"
+					"+:::\nmyapp:x:201:\n")
+			passwd = open("test/passwd").read().splitlines()
+			self.failUnless(passwd[2] == "alice:x:1500:10::"
+					"/home/alice:/bin/bash")
+			self.failUnless(passwd[3] == "myapp:x:201:201::"
+					"/:/sbin/nologin")
+			self.failUnless(len(open("test/shadow").readlines()) == 3)
+			self.failUnless(open("test/gshadow").read()
+					== "root:::\nwheel:::root,alice\n"
+					"myapp:!::\n")
+			self.failIf(pysysconf.check_groups(
+				{"myapp": {"system": True}}, backup = False))
+			self.failIf(pysysconf.check_users(
+				{"alice": {"uid": 1500}}, backup = False))
+		finally:
+			for (name, value) in saved.items():
+				setattr(pysysconf, name + "_file", value)
+
+	def test_run_roots(self):
+		f = open("test/testsrc", "w")
+		f.write("contents")
+		f.close()
+		roots = ["test/root%d" % i for i in range(3)]
+		for r in roots:
+			os.mkdir(r)
+		results = pysysconf.run_roots(multi_root_policy, roots,
+					      processes = 2)
+		for r in roots:
+			self.failUnless(results[r] == None)
+			self.failUnless(open(r + "/etc/testfile").read()
+					== "contents")
+			self.failUnless(os.readlink(r + "/etc/testlink")
+					== "/etc/testfile")
+		self.failIf(os.path.exists("/etc/testfile"))
+
+	def test_root_links_and_accounts(self):
+		for d in ["test/img", "test/img/etc", "test/img/var",
+			  "test/img/pysysconf-test-run"]:
+			os.mkdir(d)
+		f = open("test/img/etc/passwd", "w")
+		f.write("+::::::\nimguser:x:4242:4343::/:/bin/sh\n")
+		f.close()
+		f = open("test/img/etc/group", "w")
+		f.write("imggroup:x:4343:\n")
+		f.close()
+		# the target does not exist outside the image, so a link followed
+		# on the host cannot change any host file
+		os.symlink("/pysysconf-test-run/resolv.conf",
+			   "test/img/etc/resolv.conf")
+		os.symlink("../../outside", "test/img/etc/outside")
+		os.symlink("/pysysconf-test-run", "test/img/var/run")
+		f = open("test/testsrc", "w")
+		f.write("contents")
+		f.close()
+		pysysconf.root = "test/img"
+		try:
+			self.failUnless(pysysconf.check_line_in_file(
+				"/etc/resolv.conf", "nameserver 192.0.2.1"))
+			self.failIf(pysysconf.check_line_in_file("/etc/outside",
+								 "line"))
+			self.failUnless(pysysconf.check_file_exists(
+				"/var/run/file"))
+			self.failUnless(pysysconf.check_dir_exists(
+				"/var/run/dir"))
+			self.failUnless(pysysconf.check_copy("test/testsrc",
+				"/var/run/copy"))
+			self.failUnless(pysysconf.check_link("/etc/passwd",
+				"/var/run/link"))
+			self.failUnless(pysysconf.check_not_exists(
+				"/var/run/file"))
+			self.failIf(pysysconf.check_file_exists(
+				"/etc/outside/file"))
+			if os.getuid() == 0:
+				self.failUnless(pysysconf.check_file_exists(
+					"/etc/owned", uid = "imguser",
+					gid = "imggroup"))
+				st = os.stat("test/img/etc/owned")
+				self.failUnless((st.st_uid, st.st_gid)
+						== (4242, 4343))
+		finally:
+			pysysconf.root = None
+		self.failUnless(open("test/img/pysysconf-test-run/resolv.conf").read()
+				== "nameserver 192.0.2.1\n")
+		self.failUnless(os.path.islink("test/img/etc/resolv.conf"))
+		self.failIf(os.path.exists("test/outside"))
+		self.failUnless(sorted(os.listdir("test/img/pysysconf-test-run"))
+				== ["copy", "dir", "link", "resolv.conf"])
+
+	def test_import_modules(self):
+		p = subprocess.Popen([sys.executable, "-c", IMPORT_SCRIPT],
+				     stdout = subprocess.PIPE)
+		output = p.communicate()[0].strip()
+		self.failUnless(p.returncode == 0)
+		self.failIf(output, "eagerly imported: " + output)
+
+	def test_import_time(self):
+		# measure an installed import, which does not include compiling
+		py_compile.compile(os.path.splitext(pysysconf.__file__)[0]
+				   + ".py")
+		def run_time(code):
+			start = time.time()
+			subprocess.check_call([sys.executable, "-c", code])
+			return time.time() - start
+		# alternate the runs so that both see the same machine load
+		base_times = []
+		import_times = []
+		for i in range(5):
+			base_times.append(run_time("pass"))
+			import_times.append(run_time("import pysysconf"))
+		base = min(base_times)
+		cost = min(import_times) - base
+		self.failUnless(cost < IMPORT_TIME_RATIO * base,
+				"import took %.3f s, starting python %.3f s"
+				% (cost, base))
+
+	def test_unknown_distribution(self):
+		# a module that cannot find its release file logs an error
+		# and exits as it is imported
+		source = open(os.path.splitext(pysysconf.__file__)[0]
+			      + ".py").read()
+		f = open("test/pysysconf_unknown.py", "w")
+		f.write(source.replace("/etc/system-release",
+				       "test/missing-release"))
+		f.close()
+		p = subprocess.Popen([sys.executable, "-c",
+				      "import sys; sys.path.insert(0, 'test');"
+				      " import pysysconf_unknown"],
+				     stdout = subprocess.PIPE,
+				     stderr = subprocess.PIPE)
+		(output, errors) = p.communicate()
+		self.failUnless(p.returncode == 1, errors)
+		self.failUnless(output.strip() == "Unable to determine"
+				" distribution version", output + errors)
+
+	def test_copy_dir_external_sort(self):
+		pysysconf.check_dir_exists("test/testsrc")
+		pysysconf.check_dir_exists("test/testdst")
+		for i in range(20):
+			pysysconf.check_file_exists("test/testsrc/f%02d" % i)
+		for i in range(10, 30):
+			pysysconf.check_file_exists("test/testdst/f%02d" % i)
+		threshold = pysysconf.external_sort_threshold
+		pysysconf.external_sort_threshold = 3
+		try:
+			self.failUnless(pysysconf.check_copy("test/testsrc",
+					"test/testdst", purge = True))
+		finally:
+			pysysconf.external_sort_threshold = threshold
+		self.failUnless(sorted(os.listdir("test/testdst"))
+				== ["f%02d" % i for i in range(20)])
+		if pysysconf._libc_dir_functions() != None:
+			self.failUnless(sorted(pysysconf._readdir("test/testdst"))
+					== sorted(os.listdir("test/testdst")))
+			self.assertRaises(OSError, pysysconf._readdir,
+					  "test/missing")
+
+	def test_check_copy_hardlinks(self):
+		pysysconf.check_dir_exists("test/testsrc")
+		pysysconf.check_dir_exists("test/testsrc/sub")
+		f = open("test/testsrc/a", "w")
+		f.write("contents")
+		f.close()
+		os.link("test/testsrc/a", "test/testsrc/sub/b")
+		os.link("test/testsrc/a", "test/testsrc/c")
+		self.failUnless(pysysconf.check_copy("test/testsrc",
+				"test/testdst", hardlinks = True))
+		st = os.stat("test/testdst/a")
+		self.failUnless(st.st_nlink == 3)
+		self.failUnless(os.stat("test/testdst/sub/b").st_ino
+				== st.st_ino)
+		self.failUnless(os.stat("test/testdst/c").st_ino == st.st_ino)
+		self.failIf(pysysconf.check_copy("test/testsrc",
+				"test/testdst", hardlinks = True))
+		os.unlink("test/testdst/c")
+		f = open("test/testdst/c", "w")
+		f.write("contents")
+		f.close()
+		self.failUnless(pysysconf.check_copy("test/testsrc",
+				"test/testdst", hardlinks = True, backup = False))
+		self.failUnless(os.stat("test/testdst/c").st_ino == st.st_ino)
+
+	def test_copy_sparse_file(self):
+		f = open("test/testsrc", "w")
+		f.write("start")
+		f.seek(32 * 1024 * 1024)
+		f.write("middle")
+		f.truncate(64 * 1024 * 1024)
+		f.close()
+		large_file_size = pysysconf.large_file_size
+		pysysconf.large_file_size = 1024 * 1024
+		try:
+			self.failUnless(pysysconf.check_copy("test/testsrc",
+							     "test/testdst"))
+		finally:
+			pysysconf.large_file_size = large_file_size
+		src_st = os.stat("test/testsrc")
+		dst_st = os.stat("test/testdst")
+		self.failUnless(dst_st.st_size == src_st.st_size)
+		self.failUnless(dst_st.st_blocks <= src_st.st_blocks + 64)
+		f = open("test/testdst")
+		self.failUnless(f.read(5) == "start")
+		f.seek(32 * 1024 * 1024)
+		self.failUnless(f.read(6) == "middle")
+		f.close()
+		advice = []
+		fadvise = pysysconf._fadvise
+		pysysconf._fadvise = lambda fd, offset, length, how: \
+		    advice.append(how)
+		pysysconf.large_file_size = 1024 * 1024
+		try:
+			self.failIf(pysysconf.check_copy("test/testsrc",
+							 "test/testdst"))
+		finally:
+			pysysconf._fadvise = fadvise
+			pysysconf.large_file_size = large_file_size
+		self.failUnless(advice.count(
+				pysysconf._POSIX_FADV_SEQUENTIAL) == 2)
+		self.failUnless(advice[-1] == pysysconf._POSIX_FADV_DONTNEED)
+
+	def test_copy_filters(self):
+		for d in ["test/testsrc", "test/testsrc/sub", "test/testsrc/.git",
+			  "test/testdst", "test/testdst/local"]:
+			pysysconf.check_dir_exists(d)
+		for f in ["test/testsrc/a.conf", "test/testsrc/b.txt",
+			  "test/testsrc/sub/c.conf", "test/testsrc/.git/HEAD",
+			  "test/testdst/local/keep.conf", "test/testdst/old.conf",
+			  "test/testdst/old.txt"]:
+			pysysconf.check_file_exists(f)
+		seen = []
+		lstat = os.lstat
+		def recording_lstat(path):
+			seen.append(path)
+			return lstat(path)
+		os.lstat = recording_lstat
+		try:
+			self.failUnless(pysysconf.check_copy("test/testsrc",
+				"test/testdst", purge = True, backup = False,
+				include = ["*.conf"], exclude = [".git", "local"]))
+		finally:
+			os.lstat = lstat
+		self.failIf([p for p in seen if ".git" in p or "local" in p])
+		self.failUnless(os.path.exists("test/testdst/a.conf"))
+		self.failUnless(os.path.exists("test/testdst/sub/c.conf"))
+		self.failUnless(os.path.exists("test/testdst/local/keep.conf"))
+		self.failUnless(os.path.exists("test/testdst/old.txt"))
+		self.failIf(os.path.exists("test/testdst/old.conf"))
+		self.failIf(os.path.exists("test/testdst/b.txt"))
+		self.failIf(os.path.exists("test/testdst/.git"))
+		self.failUnless(pysysconf.check_not_exists("test/testdst",
+			test = pysysconf.test_true(), exclude = ["local/keep.conf"]))
+		self.failUnless(os.listdir("test/testdst") == ["local"])
+		self.failUnless(os.listdir("test/testdst/local")
+				== ["keep.conf"])
+
+	def test_check_copy_verify(self):
+		pysysconf.check_dir_exists("test/testsrc")
+		for i in range(10):
+			f = open("test/testsrc/f%d" % i, "w")
+			f.write("contents %d" % i)
+			f.close()
+		self.failUnless(pysysconf.check_copy("test/testsrc",
+				"test/testdst", verify = True))
+		self.failIf(pysysconf.check_copy("test/testsrc",
+				"test/testdst", verify = True))
+		errors = []
+		log = pysysconf.log
+		copy_file_data = pysysconf._copy_file_data
+		def corrupting_copy(src, dst, hash_name = None):
+			digest = copy_file_data(src, dst, hash_name)
+			f = open(dst, "a")
+			f.write("corrupt")
+			f.close()
+			return digest
+		pysysconf.log = lambda level, message, *args: \
+			errors.append(message % args)
+		pysysconf._copy_file_data = corrupting_copy
+		verify_hash = pysysconf.verify_hash
+		pysysconf.verify_hash = "sha256"
+		try:
+			os.unlink("test/testdst/f3")
+			pysysconf.check_copy("test/testsrc", "test/testdst",
+					     verify = True)
+		finally:
+			pysysconf.log = log
+			pysysconf._copy_file_data = copy_file_data
+			pysysconf.verify_hash = verify_hash
+		self.failUnless([m for m in errors if "verification failed"
+				 in m and "f3" in m])
+		self.failIf([m for m in errors if "verification failed"
+			     in m and "f4" in m])
+
+	def test_rpm_vercmp(self):
+		for (a, b, c) in [("1.0", "1.0", 0), ("1.0", "1.0.1", -1),
+				  ("1.10", "1.9", 1), ("1.0a", "1.0", 1),
+				  ("1a", "1.1", -1), ("1.0~rc1", "1.0", -1),
+				  ("1.0^git1", "1.0", 1), ("1.0^git1", "1.0.1", -1),
+				  ("2.0", "2_0", 0)]:
+			self.failUnless(pysysconf._rpm_vercmp(a, b) == c)
+			self.failUnless(pysysconf._rpm_vercmp(b, a) == -c)
+
+	def test_check_rpm_installed(self):
+		db = pysysconf.fake_package_db({"httpd": ["2.4.3-1.fc17"],
+						"kernel": ["3.5.2-1", "3.6.1-1"]},
+					       {"openssl": "1.0.1c-7"})
+		package_backend = pysysconf.package_backend
+		pysysconf.package_backend = db
+		try:
+			self.failIf(pysysconf.check_rpm_installed("httpd"))
+			self.failIf(pysysconf.check_rpm_installed(
+					"kernel >= 3.6"))
+			self.failIf(pysysconf.check_rpm_installed(
+					"httpd = 2.4.3"))
+			self.failUnless(pysysconf.rpm_installed(
+					"kernel < 3.6"))
+			self.failIf(pysysconf.rpm_installed("httpd > 2.4.3"))
+			self.failUnless(pysysconf.check_rpm_installed(
+					"openssl >= 1.0.1"))
+			self.failUnless(pysysconf.rpm_installed("openssl"))
+			self.failUnless(pysysconf.check_rpm_installed(
+					"httpd = 2.4.4-2"))
+			self.failUnless(pysysconf.rpm_installed(
+					"httpd = 2.4.4"))
+			self.failIf(pysysconf.check_rpm_not_installed(
+					"kernel < 3.0"))
+			self.failIf(pysysconf.check_rpm_installed(
+					"zsh < 5.0"))
+			self.failIf(pysysconf.rpm_installed("zsh"))
+			self.failUnless(pysysconf.check_rpm_not_installed(
+					"kernel < 3.6"))
+			self.failIf(pysysconf.rpm_installed("kernel-3.5.2"))
+			self.failUnless(pysysconf.rpm_installed("kernel-3.6.1"))
+			self.failUnless(pysysconf.check_rpm_not_installed(
+					"httpd"))
+			self.failIf(pysysconf.rpm_installed("httpd"))
+		finally:
+			pysysconf.package_backend = package_backend
+		self.failUnless(db.actions == [("install", "openssl"),
+					       ("install", "httpd"),
+					       ("remove", "kernel-3.5.2-1"),
+					       ("remove", "httpd")])
+
+	def test_rpm_name_forms(self):
+		db = pysysconf.fake_package_db({"glibc.i686": ["2.15-57"],
+						"kernel": ["3.5.2-1", "3.6.1-1"]})
+		package_backend = pysysconf.package_backend
+		pysysconf.package_backend = db
+		try:
+			self.failUnless(pysysconf.rpm_installed("glibc"))
+			self.failUnless(pysysconf.rpm_installed("glibc.i686"))
+			self.failIf(pysysconf.rpm_installed("glibc.x86_64"))
+			self.failUnless(pysysconf.rpm_installed("glibc-2.15"))
+			self.failUnless(pysysconf.rpm_installed(
+					"glibc-2.15-57.i686"))
+			self.failIf(pysysconf.rpm_installed("glibc-2.15-58"))
+			self.failUnless(pysysconf.rpm_installed(
+					"kernel-3.5.2-1"))
+			self.failIf(pysysconf.rpm_installed("kernel-3.7"))
+			self.failIf(pysysconf.check_rpm_installed("glibc.i686"))
+			self.failIf(pysysconf.check_rpm_installed(
+					"kernel-3.6.1"))
+			self.failUnless(pysysconf.check_rpm_not_installed(
+					"glibc.i686"))
+			self.failIf(pysysconf.rpm_installed("glibc"))
+		finally:
+			pysysconf.package_backend = package_backend
+		self.failUnless(db.actions == [("remove", "glibc.i686")])
+		log = pysysconf.log
+		errors = []
+		pysysconf.log = lambda level, message, *args: \
+		    errors.append(message % args)
+		try:
+			self.failIf(pysysconf.rpm_installed("httpd >> 2"))
+		finally:
+			pysysconf.log = log
+		self.failUnless(len(errors) == 1)
+
+	def test_shell_command_timeout(self):
+		self.failIf(pysysconf.shell_command("true", timeout = 5))
+		self.failUnless(pysysconf.shell_command("exit 3", timeout = 5)
+				== 3 << 8)
+		log = pysysconf.log
+		errors = []
+		pysysconf.log = lambda level, message, *args: \
+		    level == pysysconf.LOG_ERROR and errors.append(message)
+		start = time.time()
+		try:
+			self.failUnless(pysysconf.shell_command(
+					"sleep 60; sleep 60", timeout = 1)
+					== signal.SIGTERM)
+			with pysysconf.time_limit(1):
+				with pysysconf.time_limit(60):
+					self.failUnless(pysysconf.shell_command(
+							"sleep 60")
+							== signal.SIGTERM)
+		finally:
+			pysysconf.log = log
+		self.failUnless(time.time() - start < 30)
+		self.failUnless(len(errors) == 2)
+
+	def test_run_checks(self):
+		calls = []
+		def check(name, command = "true"):
+			calls.append(name)
+			pysysconf.shell_command(command)
+		deferred = pysysconf.run_checks([
+				(0, None, check, ("low",)),
+				(5, 1, check, ("slow", "sleep 60")),
+				(9, None, check, ("high",)),
+				(5, 60, check, ("long",)),
+				(0, 29.5, check, ("late",))], deadline = 30)
+		self.failUnless(calls == ["high", "slow", "low"])
+		self.failUnless([c[3][0] for c in deferred] == ["long", "late"])
+
+	def test_profile_run(self):
+		def policy():
+			for i in range(3):
+				pysysconf.check_dir_exists("test/dir%d" % i)
+			pysysconf.check_file_exists("test/dir0/file")
+		sites = pysysconf.profile_run(policy, "test/profile")
+		self.failUnless(pysysconf.check_dir_exists.__name__
+				== "check_dir_exists")
+		self.failUnless(sorted([(s.split()[-1], calls)
+					for (s, calls, t, b) in sites])
+				== [("check_dir_exists", 3),
+				    ("check_file_exists", 1)])
+		self.failUnless(os.path.exists("test/profile.pstats"))
+		lines = open("test/profile.collapsed").read().splitlines()
+		self.failUnless(len(lines) == 2)
+		for line in lines:
+			(stack, micros) = line.rsplit(" ", 1)
+			self.failUnless(stack.split(";")[-2].startswith("policy "))
+			int(micros)
+
+	def assert_budget(self, budget, function, *args, **kwargs):
+		(result, counts) = count_calls(function, *args, **kwargs)
+		self.failIf(result, function.__name__ + " made a change")
+		for name in CHANGING_CALLS:
+			budget.setdefault(name, 0)
+		for (name, limit) in budget.items():
+			self.failUnless(counts[name] <= limit,
+					"%s: %d calls to %s, budget %d"
+					% (function.__name__, counts[name], name,
+					   limit))
+
+	def test_syscall_budgets(self):
+		pysysconf.check_dir_exists("test/testsrc")
+		pysysconf.check_dir_exists("test/testsrc/sub")
+		for i in range(5):
+			for d in ["test/testsrc", "test/testsrc/sub"]:
+				f = open("%s/f%d" % (d, i), "w")
+				f.write("contents %d" % i)
+				f.close()
+		os.symlink("f0", "test/testsrc/link")
+		pysysconf.check_copy("test/testsrc", "test/testdst")
+		# 2 directories, 10 files, and 1 symlink: each file is stat'ed
+		# once on each side and once more to check its attributes,
+		# and the contents of both copies are read once
+		self.assert_budget({"lstat": 37, "listdir": 4, "file_open": 20,
+				    "readlink": 2, "read": 0},
+				   pysysconf.check_copy, "test/testsrc",
+				   "test/testdst")
+		self.assert_budget({"lstat": 3, "file_open": 2},
+				   pysysconf.check_copy, "test/testsrc/f0",
+				   "test/testdst/f0")
+		pysysconf.check_link("test/testsrc/f0", "test/link")
+		self.assert_budget({"lstat": 2, "readlink": 1, "file_open": 0},
+				   pysysconf.check_link, "test/testsrc/f0",
+				   "test/link")
+		self.assert_budget({"lstat": 1, "file_open": 0},
+				   pysysconf.check_file_exists, "test/testdst/f0")
+		self.assert_budget({"lstat": 1, "listdir": 0},
+				   pysysconf.check_dir_exists, "test/testdst")
+		self.assert_budget({"lstat": 1},
+				   pysysconf.check_not_exists, "test/missing")
+		# each of the 13 entries is stat'ed once
+		self.assert_budget({"lstat": 14, "listdir": 2, "file_open": 0},
+				   pysysconf.check_not_exists, "test/testdst",
+				   test = pysysconf.test_false())
+
+	def test_stat_spec(self):
+		specs = pysysconf.stat_specs([{"perm": "0640"},
+					      {"perm": 0640},
+					      {"perm": "0600", "uid": 0}])
+		self.failUnless(specs[0] is specs[1])
+		self.failUnless(specs[0].perm == 0640)
+		self.failIf(specs[0] is specs[2])
+		self.assertRaises(AttributeError, setattr, specs[0], "mode", 1)
+		self.assertRaises(pysysconf.PysysconfError, pysysconf.stat_spec,
+				  perm = "rw-r-----")
+		self.failUnless(pysysconf.check_file_exists("test/testfile",
+							    spec = specs[2]))
+		self.failUnless(stat.S_IMODE(os.stat("test/testfile").st_mode)
+				== 0600)
+		self.failIf(pysysconf.check_file_exists("test/testfile",
+							spec = specs[2]))
+		pysysconf.check_dir_exists("test/testsrc")
+		pysysconf.check_file_exists("test/testsrc/a", perm = 0666)
+		self.failUnless(pysysconf.check_copy("test/testsrc",
+				"test/testdst", spec = pysysconf.stat_spec(
+					umask = "0750", dmask = "0700")))
+		self.failUnless(stat.S_IMODE(os.stat("test/testdst/a").st_mode)
+				== 0640)
+		self.failUnless(stat.S_IMODE(os.stat("test/testdst").st_mode)
+				== 0700)
+		# a change of owner alone is reported as a change
+		uid = os.getuid()
+		gid = os.getgid()
+		os.chown("test/testfile", uid, gid)
+		other_gid = [g for g in os.getgroups() if g != gid]
+		if uid == 0 or other_gid:
+			if uid == 0:
+				new_uid = 1
+				new_gid = 1
+			else:
+				new_uid = uid
+				new_gid = other_gid[0]
+			self.failUnless(pysysconf.check_file_exists(
+				"test/testfile", uid = new_uid, gid = new_gid))
+			self.failUnless(os.stat("test/testfile").st_uid
+					== new_uid)
+			self.failIf(pysysconf.check_file_exists("test/testfile",
+				uid = new_uid, gid = new_gid))
+			os.chown("test/testfile", uid, gid)
+		# a spec cannot be combined with separate settings
+		self.failIf(pysysconf.check_file_exists("test/testfile",
+				spec = specs[2], perm = 0644))
+		self.failUnless(stat.S_IMODE(os.stat("test/testfile").st_mode)
+				== 0600)
+
+	def test_filesystem_backends(self):
+		fs = pysysconf.memory_filesystem()
+		pysysconf.filesystem = fs
+		try:
+			pysysconf.check_dir_exists("/src")
+			pysysconf.check_dir_exists("/src/sub")
+			f = fs.open("/src/sub/a", "w")
+			f.write("contents")
+			f.close()
+			fs.link("/src/sub/a", "/src/b")
+			pysysconf.check_link("sub/a", "/src/c")
+			pysysconf.check_dir_exists("/dst")
+			pysysconf.check_file_exists("/dst/stale")
+			self.failIf(pysysconf.check_file_exists("/dst/stale"))
+			self.failUnless(pysysconf.check_copy("/src", "/dst",
+					purge = True, hardlinks = True,
+					verify = True))
+			self.failIf(pysysconf.check_copy("/src", "/dst",
+					purge = True, hardlinks = True))
+			self.failUnless(fs.open("/dst/sub/a").read() == "contents")
+			self.failUnless(fs.stat("/dst/c").st_ino
+					== fs.stat("/dst/b").st_ino)
+			self.failUnless(sorted(fs.listdir("/dst"))
+					== ["b", "c", "sub"])
+			self.failUnless(pysysconf.check_not_exists("/dst",
+					test = pysysconf.test_regexp(re.compile("/a$"))))
+			self.failUnless(fs.listdir("/dst/sub") == [])
+			self.failUnless(pysysconf.check_not_exists("/dst"))
+			self.assertRaises(OSError, fs.lstat, "/dst")
+			self.failIf(os.path.exists("/dst"))
+		finally:
+			pysysconf.filesystem = None
+		pysysconf.check_dir_exists("test/root")
+		pysysconf.filesystem = pysysconf.prefixed_filesystem(
+			os.path.abspath("test/root"))
+		try:
+			pysysconf.check_dir_exists("/etc")
+			pysysconf.check_file_exists("/etc/motd")
+			self.failUnless(pysysconf.check_copy("/etc", "/etc.copy"))
+		finally:
+			pysysconf.filesystem = None
+		self.failUnless(os.path.isfile("test/root/etc.copy/motd"))
+
+	def test_log_aggregate(self):
+		pysysconf.check_dir_exists("test/spool")
+		for i in range(1200):
+			pysysconf.check_file_exists("test/spool/f%d" % i)
+		stdout = sys.stdout
+		settings = (pysysconf.verbosity, pysysconf.syslog_verbosity,
+			    pysysconf.log_aggregate, pysysconf.log_buffer_lines)
+		sys.stdout = StringIO.StringIO()
+		try:
+			pysysconf.verbosity = pysysconf.LOG_ACTION
+			pysysconf.syslog_verbosity = pysysconf.LOG_NONE
+			pysysconf.log_aggregate = True
+			pysysconf.log_buffer_lines = 100
+			self.failUnless(pysysconf.check_not_exists("test/spool",
+					test = pysysconf.test_true()))
+			pysysconf.log_aggregate = False
+			pysysconf.check_file_exists("test/spool/a")
+			pysysconf.check_file_exists("test/spool/b")
+			held = sys.stdout.getvalue()
+			pysysconf.flush_log()
+			output = sys.stdout.getvalue()
+		finally:
+			sys.stdout = stdout
+			(pysysconf.verbosity, pysysconf.syslog_verbosity,
+			 pysysconf.log_aggregate,
+			 pysysconf.log_buffer_lines) = settings
+		self.failUnless(held == "")
+		# messages still held back are written at exit
+		p = subprocess.Popen([sys.executable, "-c",
+				      BUFFERED_LOG_SCRIPT],
+				     stdout = subprocess.PIPE)
+		self.failUnless(p.communicate()[0] == "one\ntwo\n")
+		self.failUnless(output.splitlines() ==
+				["removed 1,200 objects under test/spool",
+				 "Creating file test/spool/a",
+				 "Creating file test/spool/b"])
+
+	def test_report(self):
+		pysysconf.check_dir_exists("test/testsrc")
+		f = open("test/testsrc/a", "w")
+		f.write("0123456789")
+		f.close()
+		check_copy = pysysconf.check_copy
+		pysysconf.start_report("test/report.jsonl")
+		try:
+			self.assertRaises(pysysconf.PysysconfError,
+					  pysysconf.start_report, "test/other")
+			pysysconf.check_copy("test/testsrc", "test/testdst")
+			pysysconf.check_file_exists(dst = "test/testdst/a")
+			pysysconf.check_copy("test/missing", "test/testdst2")
+		finally:
+			pysysconf.finish_report()
+		pysysconf.finish_report()
+		events = [json.loads(line) for line in open("test/report.jsonl")]
+		self.failUnless([e["seq"] for e in events] == [1, 2, 3])
+		self.failUnless(len(set([e["run"] for e in events])) == 1)
+		(copy, exists, missing) = events
+		self.failUnless(copy["check"] == "check_copy")
+		self.failUnless(copy["resource"] == "test/testdst")
+		self.failUnless(copy["action"] == "changed")
+		self.failUnless(copy["before"] == None)
+		self.failUnless(copy["after"]["type"] == "directory")
+		self.failUnless(copy["bytes"] == 10)
+		self.failUnless(copy["error"] == None)
+		self.failUnless(exists["action"] == "unchanged")
+		self.failUnless(exists["resource"] == "test/testdst/a")
+		self.failUnless(exists["before"] == exists["after"])
+		self.failUnless(exists["after"]["size"] == 10)
+		self.failUnless(missing["action"] == "error")
+		self.failUnless("test/missing" in missing["error"])
+		self.failUnless(set(copy.keys()) == set(["schema", "run", "seq",
+			"host", "time", "check", "resource", "action", "before",
+			"after", "duration", "bytes", "error"]))
+		self.failUnless(pysysconf.check_copy is check_copy)
+
+	def test_report_write_error(self):
+		class full_disk:
+			def write(self, data):
+				raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+			def flush(self):
+				pass
+		pysysconf.check_file_exists("test/testfile")
+		log = pysysconf.log
+		errors = []
+		pysysconf.log = lambda level, message, *args: \
+		    level == pysysconf.LOG_ERROR and errors.append(message % args)
+		pysysconf.start_report(full_disk())
+		try:
+			# more events than the queue holds
+			for i in range(1100):
+				pysysconf.check_file_exists("test/testfile")
+		finally:
+			pysysconf.finish_report()
+			pysysconf.log = log
+		self.failUnless(len(errors) == 1)
+		self.failUnless("No space left" in errors[0], errors)
+		self.failUnless("1100 events not written" in errors[0], errors)
+
+	def test_expiry_index(self):
+		old = time.time() - 3 * 86400
+		for d in ["test/spool", "test/spool/a", "test/spool/a/deep",
+			  "test/spool/b"]:
+			pysysconf.check_dir_exists(d)
+		for f in ["a/old", "a/new", "a/deep/new", "b/new"]:
+			pysysconf.check_file_exists("test/spool/" + f)
+		os.utime("test/spool/a/old", (old, old))
+		test = pysysconf.test_age(age = datetime.timedelta(days = 1))
+		settings = (pysysconf.state_db, pysysconf.expiry_index)
+		pysysconf.state_db = "test/expiry.db"
+		pysysconf.expiry_index = True
+		try:
+			self.failUnless(pysysconf.check_not_exists("test/spool",
+								   test = test))
+			self.failIf(os.path.exists("test/spool/a/old"))
+			# directories changed within a second of being listed may
+			# gain entries without changing their mtime, so are
+			# listed again until they are older than that
+			(result, counts) = count_calls(pysysconf.check_not_exists,
+						       "test/spool", test = test)
+			self.failUnless(counts["listdir"] == 4)
+			time.sleep(1.1)
+			pysysconf.check_not_exists("test/spool", test = test)
+			(result, counts) = count_calls(pysysconf.check_not_exists,
+						       "test/spool", test = test)
+			self.failIf(result)
+			self.failUnless(counts["listdir"] == 0)
+			self.failUnless(counts["lstat"] == 4)
+			pysysconf.check_file_exists("test/spool/a/deep/old")
+			os.utime("test/spool/a/deep/old", (old, old))
+			(result, counts) = count_calls(pysysconf.check_not_exists,
+						       "test/spool", test = test)
+			self.failUnless(result)
+			self.failUnless(counts["listdir"] == 1)
+			self.failIf(os.path.exists("test/spool/a/deep/old"))
+			self.failUnless(os.path.exists("test/spool/a/deep/new"))
+			(result, counts) = count_calls(pysysconf.check_not_exists,
+						       "test/spool", test = test)
+			self.failUnless(counts["listdir"] == 1)
+			pysysconf.expiry_index = False
+			pysysconf.check_file_exists("test/spool/b/old")
+			os.utime("test/spool/b/old", (old, old))
+			pysysconf.expiry_index = True
+			pysysconf.force_full_run = True
+			self.failUnless(pysysconf.check_not_exists("test/spool",
+								   test = test))
+		finally:
+			pysysconf.force_full_run = False
+			(pysysconf.state_db, pysysconf.expiry_index) = settings
+		self.failIf(os.path.exists("test/spool/b/old"))
+
 suite = unittest.TestSuite()
 suite.addTest(unittest.makeSuite(TestPySysConfFunctions))
 unittest.TextTestRunner(verbosity=2).run(suite)